@@ -0,0 +1,99 @@
+"""
+基准测试：历史搜索（FTS5 trigram 索引 vs LIKE 全表过滤）的耗时与消息总量的关系
+
+数据：--users 个用户平均分摊的消息，每 1000 条中有一条包含待搜索的短语。
+- FTS5：search_messages 走 messagefts 索引（三字及以上的词），命中行回表后按用户过滤
+- LIKE：按 user_id 索引取出该用户的消息逐条 LIKE '%...%'（短词回退路径 / 旧方式的近似）
+
+运行方式（在 backend 目录下）：
+    python benchmarks/bench_history_search.py
+    python benchmarks/bench_history_search.py --sizes 10000 100000 1000000 --users 10
+
+预期：FTS5 的耗时取决于（所有用户的）命中数，随消息总量增长很慢；
+LIKE 的耗时随该用户的消息数增长（默认单个用户，即最坏情况）。
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PHRASES = ["孩子不肯写作业怎么办？", "睡前总要玩手机", "和同学闹矛盾了", "吃饭时挑食严重", "早上起床困难"]
+NEEDLE = "撒谎背后的原因"
+
+
+def _seed(service, users: int, count: int, offset: int) -> None:
+    # 直接批量插入（触发器同步写入全文索引），每 1000 条命中一条
+    from modules.history.service import MessageModel, SessionModel
+
+    rng = random.Random(offset)
+    start = datetime.utcnow() - timedelta(seconds=count)
+    with service.engine.begin() as conn:
+        if offset == 0:
+            conn.execute(SessionModel.__table__.insert(), [
+                {"session_id": f"s{u}", "user_id": f"bench_user_{u}", "created_at": start, "updated_at": start}
+                for u in range(users)
+            ])
+        rows = []
+        for i in range(offset, offset + count):
+            u = i % users
+            content = rng.choice(PHRASES) * 3
+            if i % 1000 == 0:
+                content += f"要先了解{NEEDLE}。"
+            rows.append({
+                "session_id": f"s{u}", "user_id": f"bench_user_{u}", "role": "assistant", "content": content,
+                "timestamp": start + timedelta(seconds=i), "truncated": False,
+            })
+        conn.execute(MessageModel.__table__.insert(), rows)
+
+
+def _timeit(fn, repeat: int) -> float:
+    fn()  # 预热
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 300000])
+    parser.add_argument("--users", type=int, default=1, help="消息分摊到的用户数")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 在导入配置之前把数据库指向临时目录
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        from sqlalchemy import text
+        from modules.history.service import HistoryService
+
+        service = HistoryService()
+        service.init_db()
+        user_id = "bench_user_0"
+
+        print(f"{'messages':>10} | {'fts5 (ms)':>10} | {'like (ms)':>10}")
+        print("-" * 37)
+        seeded = 0
+        for size in sorted(args.sizes):
+            _seed(service, args.users, size - seeded, seeded)
+            seeded = size
+
+            def like():
+                with service.engine.connect() as conn:
+                    return conn.execute(text(
+                        "SELECT id FROM messagemodel WHERE user_id = :u AND content LIKE :p ORDER BY id DESC LIMIT 20"
+                    ), {"u": user_id, "p": f"%{NEEDLE}%"}).all()
+
+            fts_ms = _timeit(lambda: service.search_messages(user_id, NEEDLE), args.repeat)
+            like_ms = _timeit(like, args.repeat)
+            print(f"{size:>10} | {fts_ms:10.3f} | {like_ms:10.3f}")
+        service.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
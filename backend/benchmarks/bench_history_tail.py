@@ -0,0 +1,91 @@
+"""
+基准测试：每轮对话读取“最近 N 条消息”的耗时与会话长度的关系
+
+对比两种读取方式：
+- 旧方式：get_history 取出整个会话（构造全部 Message 对象）后切片 [-limit:]
+- 新方式：get_messages_for_api 在 (session_id, timestamp) 复合索引上 ORDER BY ... DESC LIMIT n
+
+运行方式（在 backend 目录下）：
+    python benchmarks/bench_history_tail.py
+    python benchmarks/bench_history_tail.py --sizes 10 1000 100000 --limit 10
+
+预期：新方式的耗时基本不随会话长度变化；旧方式随消息数线性增长。
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _seed(service, session_id: str, user_id: str, count: int) -> None:
+    # 直接批量插入，避免逐条 add_message 提交带来的准备时间
+    from modules.history.service import MessageModel
+
+    start = datetime.utcnow() - timedelta(seconds=count)
+    rows = [
+        {
+            "session_id": session_id,
+            "user_id": user_id,
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"第 {i} 条消息：孩子不肯写作业怎么办？" * 3,
+            "timestamp": start + timedelta(seconds=i),
+            "truncated": False,
+        }
+        for i in range(count)
+    ]
+    with service.engine.begin() as conn:
+        conn.execute(MessageModel.__table__.insert(), rows)
+
+
+def _timeit(fn, repeat: int) -> float:
+    fn()  # 预热（建立连接、填充页缓存）
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--limit", type=int, default=10, help="每轮读取的最近消息条数")
+    parser.add_argument("--repeat", type=int, default=50, help="每个规模的重复次数")
+    parser.add_argument("--full-max", type=int, default=10000, help="旧方式只测到该规模（更大时太慢）")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 在导入配置之前把数据库指向临时目录
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        from modules.history.service import HistoryService
+
+        service = HistoryService()
+        service.init_db()
+        user_id = "bench_user"
+
+        print(f"{'messages':>10} | {'tail query (ms)':>16} | {'full load (ms)':>15}")
+        print("-" * 48)
+        for size in args.sizes:
+            session_id = service.create_session(user_id)
+            _seed(service, session_id, user_id, size)
+
+            tail_ms = _timeit(
+                lambda: service.get_messages_for_api(user_id, session_id, args.limit), args.repeat
+            )
+            if size <= args.full_max:
+                full_ms = _timeit(
+                    lambda: service.get_history(user_id, session_id).messages[-args.limit:],
+                    max(1, args.repeat // 10),
+                )
+                full = f"{full_ms:15.3f}"
+            else:
+                full = f"{'(skipped)':>15}"
+            print(f"{size:>10} | {tail_ms:16.3f} | {full}")
+        service.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,13 +8,60 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+# ========== System Prompt 组成部分 ==========
+# 基础 Prompt 在所有请求中保持逐字不变（作为稳定前缀），可变部分依次追加在末尾
+
+# 基础角色设定
+BASE_PROMPT = """你是一位资深的儿童教育专家和家庭心理顾问。你的职责是帮助家长处理育儿过程中遇到的各种困惑和挑战。
+
+你的回答风格：
+1. 先共情：理解家长当下的情绪（焦虑、愤怒、无助），用温暖的语气先安抚他们
+2. 再分析：从儿童心理学角度解释孩子行为背后的动机和原因
+3. 给话术：提供具体的、可直接使用的沟通语句（"第一句可以这样说..."）
+4. 避坑提醒：指出常见的错误做法及其后果
+
+你的专业领域包括：
+- 儿童安全教育（走丢、陌生人、网络安全等）
+- 情绪管理与心理健康
+- 行为习惯养成（撒谎、拖延、注意力等）
+- 社交能力培养（被欺负、交友困难等）
+- 道德品质教育（诚实、责任、同理心等）
+
+重要原则：
+- 绝不建议任何形式的体罚或语言暴力
+- 尊重儿童的人格和尊严
+- 建议要具体可操作，而非空洞的大道理
+- 如果情况严重（如心理创伤、自残倾向），建议寻求专业心理咨询"""
+
+# 根据模式调整
+MODE_INSTRUCTIONS = {
+    "concise": """\n\n【简洁模式】：
+- 回答控制在 200-300 字以内
+- 只给最核心的建议和话术
+- 省略冗长的心理学原理解释""",
+    "detailed": """\n\n【详细模式】：
+- 深入分析行为背后的心理动机
+- 提供完整的教育方案
+- 适当引用儿童心理学理论支撑""",
+}
+
+# 根据年龄段调整（键与 Settings.get_age_band 的返回值一致）
+AGE_INSTRUCTIONS = {
+    "any": "",
+    "0-3": "\n\n【年龄段】：0-3岁婴幼儿期，重点关注安全感建立、情绪识别、基础规则意识。语言要极简，多用具体动作指导。",
+    "3-6": "\n\n【年龄段】：3-6岁学前期，重点关注自我控制、同理心培养、社交技能。可以通过故事、游戏引导。",
+    "6-12": "\n\n【年龄段】：6-12岁学龄期，重点关注责任感、学习习惯、情绪管理。可以进行更多逻辑推理式沟通。",
+    "12+": "\n\n【年龄段】：12岁以上青春期，重点关注自主性、价值观形成、同伴关系。尊重其独立性，避免说教。",
+}
+
+
 class Settings:
     """
     应用配置类
     
     集中管理所有配置项，包括：
     - API 连接配置（密钥、地址、模型）
-    - 对话管理配置（历史长度）
+    - 对话管理配置（上下文 token 预算）
     - System Prompt 生成逻辑
     
     设计模式：单例配置类
@@ -37,14 +84,144 @@ class Settings:
     # 使用的模型名称（从环境变量读取）
     # 示例："gpt-4o-mini", "qwen-plus", "deepseek-chat"
     MODEL_NAME: str = os.getenv("MODEL_NAME", "gpt-4o-mini")
+
+    # ========== LLM 连接池配置 ==========
+
+    # 单次 LLM 请求超时时间（秒），防止长时间等待
+    LLM_TIMEOUT: float = float(os.getenv("LLM_TIMEOUT", "60"))
+
+    # 连接池上限：同一 worker 内允许同时进行的 LLM 请求数
+    LLM_MAX_CONNECTIONS: int = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+
+    # 空闲时保留的 keep-alive 连接数，以及空闲连接的保活时长（秒）
+    # 复用连接可省去每次请求的 TCP/TLS 握手
+    LLM_MAX_KEEPALIVE_CONNECTIONS: int = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+    LLM_KEEPALIVE_EXPIRY: float = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+
+    # ========== 数据库配置 ==========
+    
+    # 数据库地址（SQLAlchemy URL），档案与历史服务共用
+    DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./data.db")
+    
+    # 连接池：常驻连接数、高峰时额外允许的连接数、取连接的等待超时（秒）
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "5"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    
+    # SQLite 调优：写锁等待时间（毫秒）、内存映射大小（字节）、页缓存大小（KiB）
+    DB_BUSY_TIMEOUT_MS: int = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+    DB_MMAP_SIZE: int = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+    DB_CACHE_SIZE_KB: int = int(os.getenv("DB_CACHE_SIZE_KB", str(64 * 1024)))
+    
+    # 数据库线程池大小：同步的 SQLite 调用在该线程池中执行，不阻塞事件循环
+    # SQLite 写入本身是串行的，线程数不宜过大
+    DB_EXECUTOR_WORKERS: int = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+    
+    # 批量删除（清空/删除会话）每批删除的行数；每批单独提交，避免长时间持有写锁
+    DB_DELETE_BATCH_SIZE: int = int(os.getenv("DB_DELETE_BATCH_SIZE", "1000"))
+    
+    # 冷会话归档（python -m modules.history.maintenance）：超过 N 天无活动的会话压缩归档；每批挑选的会话数
+    HISTORY_ARCHIVE_IDLE_DAYS: float = float(os.getenv("HISTORY_ARCHIVE_IDLE_DAYS", "30"))
+    HISTORY_ARCHIVE_BATCH_SIZE: int = int(os.getenv("HISTORY_ARCHIVE_BATCH_SIZE", "100"))
+    
+    # 历史消息写缓冲：开启后消息先进入内存队列，后台按间隔（毫秒）或攒满 N 条时批量写入
+    # 一个事务只做一次 fsync；进程被强杀时可能丢失最后几毫秒内的消息
+    HISTORY_WRITE_BEHIND: bool = os.getenv("HISTORY_WRITE_BEHIND", "false").lower() == "true"
+    HISTORY_FLUSH_INTERVAL_MS: float = float(os.getenv("HISTORY_FLUSH_INTERVAL_MS", "20"))
+    HISTORY_FLUSH_MAX_ROWS: int = int(os.getenv("HISTORY_FLUSH_MAX_ROWS", "100"))
+    
+    # 当前会话指针缓存（user_id → 最近更新的会话），省去每次按 updated_at 排序查询
+    CURRENT_SESSION_CACHE_MAX_ENTRIES: int = int(os.getenv("CURRENT_SESSION_CACHE_MAX_ENTRIES", "10000"))
+    CURRENT_SESSION_CACHE_TTL: float = float(os.getenv("CURRENT_SESSION_CACHE_TTL", "3600"))  # 秒
     
     # ========== 对话管理配置 ==========
     
-    # 对话历史保留轮数（1 轮 = 1 条 user + 1 条 assistant）
-    # 设置为 5 表示最多保留 10 条消息（5 轮对话）
-    # 原因：防止 token 超限，控制 API 成本
-    # 可根据实际需求调整（建议 3-10 轮）
-    MAX_HISTORY_ROUNDS: int = 5  # 最多保留最近 5 轮对话（10条消息）
+    # 单次请求的上下文 token 预算（System Prompt + 历史 + 当前问题 + 预留输出）
+    # 历史按 token 数从新到旧填充，直到预算用完（而不是固定保留 N 条消息）
+    # 原因：防止 token 超限，控制 API 成本与响应延迟
+    # 应小于所用模型的上下文窗口；可根据模型与成本调整
+    CONTEXT_TOKEN_BUDGET: int = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+    
+    # 单次回答的最大生成 token 数（控制回答长度），构建上下文时为其预留空间
+    MAX_OUTPUT_TOKENS: int = int(os.getenv("MAX_OUTPUT_TOKENS", "800"))
+    
+    # ========== 会话摘要配置 ==========
+    
+    # 长对话中较早的消息在后台折叠为摘要，上下文发送“摘要 + 最近消息”
+    # SUMMARY_KEEP_RECENT：始终以原文保留的最近消息条数
+    # SUMMARY_TRIGGER_MESSAGES：更早的未摘要消息达到该条数时触发一次摘要
+    # 每次摘要都是一次额外的（计费的）LLM 调用，默认关闭
+    SUMMARY_ENABLED: bool = os.getenv("SUMMARY_ENABLED", "false").lower() == "true"
+    SUMMARY_KEEP_RECENT: int = int(os.getenv("SUMMARY_KEEP_RECENT", "6"))
+    SUMMARY_TRIGGER_MESSAGES: int = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", "8"))
+    SUMMARY_MAX_TOKENS: int = int(os.getenv("SUMMARY_MAX_TOKENS", "400"))
+    
+    # ========== 回答缓存配置 ==========
+    
+    # 无历史的首个问题（如“孩子不肯写作业怎么办”）高度重复，命中缓存可省去一次 LLM 调用
+    # 缓存键：规范化后的问题 + 回答模式 + 年龄段
+    RESPONSE_CACHE_ENABLED: bool = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+    RESPONSE_CACHE_MAX_ENTRIES: int = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+    RESPONSE_CACHE_TTL: float = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # 秒
+    
+    # 档案缓存：每轮对话都要读取孩子年龄，档案却极少变化
+    # 条目最长保留 PROFILE_CACHE_TTL 秒，且不跨越本地零点（年龄按日期计算）
+    PROFILE_CACHE_MAX_ENTRIES: int = int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "10000"))
+    PROFILE_CACHE_TTL: float = float(os.getenv("PROFILE_CACHE_TTL", "600"))  # 秒
+    
+    # ========== 运行指标配置 ==========
+    
+    # GET /metrics（Prometheus 文本格式）：接口不鉴权，默认关闭；
+    # 开启后请在反向代理上限制访问来源（只允许 Prometheus 抓取端）
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+    
+    # ========== 请求追踪配置 ==========
+    
+    # 每个请求附加 X-Request-ID 响应头，慢请求输出一行 JSON 追踪日志
+    # TRACE_LOG_MIN_MS：只记录耗时不低于该值的请求（默认只看慢请求；0 表示全部记录）
+    # TRACE_SERVER_TIMING：追加 Server-Timing 响应头（暴露内部阶段名称与耗时，仅用于调试/内网）
+    TRACING_ENABLED: bool = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+    TRACE_LOG_MIN_MS: float = float(os.getenv("TRACE_LOG_MIN_MS", "1000"))
+    TRACE_SERVER_TIMING: bool = os.getenv("TRACE_SERVER_TIMING", "false").lower() == "true"
+    # 采样分析器的调用栈采样间隔（毫秒）；采样比例通过管理接口 PUT /admin/profiler 按需开启
+    PROFILER_INTERVAL_MS: float = float(os.getenv("PROFILER_INTERVAL_MS", "5"))
+    
+    # ========== 管理接口配置 ==========
+    
+    # 管理接口（/admin/*）口令，请求头 X-Admin-Token 需与之一致
+    # 为空时管理接口全部关闭（返回 403）
+    ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "")
+    
+    def __init__(self):
+        # 启动时预编译所有 System Prompt 组合，请求路径上不再做字符串拼接
+        self._prompt_table = {
+            (mode, band): BASE_PROMPT + mode_instruction + age_instruction
+            for mode, mode_instruction in MODE_INSTRUCTIONS.items()
+            for band, age_instruction in AGE_INSTRUCTIONS.items()
+        }
+    
+    def get_mode(self, mode: str = "detailed") -> str:
+        """
+        规范化回答模式：只有 "concise" 为简洁模式，其余（含 None）均按详细模式处理
+        """
+        return "concise" if mode == "concise" else "detailed"
+    
+    def get_age_band(self, child_age: int = None) -> str:
+        """
+        将孩子年龄映射为年龄段（System Prompt 与回答缓存共用同一划分）
+        
+        返回：
+            "0-3" / "3-6" / "6-12" / "12+"；未指定年龄时返回 "any"
+        """
+        if not child_age:
+            return "any"
+        if child_age <= 3:
+            return "0-3"
+        if child_age <= 6:
+            return "3-6"
+        if child_age <= 12:
+            return "6-12"
+        return "12+"
     
     def get_system_prompt(self, mode: str = "detailed", child_age: int = None) -> str:
         """
@@ -101,57 +278,13 @@ class Settings:
             # 返回的 Prompt 会要求：200-300字、核心建议、无年龄特定内容
         
         技术细节：
-        - 使用字符串拼接组合不同部分
-        - 确保 Prompt 语义完整、逻辑清晰
-        - 已针对 Qwen 模型优化（非流式响应）
+        - 所有（模式 × 年龄段）组合在启动时预先拼接好（共 2 × 5 = 10 个），请求时只做一次查表
+        - 布局：[基础 Prompt（所有组合完全相同）][模式说明][年龄段说明]
+          可变部分全部放在末尾，所有请求共享同一段很长的稳定前缀，
+          便于 OpenAI 兼容服务商的前缀缓存（Prompt Caching）命中，降低首字延迟与费用
+        - 不要在基础 Prompt 中插入日期、用户信息等可变内容，否则会破坏前缀缓存
         """
-        # 基础角色设定
-        base_prompt = """你是一位资深的儿童教育专家和家庭心理顾问。你的职责是帮助家长处理育儿过程中遇到的各种困惑和挑战。
-
-你的回答风格：
-1. 先共情：理解家长当下的情绪（焦虑、愤怒、无助），用温暖的语气先安抚他们
-2. 再分析：从儿童心理学角度解释孩子行为背后的动机和原因
-3. 给话术：提供具体的、可直接使用的沟通语句（"第一句可以这样说..."）
-4. 避坑提醒：指出常见的错误做法及其后果
-
-你的专业领域包括：
-- 儿童安全教育（走丢、陌生人、网络安全等）
-- 情绪管理与心理健康
-- 行为习惯养成（撒谎、拖延、注意力等）
-- 社交能力培养（被欺负、交友困难等）
-- 道德品质教育（诚实、责任、同理心等）
-
-重要原则：
-- 绝不建议任何形式的体罚或语言暴力
-- 尊重儿童的人格和尊严
-- 建议要具体可操作，而非空洞的大道理
-- 如果情况严重（如心理创伤、自残倾向），建议寻求专业心理咨询"""
-        
-        # 根据模式调整
-        if mode == "concise":
-            mode_instruction = """\n\n【简洁模式】：
-- 回答控制在 200-300 字以内
-- 只给最核心的建议和话术
-- 省略冗长的心理学原理解释"""
-        else:
-            mode_instruction = """\n\n【详细模式】：
-- 深入分析行为背后的心理动机
-- 提供完整的教育方案
-- 适当引用儿童心理学理论支撑"""
-        
-        # 根据年龄调整
-        age_instruction = ""
-        if child_age:
-            if child_age <= 3:
-                age_instruction = "\n\n【年龄段】：0-3岁婴幼儿期，重点关注安全感建立、情绪识别、基础规则意识。语言要极简，多用具体动作指导。"
-            elif child_age <= 6:
-                age_instruction = "\n\n【年龄段】：3-6岁学前期，重点关注自我控制、同理心培养、社交技能。可以通过故事、游戏引导。"
-            elif child_age <= 12:
-                age_instruction = "\n\n【年龄段】：6-12岁学龄期，重点关注责任感、学习习惯、情绪管理。可以进行更多逻辑推理式沟通。"
-            else:
-                age_instruction = "\n\n【年龄段】：12岁以上青春期，重点关注自主性、价值观形成、同伴关系。尊重其独立性，避免说教。"
-        
-        return base_prompt + mode_instruction + age_instruction
+        return self._prompt_table[(self.get_mode(mode), self.get_age_band(child_age))]
 
 
 settings = Settings()
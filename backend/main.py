@@ -3,14 +3,15 @@
 
 功能说明：
 - 提供 POST /chat 接口，接收家长问题并返回育儿建议
+- 提供 POST /chat/stream 接口，以 SSE 流式返回育儿建议
 - 支持详细/简洁两种回答模式
 - 根据孩子年龄自适应调整回答策略
 - 内置安全过滤机制，防止不当建议
-- 自动限制对话历史长度，优化 token 使用
+- 按 token 预算裁剪对话历史，优化 token 使用
 
 技术栈：
 - FastAPI: Web 框架
-- OpenAI SDK: LLM 调用（兼容 Qwen 等模型）
+- OpenAI SDK: LLM 调用（兼容 Qwen 等模型，异步客户端 + 连接池）
 - Pydantic: 数据验证
 
 作者：AI 教育项目组
@@ -21,21 +22,48 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from openai import OpenAI
+from contextlib import asynccontextmanager
 from typing import List, Optional
-import json
 
-# 导入配置文件（包含 API Key、模型名称、System Prompt 生成逻辑等）
-from config import settings
+from modules.chat import llm_client_manager
+from modules.chat.service import chat_service
+from modules.chat.sse import sse_event
+from modules.database import shutdown_db_executor
+from modules.history.service import history_service
+from modules.history.summarizer import summarizer
+from modules.profile.service import profile_service
 
 # ============== FastAPI 应用初始化 ==============
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期管理
+    
+    - 启动时：建表并执行数据库迁移（init_db），创建共享的异步 LLM 客户端（带连接池与 keep-alive）
+    - 关闭时：取消未完成的会话摘要任务，等待数据库线程池中的写入完成，
+      落库历史写缓冲中的剩余消息，释放连接池
+    
+    所有 /chat 请求共用同一个客户端，等待模型响应时不阻塞事件循环，
+    同一个 worker 可以同时处理多路对话以及 /profile、/history 等请求。
+    """
+    profile_service.init_db()
+    history_service.init_db()
+    llm_client_manager.startup()
+    yield
+    await summarizer.shutdown()
+    shutdown_db_executor()
+    history_service.close()
+    await llm_client_manager.shutdown()
+
+
 # 创建 FastAPI 应用实例
 # 自动生成 API 文档：http://localhost:8000/docs (Swagger UI)
 app = FastAPI(
     title="教育专家 AI",
     description="面向家长的育儿咨询 AI 助手",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # 配置跨域资源共享（CORS）
@@ -49,14 +77,9 @@ app.add_middleware(
     allow_headers=["*"],  # 允许所有请求头
 )
 
-# 初始化 OpenAI 客户端
+# OpenAI 客户端由 llm_client_manager 统一管理（见 modules/chat/llm.py）
 # 兼容 OpenAI 接口格式的其他模型（Qwen、DeepSeek 等）
-# API Key 和 Base URL 从 .env 文件中读取
-client = OpenAI(
-    api_key=settings.OPENAI_API_KEY,  # API 密钥
-    base_url=settings.OPENAI_BASE_URL,  # API 基地址（支持自定义）
-    timeout=60.0,  # 请求超时时间（秒），防止长时间等待
-)
+# API Key、Base URL、连接池参数从 .env 文件中读取
 
 
 # ============== 数据模型定义 ==============
@@ -86,7 +109,7 @@ class ChatRequest(BaseModel):
     属性：
         message: 家长当前提出的问题（必填）
         history: 历史对话记录，用于多轮对话上下文（可选）
-                建议最多传递 10 条消息（5 轮对话），后端会自动截断
+                后端按 token 预算（CONTEXT_TOKEN_BUDGET）从新到旧保留，超出部分自动丢弃
         response_mode: 回答模式（可选，默认 "detailed"）
                       - "detailed": 详细模式，包含完整分析、心理学原理、话术、避坑提醒
                       - "concise": 简洁模式，200-300字核心建议
@@ -120,71 +143,10 @@ class ChatResponse(BaseModel):
     属性：
         reply: AI 生成的育儿建议内容
                如果检测到敏感词汇，会在末尾自动追加安全提醒
+        context_tokens: 本次请求发送给模型的上下文 token 数（估算值）
     """
     reply: str  # AI 回答内容
-
-
-# ============== 安全过滤 ==============
-
-def filter_unsafe_content(text: str) -> str:
-    """
-    后端安全过滤函数（双保险机制的第二层）
-    
-    功能说明：
-    1. 检查 AI 回答中是否包含敏感词汇（体罚、暴力相关）
-    2. 如果检测到，在原回答末尾追加安全提醒（不替换原文）
-    3. 此函数作为 System Prompt 的补充防线
-    
-    设计理念：
-    - System Prompt 已明确禁止 AI 给出体罚建议（第一层防护）
-    - AI 通常会正确遵守 Prompt，说明错误做法时也是为了教育
-    - 简单关键词拦截会误杀（如 AI 说"不应该打孩子"也会被检测）
-    - 因此采用"追加提醒"而非"完全拦截"策略
-    
-    策略演进：
-    - 初版：检测到关键词直接替换全文为警告
-    - 问题：AI 本身不会给不当建议，却被误杀
-    - 优化：保留 AI 专业回答，末尾追加安全提醒
-    
-    参数：
-        text: AI 生成的原始回答文本
-    
-    返回：
-        如果包含敏感词汇：原文 + 安全提醒
-        如果不包含：原文不变
-    
-    测试案例：
-        输入：家长问"孩子不听话，是不是该打他？"
-        AI 回答：详细的非暴力沟通建议（包含"打"字是为了说明错误做法）
-        本函数：检测到"打"，追加安全提醒，不删除专业建议
-    """
-    # 敏感关键词列表（体罚、暴力相关词汇）
-    # 这些词汇在育儿建议中应谨慎对待
-    dangerous_keywords = [
-        "打", "骂", "揍", "体罚", "关禁闭", "罚站", "罚跪",
-        "暴力", "殴打", "掌掴", "用力", "狠狠", "教训"
-    ]
-    
-    # 检查回答中是否包含任何敏感词汇
-    # 使用 any() 提高效率，发现一个即停止
-    contains_sensitive = any(keyword in text for keyword in dangerous_keywords)
-    
-    if contains_sensitive:
-        # 在原回答末尾追加安全提醒（不替换原内容）
-        safety_reminder = (
-            "\n\n---\n\n"
-            "⚠️ **安全提醒**：\n\n"
-            "我们坚持：任何形式的体罚或语言暴力都不应该被使用。"
-            "如果上述回答中涉及相关词汇，仅为说明错误做法，请勿模仿。\n\n"
-            "正确的教育方式应该是：\n"
-            "• 非暴力沟通\n"
-            "• 尊重孩子的人格和尊严\n"
-            "• 用温和而坚定的态度设立界限\n\n"
-            "如情况复杂，建议寻求专业心理咨询师帮助。"
-        )
-        return text + safety_reminder
-    
-    return text
+    context_tokens: int = 0  # 上下文 token 数（估算）
 
 
 # ============== API 接口 ==============
@@ -211,7 +173,8 @@ async def chat(request: ChatRequest):
     
     响应示例：
         {
-          "reply": "亲爱的家长，我能感受到...[详细育儿建议]"
+          "reply": "亲爱的家长，我能感受到...[详细育儿建议]",
+          "context_tokens": 712
         }
     
     错误处理：
@@ -219,8 +182,10 @@ async def chat(request: ChatRequest):
         - 所有异常都会被捕获并返回友好提示
     
     性能优化：
-        - 自动限制 history 长度（最多 10 条消息）
-        - 超时设置 60 秒
+        - 按 token 预算裁剪 history（从新到旧保留，并为输出预留空间）
+        - 超时设置 60 秒（LLM_TIMEOUT）
+        - 异步调用 LLM，等待期间不阻塞事件循环
+        - 无历史的问题命中回答缓存时直接返回，不调用 LLM
     
     参数：
         request: ChatRequest 对象（自动验证）
@@ -232,59 +197,21 @@ async def chat(request: ChatRequest):
         HTTPException: LLM 调用失败时抛出 500 错误
     """
     try:
-        # ========== 步骤 1：生成动态 System Prompt ==========
-        # 根据 response_mode（详细/简洁）和 child_age（年龄段）
-        # 动态生成最合适的 System Prompt
-        system_prompt = settings.get_system_prompt(
-            mode=request.response_mode,  # "detailed" 或 "concise"
-            child_age=request.child_age  # 可选，None 表示不指定年龄
-        )
-        
-        # ========== 步骤 2：构建完整的消息列表 ==========
-        # 消息列表结构：[System Prompt, 历史消息..., 当前用户消息]
-        # 这是 LLM API 的标准输入格式
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # 添加历史对话（自动限制长度）
-        # 原因：防止历史过长导致：
-        # 1. Token 数超限（大多数模型有 token 限制）
-        # 2. API 成本增加（token 越多费用越高）
-        # 3. 响应速度变慢（处理时间增加）
-        max_history_messages = settings.MAX_HISTORY_ROUNDS * 2  # 5轮 = 10条消息 (user + assistant)
-        
-        # 使用负索引切片获取最近的消息
-        # 如果 history 长度 <= max_history_messages，全部保留
-        # 如果 history 长度 > max_history_messages，只保留最后 N 条
-        recent_history = request.history[-max_history_messages:] if len(request.history) > max_history_messages else request.history
-        
-        # 将历史消息转换为 LLM API 所需的格式
-        for msg in recent_history:
-            messages.append({"role": msg.role, "content": msg.content})
-        
-        # 添加当前用户消息（最新的问题）
-        messages.append({"role": "user", "content": request.message})
-        
-        # ========== 步骤 3：调用 LLM API ==========
-        # 使用 OpenAI SDK 调用大模型（兼容 Qwen、DeepSeek 等）
-        response = client.chat.completions.create(
-            model=settings.MODEL_NAME,  # 模型名称（从 .env 读取）
-            messages=messages,  # 完整的对话历史
-            temperature=0.7,  # 创造性参数（0-1，0.7 较均衡）
-            max_tokens=800,  # 最大生成 token 数（控制回答长度）
-            timeout=60.0,  # 请求超时时间（秒）
+        # ========== 进程内对话流水线 ==========
+        # 1. 根据 response_mode（详细/简洁）和 child_age（年龄段）生成 System Prompt
+        # 2. 按 token 预算从新到旧裁剪历史，构建完整消息列表
+        # 3. 异步调用 LLM（await 期间事件循环可以继续处理其他请求）
+        # 4. 安全过滤（双保险机制的第二层），如有敏感词汇则追加安全提醒
+        # 详见 modules/chat/service.py
+        result = await chat_service.complete(
+            message=request.message,
+            history=[msg.model_dump() for msg in request.history or []],
+            response_mode=request.response_mode,
+            child_age=request.child_age,
         )
         
-        # ========== 步骤 4：提取回答并进行安全过滤 ==========
-        # 从 LLM 响应中提取文本内容
-        # choices[0] 表示第一个生成结果（通常只有一个）
-        reply = response.choices[0].message.content
-        
-        # 应用安全过滤（双保险机制的第二层）
-        # 检查是否包含敏感词汇，如有则追加安全提醒
-        reply = filter_unsafe_content(reply)
-        
         # 返回最终结果
-        return ChatResponse(reply=reply)
+        return ChatResponse(reply=result.reply, context_tokens=result.context_tokens)
     
     except Exception as e:
         # 异常处理：捕获所有可能的错误
@@ -297,17 +224,89 @@ async def chat(request: ChatRequest):
         raise HTTPException(status_code=500, detail=f"AI 服务异常: {str(e)}")
 
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    流式 API 接口：育儿咨询对话（Server-Sent Events）
+    
+    功能：
+    与 /chat 使用相同的请求模型与 System Prompt 生成逻辑，
+    但模型每生成一段文本就立即推送给客户端，
+    家长无需等待整段回答生成完毕即可开始阅读（首字延迟 ≈ 一次网络往返）。
+    
+    响应格式（text/event-stream）：
+        event: delta
+        data: {"content": "亲爱的家长，"}
+        
+        event: delta
+        data: {"content": "我能感受到..."}
+        
+        event: done
+        data: {"reply": "完整回答（含安全提醒）", "safety_reminder": "..." 或 null, "context_tokens": 712}
+    
+    事件说明：
+        - delta：模型增量文本，客户端按顺序拼接展示
+        - done：最终事件，reply 为经过安全过滤的完整回答，客户端可用其替换拼接结果
+        - error：生成过程中出错（响应头已发送，无法再返回 500），detail 为错误信息
+    
+    参数：
+        request: ChatRequest 对象（自动验证）
+    
+    返回：
+        StreamingResponse（media_type="text/event-stream"）
+    """
+    stream = chat_service.stream(
+        message=request.message,
+        history=[msg.model_dump() for msg in request.history or []],
+        response_mode=request.response_mode,
+        child_age=request.child_age,
+    )
+    
+    async def event_generator():
+        try:
+            async for content in stream:
+                yield sse_event("delta", {"content": content})
+        except Exception as e:
+            # 响应头已发送，只能通过事件通知客户端出错
+            yield sse_event("error", {"detail": f"AI 服务异常: {str(e)}"})
+            return
+        
+        # 生成结束后对完整回答做一次安全检查（与 /chat 策略一致）
+        yield sse_event("done", {
+            "reply": stream.final_reply,
+            "safety_reminder": stream.safety_reminder,
+            "context_tokens": stream.context_tokens,
+        })
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # 关闭 Nginx 等反向代理的缓冲，保证实时推送
+        },
+    )
+
+
 # ============== Phase 3 新增模块注册 ==============
-# 导入并注册新模块（档案管理、对话历史管理）
+# 导入并注册新模块（档案管理、对话历史管理、聊天适配器、管理接口、运行指标、请求追踪）
 # 这些模块独立于主代码，保持 main.py 简洁
 from modules.profile import register_routes as register_profile
 from modules.history import register_routes as register_history
 from modules.adapter import register_routes as register_adapter
+from modules.admin import register_routes as register_admin
+from modules.metrics import register_routes as register_metrics
+from modules.tracing import register_middleware as register_tracing
 
 # 注册模块路由
 register_profile(app)
 register_history(app)
 register_adapter(app)
+register_admin(app)
+register_metrics(app)
+
+# 请求追踪中间件最后注册：位于最外层，请求总耗时包含其他中间件的耗时
+register_tracing(app)
 
 # ============== 服务启动入口 ==============
 
@@ -324,6 +323,7 @@ if __name__ == "__main__":
     访问方式：
     - API 文档：http://localhost:8000/docs
     - API 接口：http://localhost:8000/chat
+    - 流式接口：http://localhost:8000/chat/stream
     
     生产环境建议：
     - 关闭 reload（提高性能）
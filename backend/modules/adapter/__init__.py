@@ -4,7 +4,7 @@
 作用：对外提供聚合接口 /chat_with_context
 - 自动读取档案年龄
 - 自动读取并裁剪历史
-- 转调既有 /chat 接口（不改动 main.py 逻辑）
+- 进程内调用对话流水线（与 /chat 共用 modules/chat/service.py）
 - 自动回写历史（user/assistant 两条）
 """
 
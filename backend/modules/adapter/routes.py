@@ -2,33 +2,34 @@
 聊天适配器模块 - API 路由
 
 模块定位：
-- 充当“编排层/门面”，为前端提供一站式接口 `POST /chat_with_context`：
-    - 自动获取孩子档案（年龄）
-    - 自动获取会话历史（最近 N 条）
-    - 将用户消息先写入历史以保证对账
-    - 转调既有 `/chat`（保留原业务与安全策略）
-    - 回写 AI 回复到历史
+- 充当“编排层/门面”，为前端提供一站式接口 `POST /chat_with_context`
+  及其流式版本 `POST /chat_with_context/stream`（SSE）：
+    - 一次读取取得会话、摘要、最近 N 条历史与孩子年龄（`load_turn_context`）
+    - 进程内调用对话流水线 `chat_service`（与 `/chat` 共用同一套 Prompt、裁剪与安全策略）
+    - 在一个事务中回写本轮的问与答（`record_turn`）
 
 设计原则：
-- 不侵入主应用逻辑：通过 `httpx` 调用已有 `/chat`，避免复制核心业务。
+- 不复制核心业务：直接调用 `modules.chat.service.chat_service`，与 `/chat` 逻辑完全一致，
+  且无 HTTP 回环（不依赖端口、不受多 worker 影响）。
 - 会话与用户通过请求头传递：`X-User-ID` 必填，`X-Session-ID` 可选（缺省则自动创建/复用）。
+- 数据库读写一律 await 服务的 *_async 方法（在数据库线程池中执行），不阻塞事件循环。
+- 在途请求数与端到端耗时记入 modules/metrics（各阶段耗时由各服务自行记录）。
+- 数据库调用记为追踪 span（adapter.load_context / adapter.record_turn，见 modules/tracing），
+  与服务内的 history.* span 之差即在数据库线程池中排队的时间。
 """
-from fastapi import APIRouter, HTTPException, Header
-from pydantic import BaseModel, Field
-from typing import Optional, Literal
-import httpx
-
-from modules.profile.service import profile_service
-from modules.history.service import history_service
-from modules.history.schemas import AddMessageRequest
 from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
+from datetime import datetime
+from time import perf_counter
 from typing import Optional, Literal
-import httpx
 
-from modules.profile.service import profile_service
+from modules.chat.service import chat_service
+from modules.chat.sse import sse_event
 from modules.history.service import history_service
-from modules.history.schemas import AddMessageRequest
+from modules.history.summarizer import summarizer
+from modules.metrics.service import chat_metrics
+from modules.tracing.service import span
 
 
 class ChatAdapterRequest(BaseModel):
@@ -42,6 +43,7 @@ class ChatAdapterRequest(BaseModel):
 class ChatAdapterResponse(BaseModel):
     session_id: str
     reply: str
+    context_tokens: int = Field(0, description="本次请求发送给模型的上下文 token 数（估算）")
 
 
 def register_routes(app):
@@ -55,67 +57,124 @@ def register_routes(app):
     ):
         """
         编排流程说明：
-        1) 会话准备：复用传入的 `X-Session-ID`；若缺失则获取当前会话或创建新会话。
-        2) 上下文收集：读取最近 `history_limit` 条消息，并获取档案年龄（若存在）。
-        3) 先写入用户消息到历史：保证请求与历史一致性，便于后续审计/回放。
-        4) 转调 `/chat`：保留既有的安全过滤与生成策略，不在适配层重复实现。
-        5) 回写 AI 回复到历史：形成完整的双向消息记录。
-        6) 返回 `session_id` 与 `reply`：供前端缓存与展示。
+        1) 上下文收集（一次读取）：复用传入的 `X-Session-ID`，缺失时获取当前会话或创建新会话；
+           读取会话摘要、摘要之后最近 `history_limit` 条消息与档案年龄（若存在）。
+        2) 调用对话流水线 `chat_service`：与 `/chat` 共用生成与安全过滤策略，不在适配层重复实现。
+        3) 回写本轮对话（一个事务）：用户问题 + AI 回复 + 会话更新时间；生成失败时仅记录问题，便于审计/回放。
+        4) 后台调度会话摘要：较早的消息折叠为摘要，长对话的上下文长度保持平稳。
+        5) 返回 `session_id` 与 `reply`：供前端缓存与展示。
 
         头部约定：
         - X-User-ID：必填，用于区分用户并路由到其档案与历史。
         - X-Session-ID：可选，用于定位具体会话；缺省时自动创建/复用。
         """
-        # 1) 准备会话
-        if session_id is None:
-            session_id = history_service.get_current_session(user_id)
-            if session_id is None:
-                session_id = history_service.create_session(user_id)
-
-        # 2) 取历史 & 档案年龄
-        history = history_service.get_messages_for_api(
-            user_id, session_id, limit=payload.history_limit
-        )
-        profile = profile_service.get_profile(user_id)
-        age = profile.age if profile else None
-
-        # 3) 回写用户消息到历史（先写，保证对账与一致性）
-        history_service.add_message(
-            user_id,
-            session_id,
-            message_data=AddMessageRequest(role="user", content=payload.message),
-        )
-
-        # 4) 调用现有 /chat（复用既有逻辑与安全策略）
-        try:
-            # 直接转调本机已有的 /chat，避免复制业务逻辑与安全策略
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                resp = await client.post(
-                    "http://127.0.0.1:8000/chat",
-                    json={
-                        "message": payload.message,
-                        "response_mode": payload.response_mode,
-                        "child_age": age,
-                        "history": history,
-                    },
+        with chat_metrics.in_flight.track(), chat_metrics.request.time():
+            # 1) 会话准备 + 取摘要/历史与年龄（一次读取）
+            with span("adapter.load_context"):
+                turn = await history_service.load_turn_context_async(user_id, session_id, payload.history_limit)
+            session_id = turn.session_id
+            asked_at = datetime.utcnow()
+
+            # 2) 进程内调用对话流水线（复用 /chat 的 Prompt、历史裁剪与安全策略）
+            try:
+                result = await chat_service.complete(
+                    message=payload.message,
+                    history=turn.history,
+                    response_mode=payload.response_mode,
+                    child_age=turn.age,
+                    summary=turn.summary,
                 )
-        except httpx.RequestError as e:
-            # 转调失败（网络/服务不可用）→ 返回 503
-            raise HTTPException(status_code=503, detail=f"聊天服务不可用: {e}")
-
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.text)
+            except Exception as e:
+                # LLM 调用失败（网络、密钥、超时等）→ 仅记录用户问题，与 /chat 一致返回 500
+                with span("adapter.record_turn"):
+                    await history_service.record_turn_async(
+                        user_id, session_id, payload.message, None, asked_at=asked_at
+                    )
+                raise HTTPException(status_code=500, detail=f"AI 服务异常: {e}")
+            reply = result.reply
+
+            # 3) 问与答在一个事务中回写（形成完整的双向记录）
+            with span("adapter.record_turn"):
+                await history_service.record_turn_async(user_id, session_id, payload.message, reply, asked_at=asked_at)
+            # 4) 后台折叠较早的消息为摘要（不阻塞本次响应）
+            summarizer.schedule(session_id)
+
+            return ChatAdapterResponse(
+                session_id=session_id, reply=reply, context_tokens=result.context_tokens
+            )
+
+    @router.post("/stream")
+    async def chat_with_context_stream(
+        payload: ChatAdapterRequest,
+        user_id: str = Header(..., alias="X-User-ID"),
+        session_id: Optional[str] = Header(None, alias="X-Session-ID"),
+    ):
+        """
+        流式版本（Server-Sent Events），编排步骤与 `/chat_with_context` 相同。
 
-        data = resp.json()
-        reply = data.get("reply", "")
+        事件顺序：
+        - session：首个事件，携带 `session_id`，客户端可在生成结束前先行保存
+        - delta：模型增量文本 {"content": "..."}
+        - done：{"session_id", "reply"（含安全提醒）, "safety_reminder", "context_tokens"}
+        - error：生成出错 {"detail": "..."}
 
-        # 5) 回写 AI 回复（形成完整的双向记录）
-        history_service.add_message(
-            user_id,
-            session_id,
-            message_data=AddMessageRequest(role="assistant", content=reply),
+        历史回写（用户问题与回答在同一事务中保存）：
+        - 流正常结束：保存完整回答（含安全提醒）
+        - 客户端断开或生成出错：保存已生成的部分内容，并标记 `truncated=True`
+        """
+        started = perf_counter()
+        with chat_metrics.in_flight.track(), span("adapter.load_context"):
+            turn = await history_service.load_turn_context_async(user_id, session_id, payload.history_limit)
+        session_id = turn.session_id
+        asked_at = datetime.utcnow()
+        stream = chat_service.stream(
+            message=payload.message,
+            history=turn.history,
+            response_mode=payload.response_mode,
+            child_age=turn.age,
+            summary=turn.summary,
         )
 
-        return ChatAdapterResponse(session_id=session_id, reply=reply)
+        async def event_generator():
+            # 在途计数从事件流开始到结束（含客户端断开），耗时从收到请求算起
+            chat_metrics.in_flight.inc()
+            try:
+                yield sse_event("session", {"session_id": session_id})
+                async for content in stream:
+                    yield sse_event("delta", {"content": content})
+            except Exception as e:
+                # 响应头已发送，只能通过事件通知客户端出错
+                yield sse_event("error", {"detail": f"AI 服务异常: {e}"})
+                return
+            finally:
+                # 无论正常结束、出错还是客户端断开（生成器被关闭）都会执行。
+                # 指标先行记录：客户端断开时下面的 await 会抛出 CancelledError。
+                chat_metrics.in_flight.dec()
+                chat_metrics.request_stream.observe(perf_counter() - started)
+                # 问与答在一个事务中回写，不完整的回答标记为 truncated。
+                if stream.finished:
+                    reply, truncated = stream.final_reply, False
+                else:
+                    reply, truncated = stream.reply, True
+                # 客户端断开时任务已被取消，await 会立即抛出 CancelledError，
+                # 但写入在调用时已提交到数据库线程池，仍会完成（仅跳过本轮的摘要调度）。
+                with span("adapter.record_turn"):
+                    await history_service.record_turn_async(
+                        user_id, session_id, payload.message, reply, truncated=truncated, asked_at=asked_at
+                    )
+                summarizer.schedule(session_id)
+
+            yield sse_event("done", {
+                "session_id": session_id,
+                "reply": stream.final_reply,
+                "safety_reminder": stream.safety_reminder,
+                "context_tokens": stream.context_tokens,
+            })
+
+        return StreamingResponse(
+            event_generator(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     app.include_router(router)
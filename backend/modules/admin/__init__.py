@@ -0,0 +1,8 @@
+"""
+管理接口模块
+
+功能：运维相关接口（缓存与请求合并统计、缓存清理等），需通过 X-Admin-Token 鉴权
+"""
+from .routes import register_routes, require_admin
+
+__all__ = ["register_routes", "require_admin"]
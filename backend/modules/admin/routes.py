@@ -0,0 +1,136 @@
+"""
+管理接口模块 - API 路由
+
+C++ 程序员理解：
+- require_admin 类似一个前置检查（guard），挂在每个管理接口上
+- ADMIN_TOKEN 未配置时，管理接口整体关闭，避免误暴露
+- /admin/profiler：按比例对请求开启采样分析器，导出火焰图可用的 folded stacks（见 modules/tracing/profiler.py）
+"""
+import hmac
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+
+from config import settings
+from modules.chat.cache import response_cache
+from modules.chat.singleflight import singleflight
+from modules.profile.service import profile_service
+from modules.tracing.profiler import profiler
+
+
+class ProfilerConfig(BaseModel):
+    sample_rate: float = Field(..., ge=0, le=1, description="被采样请求的比例（0 关闭，1 全部）")
+    interval_ms: Optional[float] = Field(None, ge=1, le=1000, description="调用栈采样间隔（毫秒）")
+
+
+def require_admin(admin_token: Optional[str] = Header(None, alias="X-Admin-Token")):
+    """
+    管理接口鉴权依赖
+
+    - 未配置 ADMIN_TOKEN：403（管理接口未启用）
+    - 口令不匹配：403
+    """
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="管理接口未启用")
+    # 常量时间比较，避免通过响应耗时猜测口令；
+    # 按字节比较：str 含非 ASCII 字符时 compare_digest 会抛 TypeError（畸形请求头变成 500）
+    if not admin_token or not hmac.compare_digest(
+        admin_token.encode("utf-8"), settings.ADMIN_TOKEN.encode("utf-8")
+    ):
+        raise HTTPException(status_code=403, detail="管理口令无效")
+
+
+def register_routes(app):
+    """
+    注册管理接口路由到主应用
+
+    参数：
+        app: FastAPI 应用实例
+    """
+    router = APIRouter(
+        prefix="/admin",
+        tags=["管理接口"],
+        dependencies=[Depends(require_admin)],
+    )
+
+    @router.get("/cache")
+    async def get_cache_stats():
+        """
+        查询缓存统计
+
+        返回：
+            {
+                "response_cache": {"size": 12, "hits": 30, "misses": 12, "hit_rate": 0.7143, ...},
+                "singleflight": {"in_flight_calls": 1, "leaders": 42, "coalesced": 7, ...},
+                "profile_cache": {"size": 80, "hits": 950, "misses": 80, "hit_rate": 0.9223, ...}
+            }
+        """
+        return {
+            "response_cache": response_cache.stats(),
+            "singleflight": singleflight.stats(),
+            "profile_cache": profile_service.cache_stats(),
+        }
+
+    @router.delete("/cache")
+    async def flush_cache():
+        """
+        清空回答缓存（如调整 System Prompt 后需要让旧回答失效）与档案缓存（如直接修改了数据库中的档案）
+
+        返回：
+            {"message": "缓存已清空", "flushed": 12, "profile_flushed": 80}
+        """
+        flushed = response_cache.clear()
+        profile_flushed = profile_service.clear_cache()
+        return {"message": "缓存已清空", "flushed": flushed, "profile_flushed": profile_flushed}
+
+    @router.get("/profiler")
+    async def get_profiler_stats():
+        """
+        查询采样分析器状态
+
+        返回：
+            {"sample_rate": 0.05, "interval_ms": 5.0, "sampled_requests": 37, "active_requests": 0,
+             "samples": 912, "distinct_stacks": 140}
+        """
+        return profiler.stats()
+
+    @router.put("/profiler")
+    async def configure_profiler(config: ProfilerConfig):
+        """
+        设置采样比例（如 0.05 表示约 5% 的请求在处理期间采集调用栈）；sample_rate=0 停止采样，已采集的数据保留
+
+        返回：与 GET /admin/profiler 相同
+        """
+        interval = config.interval_ms / 1000 if config.interval_ms is not None else None
+        profiler.configure(config.sample_rate, interval)
+        return profiler.stats()
+
+    @router.get("/profiler/folded", response_class=PlainTextResponse)
+    async def dump_profile(reset: bool = False):
+        """
+        导出 folded stacks（每行 “线程;外层函数;...;内层函数 次数”），可直接生成火焰图：
+            curl -H "X-Admin-Token: ..." http://host/admin/profiler/folded > app.folded
+            flamegraph.pl app.folded > app.svg   # 或拖入 https://www.speedscope.app
+
+        参数：
+            reset: 导出后清空已采集的数据，便于按时间段对比
+        """
+        folded = profiler.folded()
+        if reset:
+            profiler.reset()
+        return PlainTextResponse(folded)
+
+    @router.delete("/profiler")
+    async def reset_profiler():
+        """
+        停止采样并清空已采集的数据
+
+        返回：
+            {"message": "采样分析器已重置"}
+        """
+        profiler.configure(0.0)
+        profiler.reset()
+        return {"message": "采样分析器已重置"}
+
+    app.include_router(router)
@@ -0,0 +1,8 @@
+"""
+聊天核心模块
+
+功能：LLM 客户端管理、对话流水线、安全过滤等 /chat 相关的公共能力，供 main.py 与适配器复用
+"""
+from .llm import llm_client_manager
+
+__all__ = ["llm_client_manager"]
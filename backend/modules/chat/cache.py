@@ -0,0 +1,64 @@
+"""
+聊天核心模块 - 回答缓存
+
+C++ 视角速览：
+- ResponseCache 是 LLM 调用前的一层精确匹配缓存（底层为 modules/cache.py 的 LRU + TTL）。
+- 只缓存“无历史”的首个问题：有历史时回答依赖上下文，不可复用。
+- 缓存的是模型原始回答（不含安全提醒），命中后仍走同样的安全过滤，保证两条路径输出一致。
+"""
+from typing import List, Optional, Tuple
+import re
+import unicodedata
+
+from config import settings
+from modules.cache import TTLCache
+
+# 规范化时去掉的首尾标点与空白（“怎么办？”与“怎么办”视为同一问题）
+_TRIM_CHARS = " \t\r\n?？!！。.,，~～…"
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_message(text: str) -> str:
+    # NFKC：全角/半角统一；合并连续空白；忽略大小写与首尾标点
+    text = unicodedata.normalize("NFKC", text)
+    text = _WHITESPACE.sub(" ", text).strip(_TRIM_CHARS)
+    return text.lower()
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int, ttl: float, enabled: bool = True):
+        self.enabled = enabled
+        self._cache = TTLCache(max_entries=max_entries, ttl=ttl)
+
+    def make_key(
+        self, message: str, response_mode: Optional[str], child_age: Optional[int]
+    ) -> Tuple[str, str, str]:
+        # 模式与年龄段的划分与 get_system_prompt 保持一致
+        return (
+            normalize_message(message),
+            settings.get_mode(response_mode),
+            settings.get_age_band(child_age),
+        )
+
+    def is_cacheable(self, history: Optional[List[dict]]) -> bool:
+        return self.enabled and not history
+
+    def get(self, key: Tuple[str, str, str]) -> Optional[str]:
+        return self._cache.get(key)
+
+    def set(self, key: Tuple[str, str, str], reply: str) -> None:
+        if reply:
+            self._cache.set(key, reply)
+
+    def clear(self) -> int:
+        return self._cache.clear()
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, **self._cache.stats()}
+
+
+response_cache = ResponseCache(
+    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=settings.RESPONSE_CACHE_TTL,
+    enabled=settings.RESPONSE_CACHE_ENABLED,
+)
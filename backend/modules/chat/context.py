@@ -0,0 +1,80 @@
+"""
+聊天核心模块 - 上下文窗口构建（按 token 预算裁剪历史）
+
+C++ 视角速览：
+- 按“token 预算”而不是“消息条数”裁剪历史：10 条 2000 字的详细回答与 10 条短消息开销相差数十倍。
+- ContextBuilder.build 从最新到最旧依次放入历史消息，直到预算用完；
+  System Prompt、会话摘要与当前问题总是保留，并为模型输出（max_tokens）预留空间。
+- estimate_tokens 为近似估算（无需加载分词器）：中文等 CJK 字符约 1 token/字，
+  其他字符约 4 字符/token，另加每条消息的格式开销。
+"""
+from typing import List, NamedTuple, Optional
+
+# 每条消息的固定格式开销（role 标记、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 会话摘要以一条 system 消息的形式放在 System Prompt 之后（不破坏其稳定前缀）
+SUMMARY_HEADER = "【此前对话摘要】\n"
+
+
+def _is_cjk(ch: str) -> bool:
+    code = ord(ch)
+    return (
+        0x4E00 <= code <= 0x9FFF  # CJK 统一汉字
+        or 0x3400 <= code <= 0x4DBF  # 扩展 A
+        or 0x3000 <= code <= 0x303F  # CJK 标点
+        or 0xFF00 <= code <= 0xFFEF  # 全角字符
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def estimate_message_tokens(message: dict) -> int:
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+class BuiltContext(NamedTuple):
+    messages: List[dict]  # 发送给 LLM 的完整消息列表
+    prompt_tokens: int  # 估算的输入 token 数
+    history_used: int  # 实际放入的历史消息条数
+
+
+class ContextBuilder:
+    def __init__(self, token_budget: int, reserved_output_tokens: int):
+        self.token_budget = token_budget
+        self.reserved_output_tokens = reserved_output_tokens
+
+    def build(
+        self,
+        system_prompt: str,
+        history: Optional[List[dict]],
+        message: str,
+        summary: Optional[str] = None,
+    ) -> BuiltContext:
+        """
+        构建消息列表：
+        [System Prompt, 会话摘要（如有）, 历史消息（按预算从新到旧选取）..., 当前用户消息]
+
+        预算 = token_budget - reserved_output_tokens；历史中放不下的最旧消息被丢弃。
+        """
+        head = [{"role": "system", "content": system_prompt}]
+        if summary:
+            head.append({"role": "system", "content": SUMMARY_HEADER + summary})
+        current = {"role": "user", "content": message}
+        used = sum(estimate_message_tokens(m) for m in head) + estimate_message_tokens(current)
+        available = self.token_budget - self.reserved_output_tokens
+
+        selected: List[dict] = []
+        for msg in reversed(history or []):
+            cost = estimate_message_tokens(msg)
+            if used + cost > available:
+                break
+            selected.append({"role": msg["role"], "content": msg["content"]})
+            used += cost
+        selected.reverse()
+
+        return BuiltContext([*head, *selected, current], used, len(selected))
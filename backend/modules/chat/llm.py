@@ -0,0 +1,54 @@
+"""
+聊天核心模块 - LLM 客户端管理
+
+C++ 视角速览：
+- LLMClientManager 相当于进程级单例，持有一个带连接池的 AsyncOpenAI 客户端。
+- startup/shutdown 由 FastAPI lifespan 调用（类似构造/析构），避免每个请求重复建连。
+- 使用异步客户端：等待 LLM 响应期间不阻塞事件循环，/profile、/history 等请求可并发处理。
+"""
+from typing import Optional
+import httpx
+from openai import AsyncOpenAI
+
+from config import settings
+
+
+class LLMClientManager:
+    def __init__(self):
+        self._client: Optional[AsyncOpenAI] = None
+
+    def _build(self) -> AsyncOpenAI:
+        # 连接池：多个并发 LLM 请求复用同一组 keep-alive 连接，省去重复的 TCP/TLS 握手。
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=settings.LLM_TIMEOUT,
+        )
+        return AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=settings.OPENAI_BASE_URL,
+            timeout=settings.LLM_TIMEOUT,
+            http_client=http_client,
+        )
+
+    def startup(self) -> AsyncOpenAI:
+        # 幂等：已创建（例如测试中提前访问过）则直接复用。
+        if self._client is None:
+            self._client = self._build()
+        return self._client
+
+    async def shutdown(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        # 未经 lifespan 启动（如 TestClient 未进入上下文）时按需懒创建。
+        return self.startup()
+
+
+llm_client_manager = LLMClientManager()
@@ -0,0 +1,209 @@
+"""
+聊天核心模块 - 安全过滤
+
+C++ 视角速览：
+- /chat、/chat/stream、/chat_with_context 共用同一套关键词与提醒文本。
+- SafetyMatcher 是由关键词表编译出的 Aho-Corasick 自动机（类似编译好的 DFA），进程内只构建一次；
+  扫描一遍文本即可找出所有关键词，耗时与文本长度成正比，与关键词数量无关。
+- SafetyScanner 是自动机上的“游标”：跨流式 chunk 保持状态，关键词被拆在两个 chunk 之间也能识别。
+"""
+from collections import deque
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+
+# 敏感关键词列表（体罚、暴力相关词汇）
+# 这些词汇在育儿建议中应谨慎对待
+DANGEROUS_KEYWORDS = [
+    "打", "骂", "揍", "体罚", "关禁闭", "罚站", "罚跪",
+    "暴力", "殴打", "掌掴", "用力", "狠狠", "教训"
+]
+
+# 安全提醒文本（检测到敏感词汇时追加到回答末尾）
+SAFETY_REMINDER = (
+    "\n\n---\n\n"
+    "⚠️ **安全提醒**：\n\n"
+    "我们坚持：任何形式的体罚或语言暴力都不应该被使用。"
+    "如果上述回答中涉及相关词汇，仅为说明错误做法，请勿模仿。\n\n"
+    "正确的教育方式应该是：\n"
+    "• 非暴力沟通\n"
+    "• 尊重孩子的人格和尊严\n"
+    "• 用温和而坚定的态度设立界限\n\n"
+    "如情况复杂，建议寻求专业心理咨询师帮助。"
+)
+
+
+class SafetyMatch(NamedTuple):
+    """一次命中：关键词及其在全文中的位置 [start, end)"""
+    term: str
+    start: int
+    end: int
+
+
+class SafetyMatcher:
+    """
+    多模式匹配自动机（Aho-Corasick）
+
+    构建：
+    - goto：Trie 转移表，每个节点一个 dict（字符 → 子节点编号）
+    - fail：失配指针，指向“当前匹配串的最长真后缀”对应的节点
+    - output：到达该节点时命中的关键词（已合并失配链上的输出）
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords: List[str] = [k for k in dict.fromkeys(keywords) if k]
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[str]] = [[]]
+
+        for keyword in self.keywords:
+            node = 0
+            for ch in keyword:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                node = nxt
+            self._output[node].append(keyword)
+
+        # BFS 计算失配指针：父节点的失配链上第一个拥有相同转移的节点
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def step(self, state: int, ch: str) -> int:
+        # 沿失配链回退直到存在 ch 的转移（根节点兜底）
+        goto = self._goto
+        while state and ch not in goto[state]:
+            state = self._fail[state]
+        return goto[state].get(ch, 0)
+
+    def scanner(self) -> "SafetyScanner":
+        return SafetyScanner(self)
+
+    def find_all(self, text: str) -> List[SafetyMatch]:
+        scanner = self.scanner()
+        scanner.feed(text)
+        return scanner.matches
+
+    def contains(self, text: str) -> bool:
+        # 命中即停止，适合只需判断“是否包含”的场景
+        state = 0
+        for ch in text:
+            state = self.step(state, ch)
+            if self._output[state]:
+                return True
+        return False
+
+
+class SafetyScanner:
+    """
+    增量扫描器：逐个 chunk 喂入文本，跨 chunk 边界保持自动机状态
+
+    用法：
+        scanner = safety_matcher.scanner()
+        for chunk in chunks:
+            new_matches = scanner.feed(chunk)
+        scanner.matched  # 是否需要追加安全提醒
+    """
+
+    def __init__(self, matcher: SafetyMatcher):
+        self._matcher = matcher
+        self._state = 0
+        self._offset = 0  # 已扫描字符数（用于计算全文位置）
+        self.matches: List[SafetyMatch] = []
+
+    def feed(self, chunk: str) -> List[SafetyMatch]:
+        """扫描一个 chunk，返回本次新增的命中（位置为全文偏移）"""
+        matcher = self._matcher
+        output = matcher._output
+        state = self._state
+        found = []
+        for i, ch in enumerate(chunk, start=self._offset + 1):
+            state = matcher.step(state, ch)
+            for term in output[state]:
+                found.append(SafetyMatch(term, i - len(term), i))
+        self._state = state
+        self._offset += len(chunk)
+        self.matches.extend(found)
+        return found
+
+    @property
+    def matched(self) -> bool:
+        return bool(self.matches)
+
+    @property
+    def terms(self) -> List[str]:
+        # 命中的关键词（去重，保持首次出现顺序）
+        return list(dict.fromkeys(m.term for m in self.matches))
+
+
+# 进程启动时编译一次，所有请求共用（自动机只读，可安全并发使用）
+safety_matcher = SafetyMatcher(DANGEROUS_KEYWORDS)
+
+
+def get_safety_reminder(text: str) -> Optional[str]:
+    """
+    判断回答是否需要追加安全提醒
+    
+    参数：
+        text: AI 生成的原始回答文本
+    
+    返回：
+        包含敏感词汇时返回 SAFETY_REMINDER，否则返回 None
+    
+    流式接口在最终事件中单独下发该提醒，非流式接口通过 filter_unsafe_content 追加。
+    """
+    # 一次线性扫描检查所有敏感词汇，发现一个即停止
+    if safety_matcher.contains(text):
+        return SAFETY_REMINDER
+    return None
+
+
+def filter_unsafe_content(text: str) -> str:
+    """
+    后端安全过滤函数（双保险机制的第二层）
+    
+    功能说明：
+    1. 检查 AI 回答中是否包含敏感词汇（体罚、暴力相关）
+    2. 如果检测到，在原回答末尾追加安全提醒（不替换原文）
+    3. 此函数作为 System Prompt 的补充防线
+    
+    设计理念：
+    - System Prompt 已明确禁止 AI 给出体罚建议（第一层防护）
+    - AI 通常会正确遵守 Prompt，说明错误做法时也是为了教育
+    - 简单关键词拦截会误杀（如 AI 说"不应该打孩子"也会被检测）
+    - 因此采用"追加提醒"而非"完全拦截"策略
+    
+    策略演进：
+    - 初版：检测到关键词直接替换全文为警告
+    - 问题：AI 本身不会给不当建议，却被误杀
+    - 优化：保留 AI 专业回答，末尾追加安全提醒
+    
+    参数：
+        text: AI 生成的原始回答文本
+    
+    返回：
+        如果包含敏感词汇：原文 + 安全提醒
+        如果不包含：原文不变
+    
+    测试案例：
+        输入：家长问"孩子不听话，是不是该打他？"
+        AI 回答：详细的非暴力沟通建议（包含"打"字是为了说明错误做法）
+        本函数：检测到"打"，追加安全提醒，不删除专业建议
+    """
+    safety_reminder = get_safety_reminder(text)
+    if safety_reminder:
+        # 在原回答末尾追加安全提醒（不替换原内容）
+        return text + safety_reminder
+    
+    return text
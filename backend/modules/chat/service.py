@@ -0,0 +1,277 @@
+"""
+聊天核心模块 - 对话流水线（进程内调用）
+
+C++ 视角速览：
+- ChatService 封装一次对话的完整流水线：构建 Prompt → 按 token 预算裁剪历史 → 调用 LLM → 安全过滤。
+- /chat、/chat/stream 与适配器 /chat_with_context 都直接调用它（普通函数调用），
+  不再经过 HTTP 回环（省去建连、JSON 编解码与第二次 ASGI 路由，也不依赖端口与 worker 数）。
+- ChatStream 类似“输入迭代器 + 结果缓冲”：逐段产出增量文本，结束后可读取完整回答。
+- 无历史的问题先查 response_cache，命中则跳过 LLM 调用（见 modules/chat/cache.py）。
+- 未命中缓存时经 singleflight 合并：相同（问题、模式、年龄段、历史摘要）的并发请求只调用一次上游。
+- 各阶段耗时（prompt_build / upstream_ttft / generation / safety_filter）、token 数与上游错误
+  记入 modules/metrics；上游指标只由真正调用上游的一方记录（被合并的请求不重复计数）。
+- 同一组计时也作为追踪 span（chat.build_context / chat.generate / chat.upstream / chat.safety_filter，
+  见 modules/tracing）：被合并的请求只有 chat.generate（等待共享结果），没有 chat.upstream。
+"""
+from functools import partial
+from time import perf_counter
+from typing import AsyncIterator, List, NamedTuple, Optional
+
+from config import settings
+from modules.metrics.service import chat_metrics
+from modules.tracing.service import record_duration, record_span, span
+from .cache import response_cache
+from .context import BuiltContext, ContextBuilder, estimate_tokens
+from .llm import llm_client_manager
+from .singleflight import history_digest, singleflight
+from .safety import SAFETY_REMINDER, SafetyMatch, filter_unsafe_content, safety_matcher
+
+
+class ChatStream:
+    """
+    一次流式生成的结果
+
+    - 异步迭代得到模型增量文本（async for delta in stream）
+    - 迭代结束后 finished=True，可读取 reply / safety_reminder / final_reply
+    - 客户端中途断开时 finished 保持 False，reply 为已生成的部分
+    - 每个增量到达时即送入安全扫描器（一次线性扫描，可识别跨 chunk 的关键词），
+      生成结束时无需再对全文做二次检查
+    """
+
+    def __init__(self, chunks: AsyncIterator[str], context_tokens: int = 0, cached: bool = False):
+        self._chunks = chunks
+        self._parts: List[str] = []
+        self._scanner = safety_matcher.scanner()
+        self.context_tokens = context_tokens  # 本次请求的上下文 token 数（估算）
+        self.cached = cached  # 是否来自回答缓存
+        self.finished = False
+        self._safety_seconds = 0.0  # 各增量安全扫描耗时之和
+
+    async def __aiter__(self):
+        async for content in self._chunks:
+            self._parts.append(content)
+            start = perf_counter()
+            self._scanner.feed(content)
+            self._safety_seconds += perf_counter() - start
+            yield content
+        self.finished = True
+        chat_metrics.safety_filter.observe(self._safety_seconds)
+        # 追踪中记为一段只有累计时长的 span（各增量扫描穿插在生成过程中，没有单一的开始时刻）
+        record_duration("chat.safety_filter", self._safety_seconds)
+
+    @property
+    def reply(self) -> str:
+        # 模型原始输出（未追加安全提醒）
+        return "".join(self._parts)
+
+    @property
+    def safety_matches(self) -> List[SafetyMatch]:
+        # 已命中的敏感词及其位置
+        return self._scanner.matches
+
+    @property
+    def safety_reminder(self) -> Optional[str]:
+        return SAFETY_REMINDER if self._scanner.matched else None
+
+    @property
+    def final_reply(self) -> str:
+        # 与非流式接口一致：原文 + 安全提醒（如有）
+        return self.reply + (self.safety_reminder or "")
+
+
+class ChatResult(NamedTuple):
+    reply: str  # 经过安全过滤的完整回答
+    context_tokens: int  # 本次请求的上下文 token 数（估算）
+    cached: bool  # 是否来自回答缓存
+
+
+class ChatService:
+    def __init__(self):
+        self.context_builder = ContextBuilder(
+            token_budget=settings.CONTEXT_TOKEN_BUDGET,
+            reserved_output_tokens=settings.MAX_OUTPUT_TOKENS,
+        )
+
+    def build_context(
+        self,
+        message: str,
+        history: Optional[List[dict]] = None,
+        response_mode: Optional[str] = "concise",
+        child_age: Optional[int] = None,
+        summary: Optional[str] = None,
+    ) -> BuiltContext:
+        """
+        构建发送给 LLM 的上下文
+
+        消息列表结构：[System Prompt, 历史消息..., 当前用户消息]
+
+        参数：
+            message: 家长当前提出的问题
+            history: 历史消息 [{"role": ..., "content": ...}, ...]（从旧到新）
+            response_mode: "detailed" 或 "concise"
+            child_age: 孩子年龄，None 表示不指定
+            summary: 会话摘要（较早对话的折叠），None 表示无
+
+        返回：
+            BuiltContext（消息列表 + 估算的 token 数）
+        """
+        with span("chat.build_context", chat_metrics.prompt_build.observe):
+            # 步骤 1：根据回答模式与年龄段取 System Prompt（启动时已预编译）
+            system_prompt = settings.get_system_prompt(mode=response_mode, child_age=child_age)
+            # 步骤 2：按 token 预算从新到旧选取历史，并为输出预留 MAX_OUTPUT_TOKENS
+            return self.context_builder.build(system_prompt, history, message, summary)
+
+    async def _create(self, messages: List[dict], stream: bool = False):
+        # 步骤 3：异步调用 LLM（await 期间不阻塞事件循环）
+        client = llm_client_manager.client
+        return await client.chat.completions.create(
+            model=settings.MODEL_NAME,
+            messages=messages,
+            temperature=0.7,  # 创造性参数（0-1，0.7 较均衡）
+            max_tokens=settings.MAX_OUTPUT_TOKENS,  # 最大生成 token 数（控制回答长度）
+            timeout=settings.LLM_TIMEOUT,
+            stream=stream,
+        )
+
+    async def complete(
+        self,
+        message: str,
+        history: Optional[List[dict]] = None,
+        response_mode: Optional[str] = "concise",
+        child_age: Optional[int] = None,
+        summary: Optional[str] = None,
+    ) -> ChatResult:
+        """
+        非流式对话：返回经过安全过滤的完整回答及上下文 token 数
+
+        异常：LLM 调用失败时原样抛出，由调用方转换为 HTTP 错误
+        """
+        context = self.build_context(message, history, response_mode, child_age, summary)
+        cache_key = None
+        if response_cache.is_cacheable(history) and not summary:
+            cache_key = response_cache.make_key(message, response_mode, child_age)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return ChatResult(self._filter(cached), context.prompt_tokens, True)
+
+        flight_key = self._flight_key(message, history, response_mode, child_age, summary)
+        joined = singleflight.in_flight_stream(flight_key)
+        with span("chat.generate"):
+            if joined is not None:
+                # 已有相同的流式生成在进行：等待其完整结果，不再重复调用上游
+                reply = "".join([content async for content in joined])
+            else:
+                reply = await singleflight.do(
+                    flight_key, partial(self._generate, context.messages, cache_key, context.prompt_tokens)
+                )
+        # 步骤 4：安全过滤（检测到敏感词汇时追加安全提醒）
+        return ChatResult(self._filter(reply), context.prompt_tokens, False)
+
+    def _filter(self, reply: str) -> str:
+        with span("chat.safety_filter", chat_metrics.safety_filter.observe):
+            return filter_unsafe_content(reply)
+
+    async def _generate(self, messages: List[dict], cache_key: Optional[tuple], prompt_tokens: int = 0) -> str:
+        chat_metrics.prompt_tokens.inc(prompt_tokens)
+        try:
+            with span("chat.upstream", chat_metrics.generation.observe):
+                response = await self._create(messages)
+        except Exception:
+            chat_metrics.upstream_errors.inc()
+            raise
+        reply = response.choices[0].message.content or ""
+        chat_metrics.completion_tokens.inc(estimate_tokens(reply))
+        if cache_key is not None:
+            response_cache.set(cache_key, reply)
+        return reply
+
+    def stream(
+        self,
+        message: str,
+        history: Optional[List[dict]] = None,
+        response_mode: Optional[str] = "concise",
+        child_age: Optional[int] = None,
+        summary: Optional[str] = None,
+    ) -> ChatStream:
+        """
+        流式对话：返回 ChatStream，迭代时才真正发起 LLM 请求
+
+        安全检查随增量进行，生成结束时即可得到安全提醒（见 ChatStream.final_reply）。
+        相同请求的并发流共享同一个上游流（后加入者先回放已生成部分）。
+        """
+        context = self.build_context(message, history, response_mode, child_age, summary)
+        cache_key = None
+        if response_cache.is_cacheable(history) and not summary:
+            cache_key = response_cache.make_key(message, response_mode, child_age)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                # 命中缓存：整段回答作为一个增量下发
+                return ChatStream(self._replay(cached), context.prompt_tokens, cached=True)
+
+        def source() -> AsyncIterator[str]:
+            # 只在真正发起上游请求时调用（加入已有流的请求不会调用）
+            chat_metrics.prompt_tokens.inc(context.prompt_tokens)
+            return self._cache_on_finish(self._iter_deltas(context.messages), cache_key)
+
+        flight_key = self._flight_key(message, history, response_mode, child_age, summary)
+        return ChatStream(singleflight.stream(flight_key, source), context.prompt_tokens)
+
+    def _flight_key(
+        self,
+        message: str,
+        history: Optional[List[dict]],
+        response_mode: Optional[str],
+        child_age: Optional[int],
+        summary: Optional[str],
+    ) -> tuple:
+        return (
+            *response_cache.make_key(message, response_mode, child_age),
+            history_digest(history, summary),
+        )
+
+    async def _replay(self, reply: str) -> AsyncIterator[str]:
+        yield reply
+
+    async def _cache_on_finish(self, source: AsyncIterator[str], cache_key: Optional[tuple]) -> AsyncIterator[str]:
+        # 仅完整生成的回答写入缓存，中断的部分回答不复用
+        parts = []
+        async for content in source:
+            parts.append(content)
+            yield content
+        if cache_key is not None:
+            response_cache.set(cache_key, "".join(parts))
+
+    async def _iter_deltas(self, messages: List[dict]) -> AsyncIterator[str]:
+        start = perf_counter()
+        first = True
+        completion_tokens = 0
+        stream = None
+        try:
+            stream = await self._create(messages, stream=True)
+            async for chunk in stream:
+                # 部分模型会发送空 choices 或空 delta（如首包仅含 role），直接跳过
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    if first:
+                        chat_metrics.upstream_ttft.observe(perf_counter() - start)
+                        record_span("chat.upstream_ttft", start)
+                        first = False
+                    completion_tokens += estimate_tokens(content)
+                    yield content
+        except Exception:
+            chat_metrics.upstream_errors.inc()
+            raise
+        finally:
+            # 客户端断开（生成器被关闭）时也记录已生成部分
+            chat_metrics.completion_tokens.inc(completion_tokens)
+            # 提前结束（客户端断开、共享的流被取消）时上游还在生成：显式关闭响应，
+            # 把连接立即归还连接池，而不是等垃圾回收或上游生成完毕
+            if stream is not None:
+                await stream.close()
+        chat_metrics.generation.observe(perf_counter() - start)
+        record_span("chat.upstream", start)
+
+
+chat_service = ChatService()
@@ -0,0 +1,142 @@
+"""
+聊天核心模块 - 相同请求合并（single-flight）
+
+C++ 视角速览：
+- 类似以请求键为索引的 std::shared_future 表：同一时刻相同键的请求只发起一次上游调用，
+  其余请求等待并共享同一个结果。
+- 流式请求通过 _SharedStream 广播：一个后台任务从上游读取增量，所有订阅者按顺序读取，
+  后加入的订阅者先回放已生成的部分再继续跟随。
+- 仅合并“正在进行中”的请求；完成后立即从表中移除（结果复用交给 response_cache）。
+"""
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+import asyncio
+import hashlib
+import json
+
+
+def history_digest(history: Optional[List[dict]], summary: Optional[str] = None) -> str:
+    # 历史内容（含会话摘要）的哈希：相同问题但上下文不同的请求不能合并
+    if not history and not summary:
+        return ""
+    payload = json.dumps(
+        [summary, [(m["role"], m["content"]) for m in history or []]],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class _SharedStream:
+    def __init__(self, source: AsyncIterator[str], on_done: Callable[[], None]):
+        self._source = source
+        self._on_done = on_done
+        self._task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self.chunks: List[str] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.subscribers = 0
+
+    async def _pump(self) -> None:
+        try:
+            async for content in self._source:
+                self.chunks.append(content)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = ConnectionAbortedError("上游生成已取消")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._on_done()
+            self._notify()
+
+    def _notify(self) -> None:
+        # 唤醒所有等待者，并换一个新的 Event 供下一轮等待
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        if self._task is None:
+            self._task = asyncio.create_task(self._pump())
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                changed = self._changed
+                if index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            # 所有订阅者都已断开：取消上游生成，避免白白消耗 token
+            if self.subscribers == 0 and not self.done:
+                self._task.cancel()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self._streams: Dict[Hashable, _SharedStream] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        执行 fn() 并返回结果；相同 key 的并发调用共享同一次执行。
+
+        使用 shield：某个等待者被取消（客户端断开）不会取消共享的上游调用。
+        """
+        future = self._calls.get(key)
+        if future is None:
+            self.leaders += 1
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    def stream(self, key: Hashable, source_factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        返回一个增量迭代器；相同 key 的并发流共享同一个上游流。
+
+        source_factory 仅在没有进行中的同键流时才会被调用。
+        """
+        shared = self._streams.get(key)
+        if shared is None or shared.done:
+            self.leaders += 1
+            shared = _SharedStream(source_factory(), on_done=lambda: self._drop_stream(key, shared))
+            self._streams[key] = shared
+        else:
+            self.coalesced += 1
+        return shared.subscribe()
+
+    def in_flight_stream(self, key: Hashable) -> Optional[AsyncIterator[str]]:
+        # 非流式请求可加入同键的进行中流式生成，等待其完整结果
+        shared = self._streams.get(key)
+        if shared is None or shared.done:
+            return None
+        self.coalesced += 1
+        return shared.subscribe()
+
+    def _drop_stream(self, key: Hashable, shared: "_SharedStream") -> None:
+        if self._streams.get(key) is shared:
+            del self._streams[key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight_calls": len(self._calls),
+            "in_flight_streams": len(self._streams),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+singleflight = SingleFlight()
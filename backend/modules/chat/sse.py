@@ -0,0 +1,20 @@
+"""
+聊天核心模块 - Server-Sent Events 编码
+
+/chat/stream 与 /chat_with_context/stream 共用同一事件格式。
+"""
+import json
+
+
+def sse_event(event: str, data: dict) -> str:
+    """
+    编码一条 Server-Sent Events 消息
+    
+    格式：
+        event: <事件名>
+        data: <JSON 字符串>
+        (空行)
+    
+    ensure_ascii=False：中文原样输出，减少传输体积
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
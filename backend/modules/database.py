@@ -0,0 +1,225 @@
+"""
+数据库访问公共设施（各模块共用）
+
+C++ 视角速览：
+- SQLModel/SQLite 的调用是同步阻塞的（查询、提交时的 fsync），直接在 async 路由里执行
+  会卡住整个事件循环，所有用户的请求（包括正在流式输出的对话）都要跟着等待。
+- run_in_db 把同步的数据库函数投递到专用线程池执行，调用方 await 结果，
+  类似把任务提交给 std::thread 池后等待 std::future；等待期间事件循环继续处理其他请求。
+- 线程池与 LLM 调用、默认线程池相互独立，数据库慢时不会挤占其他阻塞任务。
+- 通过 contextvars.copy_context 执行，请求级上下文（如日志/追踪信息）在线程中仍可读取。
+- get_engine 返回按 URL 共享的 Engine（档案、历史等服务共用同一个连接池），
+  每个新连接建立时设置 SQLite PRAGMA：
+    journal_mode=WAL      读写互不阻塞（读者不等写者），并发写入时不再频繁 "database is locked"
+    synchronous=NORMAL    WAL 模式下仍保证崩溃一致性，提交时省去大部分 fsync
+    foreign_keys=ON       启用外键约束与 ON DELETE CASCADE
+    busy_timeout          遇到写锁时等待而不是立即报错
+    mmap_size/cache_size  用内存映射与更大的页缓存减少读 I/O
+- add_missing_columns / create_missing_indexes：轻量迁移，create_all 不会修改已有表，
+  模型中新增的列与索引在启动时补齐。
+- rebuild_table：SQLite 无法用 ALTER 修改主键/约束，需要时按模型定义重建表并复制数据。
+- reclaim_space：删除数据后 SQLite 只把页标记为空闲，文件不会变小；维护命令（如会话归档）
+  结束时调用，把空闲页还给文件系统。
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from typing import Callable, Dict, List, Optional, TypeVar
+import asyncio
+import contextvars
+
+from sqlalchemy import event
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.engine import Engine, make_url
+from sqlmodel import create_engine
+
+from config import settings
+
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_engines: Dict[str, Engine] = {}
+_engines_lock = Lock()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # SQLite 默认不检查外键；开启后 ON DELETE CASCADE 才会生效
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.DB_BUSY_TIMEOUT_MS)}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.DB_MMAP_SIZE)}")
+        # 负数表示以 KiB 为单位（而不是页数）
+        cursor.execute(f"PRAGMA cache_size=-{int(settings.DB_CACHE_SIZE_KB)}")
+    finally:
+        cursor.close()
+
+
+def create_db_engine(db_url: str) -> Engine:
+    """创建带 SQLite 调优与连接池配置的 Engine（一般通过 get_engine 共享使用）"""
+    url = make_url(db_url)
+    kwargs = {}
+    if url.get_backend_name() == "sqlite":
+        # check_same_thread=False：连接会在数据库线程池的不同线程间复用
+        kwargs["connect_args"] = {"check_same_thread": False}
+    if url.database not in (None, "", ":memory:"):
+        # 内存库使用 SQLAlchemy 默认的单连接池，不支持以下参数
+        kwargs.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+        )
+    engine = create_engine(db_url, **kwargs)
+    if url.get_backend_name() == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+def get_engine(db_url: Optional[str] = None) -> Engine:
+    """按 URL 返回共享 Engine；未指定时使用 settings.DATABASE_URL"""
+    db_url = db_url or settings.DATABASE_URL
+    with _engines_lock:
+        engine = _engines.get(db_url)
+        if engine is None:
+            engine = _engines[db_url] = create_db_engine(db_url)
+        return engine
+
+
+def add_missing_columns(engine: Engine, model) -> List[str]:
+    # SQLite 不支持 create_all 自动加列；对比 PRAGMA table_info，补齐模型中新增的列，返回新增的列名。
+    table = model.__table__
+    added = []
+    with engine.begin() as conn:
+        existing = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table.name})")}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+            if column.server_default is not None:
+                ddl += f" NOT NULL DEFAULT {column.server_default.arg}"
+            conn.exec_driver_sql(ddl)
+            added.append(column.name)
+    return added
+
+
+def create_missing_indexes(engine: Engine, model) -> None:
+    # 已有表不会随 create_all 建新索引；checkfirst 保证重复启动时幂等。
+    for index in model.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+
+def table_sql(engine: Engine, table_name: str) -> str:
+    # 表在数据库中的建表语句（不存在时返回空串），用于判断是否需要重建
+    with engine.connect() as conn:
+        row = conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+        ).first()
+    return row[0] if row and row[0] else ""
+
+
+def rebuild_table(engine: Engine, model) -> None:
+    """
+    按模型当前定义重建已有表并保留数据（SQLite 官方推荐的“新建-复制-替换”流程）
+
+    用于 ALTER TABLE 做不到的变更，如给主键加 AUTOINCREMENT、给外键加 ON DELETE CASCADE。
+    整个过程在一个显式事务中完成（失败时回滚，原表不变）；期间临时关闭外键检查，
+    避免删除旧表时触发级联。
+    """
+    table = model.__table__
+    old = f"{table.name}__old"
+    raw = engine.raw_connection()
+    conn = raw.dbapi_connection
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None  # 由我们显式 BEGIN/COMMIT（pysqlite 默认不会为 DDL 开启事务）
+    cursor = conn.cursor()
+    try:
+        cursor.execute("PRAGMA foreign_keys=OFF")  # 只能在事务外切换
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table.name})").fetchall()]
+            indexes = [row[1] for row in cursor.execute(f"PRAGMA index_list({table.name})").fetchall()]
+            cursor.execute(f"ALTER TABLE {table.name} RENAME TO {old}")
+            for name in indexes:
+                if not name.startswith("sqlite_autoindex"):
+                    cursor.execute(f"DROP INDEX {name}")  # 索引随旧表改名，释放名字给新表
+            cursor.execute(str(CreateTable(table).compile(dialect=engine.dialect)))
+            for index in table.indexes:
+                cursor.execute(str(CreateIndex(index).compile(dialect=engine.dialect)))
+            copied = ", ".join(c.name for c in table.columns if c.name in columns)
+            cursor.execute(f"INSERT INTO {table.name} ({copied}) SELECT {copied} FROM {old}")
+            cursor.execute(f"DROP TABLE {old}")
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+    finally:
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+        conn.isolation_level = isolation_level
+        raw.close()
+
+
+def reclaim_space(engine: Engine, full: bool = False) -> Optional[int]:
+    """
+    回收空闲页并截断 WAL 文件，返回释放的字节数（估算）
+
+    full=True：执行 VACUUM 重写整个库（耗时与库大小成正比，期间阻塞写入），
+    同时把 auto_vacuum 切换为 INCREMENTAL；之后的调用只需 PRAGMA incremental_vacuum，
+    按空闲页数增量回收，不再重写整个文件。
+    full=False 且库仍是默认的 auto_vacuum=NONE 时无法增量回收，只截断 WAL，返回 None
+    （与“回收了 0 字节”区分，由调用方提示先执行一次完整 VACUUM）。
+    """
+    raw = engine.raw_connection()
+    conn = raw.dbapi_connection
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None  # VACUUM 不能在事务中执行
+    cursor = conn.cursor()
+    try:
+        page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+        before = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        incremental = cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2  # INCREMENTAL
+        if full:
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")  # 在 VACUUM 时生效
+            cursor.execute("VACUUM")
+        elif incremental:
+            cursor.execute("PRAGMA incremental_vacuum").fetchall()
+        after = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        if not full and not incremental:
+            return None
+        return (before - after) * page_size
+    finally:
+        cursor.close()
+        conn.isolation_level = isolation_level
+        raw.close()
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    # 首次使用时创建；关闭后再次使用会重新创建（测试中可多次启停）
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.DB_EXECUTOR_WORKERS, thread_name_prefix="db"
+        )
+    return _executor
+
+
+async def run_in_db(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    在数据库线程池中执行同步函数并等待结果
+
+    任务在调用时即已提交：即使 await 被取消（如客户端断开），线程中的写入仍会完成。
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(get_db_executor(), partial(ctx.run, fn, *args, **kwargs))
+
+
+def shutdown_db_executor() -> None:
+    # 应用关闭时调用：等待已提交的写入完成，再释放线程
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,67 @@
+"""
+对话历史管理模块 - 冷会话归档（压缩存储）
+
+C++ 视角速览：
+- 长时间无活动的会话（updated_at 早于 HISTORY_ARCHIVE_IDLE_DAYS 天）由维护命令归档：
+  该会话的全部消息序列化后压缩成一个 blob，存入 SessionArchiveModel（每会话一行），
+  原消息行从 messagemodel 删除。会话元数据（SessionModel）与摘要保持不变。
+- 压缩：安装了可选依赖 zstandard 时用 zstd，否则用标准库 zlib；每行记录所用的 codec，
+  两种格式可以混存，读取时按行解压。
+- 读取透明：消息 id 单调递增，归档部分总是会话中最早的一段；HistoryService 读取时
+  把“归档 + 在线消息”拼接返回（见 service.py），调用方无需感知。
+  归档后继续对话的新消息照常写入 messagemodel，下次归档时与已有归档合并。
+- 归档由维护命令分批执行（见 maintenance.py），每个会话一个短事务，可随时中断、重复执行。
+"""
+from typing import List, NamedTuple, Tuple
+from datetime import datetime
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖：未安装时使用 zlib
+    zstandard = None
+
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 10
+
+
+class ArchivedMessage(NamedTuple):
+    # 字段与 MessageModel 的查询结果一致，读取路径可以不加区分地使用
+    id: int
+    role: str
+    content: str
+    timestamp: datetime
+    truncated: bool
+
+
+def default_codec() -> str:
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def compress_messages(messages: List[ArchivedMessage]) -> Tuple[str, bytes, int]:
+    """把消息列表（按 id 升序）序列化并压缩，返回 (codec, 压缩数据, 压缩前字节数)"""
+    raw = json.dumps(
+        [[m.id, m.role, m.content, m.timestamp.isoformat(), bool(m.truncated)] for m in messages],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+    codec = default_codec()
+    if codec == "zstd":
+        return codec, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw), len(raw)
+    return codec, zlib.compress(raw, ZLIB_LEVEL), len(raw)
+
+
+def decompress_messages(codec: str, payload: bytes) -> List[ArchivedMessage]:
+    if codec == "zlib":
+        raw = zlib.decompress(payload)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("该归档使用 zstd 压缩，需要安装 zstandard")
+        raw = zstandard.ZstdDecompressor().decompress(payload)
+    else:
+        raise ValueError(f"未知的归档压缩格式: {codec}")
+    return [
+        ArchivedMessage(id, role, content, datetime.fromisoformat(timestamp), truncated)
+        for id, role, content, timestamp, truncated in json.loads(raw)
+    ]
@@ -0,0 +1,61 @@
+"""
+对话历史管理模块 - 维护命令（冷会话归档 + 空间回收）
+
+在 backend 目录下运行，可放进 cron 定期执行：
+    python -m modules.history.maintenance                    # 按配置归档空闲会话
+    python -m modules.history.maintenance --idle-days 7 --max-sessions 500
+    python -m modules.history.maintenance --vacuum           # 归档后 VACUUM，把空闲页还给文件系统
+
+空间回收：新建的库默认 auto_vacuum=NONE，不带 --vacuum 时只截断 WAL，空闲页不会归还
+（会输出提示）；执行一次 --vacuum 后库切换为增量模式，之后不带 --vacuum 也能按空闲页增量回收。
+
+归档分批进行（每批 --batch-size 个会话，每个会话一个短事务），服务运行期间也可执行；
+中断后重新运行即可继续。归档格式见 archive.py。
+"""
+import argparse
+import logging
+
+from config import settings
+from modules.database import reclaim_space
+from .service import history_service
+
+logger = logging.getLogger(__name__)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="归档长时间无活动的会话，并回收数据库空间")
+    parser.add_argument("--idle-days", type=float, default=settings.HISTORY_ARCHIVE_IDLE_DAYS,
+                        help="超过多少天无活动的会话会被归档")
+    parser.add_argument("--batch-size", type=int, default=settings.HISTORY_ARCHIVE_BATCH_SIZE,
+                        help="每批挑选的会话数")
+    parser.add_argument("--max-sessions", type=int, default=0, help="本次最多归档的会话数（0 表示不限）")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="完整 VACUUM（重写整个库，期间阻塞写入）并切换为增量回收；"
+                             "库未切换前，不带此参数不会回收空闲页")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    history_service.init_db()
+
+    total = 0
+    while not args.max_sessions or total < args.max_sessions:
+        batch = args.batch_size
+        if args.max_sessions:
+            batch = min(batch, args.max_sessions - total)
+        selected, archived = history_service.archive_idle_sessions(args.idle_days, batch)
+        total += archived
+        logger.info("已归档 %d 个会话（累计 %d）", archived, total)
+        # 没有候选会话时结束；部分会话被跳过（期间又有了新消息等）不代表已经归档完。
+        # 整批都被跳过时也结束，避免反复挑选同一批会话。
+        if not selected or not archived:
+            break
+
+    freed = reclaim_space(history_service.engine, full=args.vacuum)
+    if freed is None:
+        logger.warning("数据库未开启增量回收（auto_vacuum=NONE），空闲页未归还；请执行一次 --vacuum")
+    else:
+        logger.info("回收空间 %.1f MiB", freed / (1024 * 1024))
+    history_service.close()
+
+
+if __name__ == "__main__":
+    main()
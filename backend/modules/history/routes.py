@@ -5,12 +5,33 @@ C++ 程序员理解：
 - HTTP 接口定义
 - 管理对话会话的增删查
 """
-from fastapi import APIRouter, HTTPException, Header
+from fastapi import APIRouter, HTTPException, Header, Query, Response
 from typing import Optional
-from .schemas import AddMessageRequest, GetHistoryResponse
+import hashlib
+from .schemas import (
+    AddMessageRequest, GetHistoryResponse, HistoryChangesResponse, HistorySearchResponse, ListSessionsResponse,
+)
 from .service import history_service
 
 
+def _make_etag(user_id: str, session_id: str, version: str, *params) -> str:
+    # 弱 ETag：同一用户的同一会话 + 同一会话版本 + 同一分页参数 → 同一标签
+    # （含 session_id：不传 X-Session-ID 时“当前会话”可能已切换，版本串相同也不能命中）
+    parts = [user_id, session_id, version, *map(str, params)]
+    digest = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match 可能是 "*" 或逗号分隔的多个标签；弱比较忽略 W/ 前缀
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in tags
+
+
 def register_routes(app):
     """
     注册对话历史管理路由到主应用
@@ -39,7 +60,7 @@ def register_routes(app):
                 "message": "新会话已创建"
             }
         """
-        session_id = history_service.create_session(user_id)
+        session_id = await history_service.create_session_async(user_id)
         return {
             "session_id": session_id,
             "message": "新会话已创建"
@@ -55,9 +76,34 @@ def register_routes(app):
                 "session_id": "uuid-string" 或 null
             }
         """
-        session_id = history_service.get_current_session(user_id)
+        session_id = await history_service.get_current_session_async(user_id)
         return {"session_id": session_id}
     
+    @router.get("/sessions", response_model=ListSessionsResponse)
+    async def list_sessions(
+        user_id: str = Header(..., alias="X-User-ID"),
+        limit: int = Query(100, ge=1, le=1000, description="单次最多返回的会话数"),
+        before: Optional[str] = Query(None, description="上一页返回的 next_before（翻页）"),
+    ):
+        """
+        列出用户的所有会话（最近更新的在前）
+        
+        返回：
+            {
+                "sessions": [{"session_id": "...", "message_count": 12,
+                              "last_message_preview": "孩子撒谎时先别急着批评…",
+                              "last_message_at": "...", "created_at": "...", "updated_at": "..."}],
+                "has_more": true,
+                "next_before": "MjAyNi0..."
+            }
+        
+        翻页：把 next_before 原样作为 before 传入，直到 has_more 为 false。
+        """
+        try:
+            return await history_service.list_sessions_async(user_id, limit, before)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="翻页游标无效")
+    
     @router.post("/message")
     async def add_message(
         message_data: AddMessageRequest,
@@ -85,12 +131,12 @@ def register_routes(app):
         """
         # 如果未指定 session_id，使用当前会话；缺省则自动创建
         if session_id is None:
-            session_id = history_service.get_current_session(user_id)
+            session_id = await history_service.get_current_session_async(user_id)
             if session_id is None:
                 # 自动创建新会话
-                session_id = history_service.create_session(user_id)
+                session_id = await history_service.create_session_async(user_id)
         
-        success = history_service.add_message(user_id, session_id, message_data)
+        success = await history_service.add_message_async(user_id, session_id, message_data)
         if not success:
             raise HTTPException(status_code=404, detail="会话不存在")
         
@@ -102,32 +148,107 @@ def register_routes(app):
     
     @router.get("", response_model=GetHistoryResponse)
     async def get_history(
+        response: Response,
         user_id: str = Header(..., alias="X-User-ID"),
-        session_id: Optional[str] = Header(None, alias="X-Session-ID")
+        session_id: Optional[str] = Header(None, alias="X-Session-ID"),
+        if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+        before: Optional[int] = Query(None, ge=1, description="游标：返回 id 小于它的消息（向前翻页）"),
+        after: Optional[int] = Query(None, ge=0, description="游标：返回 id 大于它的消息（拉取新消息）"),
+        limit: Optional[int] = Query(None, ge=1, le=200, description="每页条数；不分页时返回整个会话"),
     ):
         """
-        查询对话历史
+        查询对话历史（支持游标分页与条件请求）
         
         请求头：
             X-User-ID: 用户 ID
             X-Session-ID: 会话 ID（可选，不填查询当前会话）
+            If-None-Match: 上次响应的 ETag（可选）；会话未变化时返回 304，不再传输消息
+        
+        查询参数（均可选，见 HistoryService.get_history）：
+            before / after: 消息 id 游标；limit: 每页条数
+            首屏：?limit=20；向前翻页：?before=<本页第一条 id>&limit=20；
+            拉取新消息：?after=<已有最后一条 id>
         
         返回：
             {
                 "session_id": "...",
-                "messages": [...],
+                "messages": [{"id": 41, "role": "user", ...}, ...],
                 "message_count": 10,
                 "created_at": "2026-01-16T10:30:00",
-                "updated_at": "2026-01-16T11:00:00"
+                "updated_at": "2026-01-16T11:00:00",
+                "has_more": true
             }
+            响应头 ETag；会话未变化且 If-None-Match 命中时返回 304（无响应体）
         """
+        # 先取会话版本（只读索引）：未变化时直接 304，省去读取与序列化消息
         # 若未传入 session_id，则查询“当前会话”（最近更新）
-        history = history_service.get_history(user_id, session_id)
+        version = await history_service.get_history_version_async(user_id, session_id)
+        if not version:
+            raise HTTPException(status_code=404, detail="历史记录不存在")
+        session_id, version = version
+        etag = _make_etag(user_id, session_id, version, before, after, limit)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+
+        history = await history_service.get_history_async(user_id, session_id, before, after, limit)
         if not history:
             raise HTTPException(status_code=404, detail="历史记录不存在")
-        
+        response.headers.update(headers)
         return history
     
+    @router.get("/changes", response_model=HistoryChangesResponse)
+    async def get_changes(
+        user_id: str = Header(..., alias="X-User-ID"),
+        session_id: Optional[str] = Header(None, alias="X-Session-ID"),
+        since: Optional[str] = Query(None, description="上次同步返回的 cursor；首次同步不传"),
+        limit: int = Query(100, ge=1, le=500, description="单次最多返回的消息条数"),
+    ):
+        """
+        增量同步（供小程序本地消息缓存使用）
+        
+        请求头：
+            X-User-ID: 用户 ID
+            X-Session-ID: 会话 ID（可选，指定时只同步该会话）
+        
+        返回：
+            {
+                "cursor": "42.3",
+                "messages": [{"id": 41, "session_id": "...", "role": "user", "content": "...", ...}],
+                "deletions": [{"session_id": "...", "kind": "clear", "up_to_message_id": 40, ...}],
+                "has_more": false
+            }
+        
+        客户端处理顺序：先按 deletions 删除本地 id ≤ up_to_message_id 的消息，再追加 messages，
+        保存 cursor；has_more 为 true 时立即用新 cursor 继续拉取。
+        """
+        try:
+            return await history_service.get_changes_async(user_id, since, session_id, limit)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="同步游标无效")
+    
+    @router.get("/search", response_model=HistorySearchResponse)
+    async def search_history(
+        user_id: str = Header(..., alias="X-User-ID"),
+        q: str = Query(..., min_length=1, max_length=100, description="搜索词（多个词用空格分隔，需全部命中）"),
+        limit: int = Query(20, ge=1, le=50, description="单次最多返回的结果数"),
+        offset: int = Query(0, ge=0, le=1000, description="跳过的结果数（翻页）"),
+    ):
+        """
+        在该用户的全部会话中搜索消息内容
+        
+        返回：
+            {
+                "query": "撒谎",
+                "hits": [{"message_id": 41, "session_id": "...", "role": "assistant",
+                          "snippet": "…孩子<em>撒谎</em>时先别急着…", "timestamp": "..."}],
+                "has_more": false
+            }
+        
+        按相关度排序；点击结果后可用 X-Session-ID + GET /history?before= 定位上下文。
+        """
+        return await history_service.search_messages_async(user_id, q, limit, offset)
+
     @router.delete("/session")
     async def clear_session(
         user_id: str = Header(..., alias="X-User-ID"),
@@ -140,11 +261,11 @@ def register_routes(app):
             204 No Content
         """
         if session_id is None:
-            session_id = history_service.get_current_session(user_id)
+            session_id = await history_service.get_current_session_async(user_id)
             if session_id is None:
                 raise HTTPException(status_code=404, detail="会话不存在")
         
-        success = history_service.clear_session(user_id, session_id)
+        success = await history_service.clear_session_async(user_id, session_id)
         if not success:
             raise HTTPException(status_code=404, detail="会话不存在")
         
@@ -158,7 +279,7 @@ def register_routes(app):
         返回：
             200 OK
         """
-        history_service.delete_all_sessions(user_id)
+        await history_service.delete_all_sessions_async(user_id)
         return {"message": "所有会话已删除"}
     
     # 将路由器挂载到主应用（保持 main.py 简洁）
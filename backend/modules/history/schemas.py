@@ -13,9 +13,11 @@ class Message(BaseModel):
     """
     单条消息（类似 C++ struct）
     """
+    id: Optional[int] = Field(None, description="消息 ID（分页游标；尚未落库的消息为空）")
     role: Literal["user", "assistant", "system"] = Field(..., description="消息角色")
     content: str = Field(..., description="消息内容")
     timestamp: datetime = Field(default_factory=datetime.now, description="消息时间戳")
+    truncated: bool = Field(False, description="是否为被中断的不完整回答（流式生成中途断开）")
 
 
 class ConversationSession(BaseModel):
@@ -46,3 +48,72 @@ class GetHistoryResponse(BaseModel):
     message_count: int = Field(..., description="消息总数")
     created_at: datetime
     updated_at: datetime
+    has_more: bool = Field(False, description="分页查询时，翻页方向上是否还有更多消息")
+
+
+class SessionListItem(BaseModel):
+    """
+    会话列表中的一项（不含消息内容）
+    """
+    session_id: str
+    message_count: int = Field(..., description="消息总数")
+    last_message_preview: Optional[str] = Field(None, description="最后一条消息的开头部分")
+    last_message_at: Optional[datetime] = Field(None, description="最后一条消息的时间")
+    created_at: datetime
+    updated_at: datetime
+
+
+class ListSessionsResponse(BaseModel):
+    """
+    会话列表的响应
+    """
+    sessions: List[SessionListItem] = Field(default_factory=list, description="按最近更新排序的会话")
+    has_more: bool = Field(False, description="是否还有更早的会话")
+    next_before: Optional[str] = Field(None, description="翻页游标：has_more 为 true 时作为 before 传入，取下一页")
+
+
+class SyncedMessage(Message):
+    """
+    增量同步中的消息（带所属会话）
+    """
+    session_id: str = Field(..., description="会话 ID")
+
+
+class HistoryDeletion(BaseModel):
+    """
+    删除记录：客户端应删除本地该会话中 id ≤ up_to_message_id 的消息
+    """
+    session_id: str
+    kind: Literal["clear", "delete"] = Field(..., description="clear=清空消息（会话保留）；delete=删除会话")
+    up_to_message_id: int = Field(..., description="删除发生时该会话的最大消息 id")
+    deleted_at: datetime
+
+
+class HistoryChangesResponse(BaseModel):
+    """
+    增量同步的响应
+    """
+    cursor: str = Field(..., description="新的同步游标，下次请求作为 since 传回")
+    messages: List[SyncedMessage] = Field(default_factory=list, description="游标之后的新消息（按 id 升序）")
+    deletions: List[HistoryDeletion] = Field(default_factory=list, description="游标之后的删除记录")
+    has_more: bool = Field(False, description="是否还有更多新消息（应立即用新游标继续拉取）")
+
+
+class HistorySearchHit(BaseModel):
+    """
+    搜索结果中的一条消息
+    """
+    message_id: int
+    session_id: str
+    role: Literal["user", "assistant", "system"]
+    snippet: str = Field(..., description="命中片段，匹配文字用 <em></em> 包裹（展示前需转义其余内容）")
+    timestamp: datetime
+
+
+class HistorySearchResponse(BaseModel):
+    """
+    历史搜索的响应
+    """
+    query: str
+    hits: List[HistorySearchHit] = Field(default_factory=list, description="按相关度排序的命中消息")
+    has_more: bool = Field(False, description="是否还有更多结果（用 offset 继续获取）")
@@ -5,35 +5,262 @@ C++ 视角速览：
 - SessionModel / MessageModel 类似两张表：会话元数据 + 消息列表。
 - HistoryService 封装 CRUD；使用 SQLModel+Session，等价于 RAII 方式管理连接。
 - “当前会话”策略：取该用户最近更新的一条会话（updated_at 最大）。
+  热路径上先查进程内的“当前会话指针”（user_id → session_id，由 create_session / add_message 等维护），
+  O(1) 命中；未命中时走 (user_id, updated_at, session_id) 覆盖索引，只读索引不回表。
+- SessionModel 上反范式存储消息数与最后一条消息的预览/时间（写入消息时在同一事务中维护），
+  会话列表（list_sessions）与 ETag 版本只读会话表，不扫描消息表。
+- SessionSummaryModel：会话的滚动摘要（较早的消息折叠为一段文字），与会话一一对应。
+- 最近消息读取走 (session_id, timestamp) 复合索引：ORDER BY ... DESC LIMIT n，
+  耗时只与 n 有关，与会话总消息数无关。
+- 与档案服务共用 modules/database.get_engine 提供的 Engine（WAL、连接池等配置集中在那里）。
+- 可选写缓冲（HISTORY_WRITE_BEHIND）：add_message 先入内存队列，后台批量落库；
+  读取最近消息 / 历史时合并尚未落库的消息（见 write_behind.py）。
+- 适配器每轮对话只访问两次数据库：load_turn_context（会话 + 摘要 + 最近消息 + 孩子年龄，一次读取）
+  与 record_turn（问与答 + 会话更新时间，一个事务）。
+- 增量同步（get_changes）：消息 id 单调递增（AUTOINCREMENT，删除后不复用）；删除操作记录为
+  HistoryTombstoneModel（墓碑），客户端凭游标只拉取新消息与删除记录。
+- 冷会话归档（SessionArchiveModel，见 archive.py / maintenance.py）：空闲会话的消息压缩成一个 blob；
+  归档部分总是会话中最早的消息，读取时与在线消息拼接，对调用方透明。
+- 全文搜索（search_messages）：FTS5 外部内容表 messagefts 索引 messagemodel.content，
+  由触发器与消息表保持同步；trigram 分词按三字子串建索引，适合不分词的中文。
+  不足三个字的词无法走 trigram 索引，改用 LIKE 在该用户的消息中过滤。已归档的消息不参与搜索。
+- 删除：消息、摘要与归档的外键带 ON DELETE CASCADE；清空/删除会话用集合式 SQL 按
+  DB_DELETE_BATCH_SIZE 分批删除（每批一个短事务），不再逐行加载 ORM 对象。
+- *_async 方法在数据库线程池中执行对应的同步方法（见 modules/database.py），供 async 路由 await。
+- 建表与迁移（补列、重建表、全文索引）不在构造时执行，由 init_db() 显式调用
+  （应用启动的 lifespan 与维护命令中），导入模块不会读写数据库文件。
 """
-from typing import List, Optional
-from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+from datetime import datetime, timedelta
+import base64
 import uuid
-from sqlmodel import SQLModel, Field, Session, create_engine, select
-from .schemas import Message, ConversationSession, AddMessageRequest, GetHistoryResponse
+from sqlmodel import SQLModel, Field, Session, select
+from sqlmodel.sql.sqltypes import AutoString
+from sqlalchemy import (
+    Column, DateTime, ForeignKey, Index, LargeBinary,
+    and_, bindparam, delete, func, insert, literal, literal_column, text, tuple_, update,
+)
+from sqlalchemy.exc import OperationalError
+from config import settings
+from modules.cache import TTLCache
+from modules.database import (
+    add_missing_columns, create_missing_indexes, get_engine, rebuild_table, run_in_db, table_sql,
+)
+from modules.metrics.service import chat_metrics
+from modules.profile.service import profile_service
+from modules.tracing.service import span, traced
+from .schemas import (
+    Message, ConversationSession, AddMessageRequest, GetHistoryResponse,
+    HistoryChangesResponse, HistoryDeletion, HistorySearchHit, HistorySearchResponse,
+    ListSessionsResponse, SessionListItem, SyncedMessage,
+)
+from .archive import ArchivedMessage, compress_messages, decompress_messages
+from .write_behind import MessageWriteBehind, PendingMessage
 
 
 class SessionModel(SQLModel, table=True):
+    # 覆盖索引：按用户取最近更新的会话时，直接读索引末尾一项即可得到 session_id
+    __table_args__ = (Index("ix_sessionmodel_user_updated", "user_id", "updated_at", "session_id"),)
+
     session_id: str = Field(primary_key=True, index=True)
     user_id: str = Field(index=True)
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+    # 反范式字段：随消息写入/清空维护（消息数包含已归档的消息）
+    message_count: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    last_message_preview: Optional[str] = None
+    last_message_at: Optional[datetime] = None
 
 
 class MessageModel(SQLModel, table=True):
+    # 复合索引：按会话取最近 N 条消息时，直接在索引上倒序扫描 N 行即可
+    # AUTOINCREMENT：id 永不复用（删除最新消息后也不会），可作为增量同步的游标
+    __table_args__ = (
+        Index("ix_messagemodel_session_ts", "session_id", "timestamp"),
+        {"sqlite_autoincrement": True},
+    )
+
     id: int = Field(primary_key=True)
-    session_id: str = Field(foreign_key="sessionmodel.session_id", index=True)
+    # 删除会话时数据库自动级联删除其消息（需 PRAGMA foreign_keys=ON，见 modules/database.py）
+    session_id: str = Field(sa_column=Column(
+        AutoString, ForeignKey("sessionmodel.session_id", ondelete="CASCADE"), index=True, nullable=False
+    ))
     user_id: str = Field(index=True)
     role: str
     content: str
     timestamp: datetime = Field(default_factory=datetime.utcnow)
+    # 流式回答被中断（客户端断开/生成出错）时只保存了部分内容，标记为 True
+    truncated: bool = Field(default=False, sa_column_kwargs={"server_default": "0"})
+
+
+class SessionSummaryModel(SQLModel, table=True):
+    session_id: str = Field(sa_column=Column(
+        AutoString, ForeignKey("sessionmodel.session_id", ondelete="CASCADE"), primary_key=True
+    ))
+    summary: str
+    # 已折叠进摘要的最后一条消息 id；id 大于它的消息仍以原文参与上下文
+    covered_until_id: int = 0
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class SessionArchiveModel(SQLModel, table=True):
+    """冷会话归档：会话最早的一段消息（id ≤ max_message_id）压缩后存成一个 blob"""
+    session_id: str = Field(sa_column=Column(
+        AutoString, ForeignKey("sessionmodel.session_id", ondelete="CASCADE"), primary_key=True
+    ))
+    codec: str  # "zlib" / "zstd"
+    message_count: int
+    max_message_id: int
+    raw_bytes: int  # 压缩前大小，用于统计压缩率
+    payload: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+    archived_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class HistoryTombstoneModel(SQLModel, table=True):
+    """删除记录（墓碑）：清空/删除会话时写入，供客户端增量同步时删除本地缓存"""
+    __table_args__ = ({"sqlite_autoincrement": True},)
+
+    id: int = Field(primary_key=True)
+    user_id: str = Field(index=True)
+    session_id: str
+    kind: str  # "clear"（清空消息，保留会话）或 "delete"（删除会话）
+    # 删除时该会话的最大消息 id：客户端删除本地 id ≤ 它的消息，之后的新消息不受影响
+    up_to_message_id: int = 0
+    deleted_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+PREVIEW_CHARS = 60  # 会话列表中最后一条消息的预览长度
+
+
+def _preview(content: str) -> str:
+    return content.replace("\n", " ")[:PREVIEW_CHARS]
+
+
+def _parse_cursor(cursor: str) -> Tuple[int, int]:
+    # 游标格式："<最后消息 id>.<最后墓碑 id>"；对客户端而言是不透明字符串
+    message_id, tombstone_id = cursor.split(".")
+    return int(message_id), int(tombstone_id)
+
+
+def _session_cursor(updated_at: datetime, session_id: str) -> str:
+    # 会话列表游标：上一页最后一项的 (updated_at, session_id)，base64url 编码成不透明字符串
+    raw = f"{updated_at.isoformat()}|{session_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _parse_session_cursor(cursor: str) -> Tuple[datetime, str]:
+    # 格式错误时抛出 ValueError（binascii.Error / UnicodeDecodeError 均为其子类）
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+    updated_at, session_id = raw.split("|", 1)
+    return datetime.fromisoformat(updated_at), session_id
+
+
+# FTS5 外部内容表：只存倒排索引，原文仍在 messagemodel（rowid = 消息 id）
+_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messagefts USING fts5("
+    "content, content='messagemodel', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS messagefts_ai AFTER INSERT ON messagemodel BEGIN "
+    "INSERT INTO messagefts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messagefts_ad AFTER DELETE ON messagemodel BEGIN "
+    "INSERT INTO messagefts(messagefts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messagefts_au AFTER UPDATE OF content ON messagemodel BEGIN "
+    "INSERT INTO messagefts(messagefts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messagefts(rowid, content) VALUES (new.id, new.content); END",
+)
+_FTS_OBJECTS = ("messagefts", "messagefts_ai", "messagefts_ad", "messagefts_au")
+SNIPPET_OPEN, SNIPPET_CLOSE = "<em>", "</em>"
+SNIPPET_CHARS = 32  # 片段长度（trigram 下约等于字符数）
+
+
+def _ensure_search_index(engine) -> bool:
+    """建立全文索引与同步触发器（幂等）；SQLite 未编译 FTS5 时返回 False，搜索退化为 LIKE"""
+    try:
+        with engine.begin() as conn:
+            existing = {row[0] for row in conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE name IN (?, ?, ?, ?)", _FTS_OBJECTS
+            )}
+            for ddl in _FTS_DDL:
+                conn.exec_driver_sql(ddl)
+            if len(existing) < len(_FTS_OBJECTS):
+                # 首次建立（或消息表重建后触发器丢失）：按现有消息重建整个索引
+                conn.exec_driver_sql("INSERT INTO messagefts(messagefts) VALUES ('rebuild')")
+    except OperationalError:
+        return False
+    return True
+
+
+def _fts_phrase(term: str) -> str:
+    # 用户输入作为 FTS5 短语（双引号内的 " 写成 ""），避免被解析为查询语法
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _like_pattern(term: str) -> str:
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _like_snippet(content: str, term: str) -> str:
+    # LIKE 回退路径没有 FTS5 的 snippet()：截取首个命中附近的一段并标记
+    pos = content.lower().find(term.lower())
+    if pos < 0:
+        return content[:SNIPPET_CHARS]
+    start = max(0, pos - (SNIPPET_CHARS - len(term)) // 2)
+    end = min(len(content), start + max(SNIPPET_CHARS, len(term)))
+    return (
+        ("…" if start > 0 else "")
+        + content[start:pos] + SNIPPET_OPEN + content[pos:pos + len(term)] + SNIPPET_CLOSE
+        + content[pos + len(term):end]
+        + ("…" if end < len(content) else "")
+    )
+
+
+class TurnContext(NamedTuple):
+    session_id: str
+    summary: Optional[str]  # 会话摘要（较早对话的折叠），无则为 None
+    history: List[dict]  # 摘要之后的最近消息（从旧到新）
+    age: Optional[int]  # 孩子年龄（来自档案），无档案为 None
 
 
 class HistoryService:
-    def __init__(self, db_url: str = "sqlite:///./data.db"):
-        # SQLite 持久化；check_same_thread=False 允许同一进程多协程访问。
-        self.engine = create_engine(db_url, connect_args={"check_same_thread": False})
+    def __init__(self, db_url: Optional[str] = None, write_behind: Optional[bool] = None):
+        # 共享 Engine；db_url 为空时使用 settings.DATABASE_URL（创建 Engine 不会连接数据库）
+        self.engine = get_engine(db_url)
+        self._fts = False  # 全文索引是否可用，由 init_db 设置
+        # 当前会话指针：user_id → 最近更新的 session_id（LRU 有界；多 worker 时最多滞后一个 TTL）
+        self._current = TTLCache(
+            max_entries=settings.CURRENT_SESSION_CACHE_MAX_ENTRIES, ttl=settings.CURRENT_SESSION_CACHE_TTL
+        )
+        if write_behind is None:
+            write_behind = settings.HISTORY_WRITE_BEHIND
+        self._writer: Optional[MessageWriteBehind] = None
+        if write_behind:
+            self._writer = MessageWriteBehind(
+                self._write_batch,
+                flush_interval=settings.HISTORY_FLUSH_INTERVAL_MS / 1000,
+                max_batch=settings.HISTORY_FLUSH_MAX_ROWS,
+            )
+
+    def init_db(self) -> None:
+        """
+        建表并执行轻量迁移（幂等，应用启动与维护命令开始时调用一次）
+
+        - 补齐新增的列与索引；新增反范式计数列时回填一次
+        - 旧库的表缺少 AUTOINCREMENT / 级联外键时重建（保留数据）
+        - 建立全文索引与同步触发器
+        """
         SQLModel.metadata.create_all(self.engine)
+        add_missing_columns(self.engine, MessageModel)
+        create_missing_indexes(self.engine, MessageModel)
+        create_missing_indexes(self.engine, SessionModel)
+        if "message_count" in add_missing_columns(self.engine, SessionModel):
+            self._backfill_session_counters()
+        for model, required in (
+            (MessageModel, ("AUTOINCREMENT", "ON DELETE CASCADE")),
+            (SessionSummaryModel, ("ON DELETE CASCADE",)),
+        ):
+            ddl = table_sql(self.engine, model.__tablename__).upper()
+            if any(marker not in ddl for marker in required):
+                rebuild_table(self.engine, model)
+        self._fts = _ensure_search_index(self.engine)
 
     def create_session(self, user_id: str) -> str:
         session_id = str(uuid.uuid4())
@@ -41,39 +268,222 @@ class HistoryService:
         with Session(self.engine) as session:
             session.add(model)
             session.commit()
+        self._current.set(user_id, session_id)
         return session_id
 
     def get_current_session(self, user_id: str) -> Optional[str]:
         # 当前会话定义：最近更新的会话（updated_at 最大）。
+        session_id = self._current.get(user_id)
+        if session_id is not None:
+            return session_id
+        return self._load_current_session(user_id)
+
+    def _load_current_session(self, user_id: str) -> Optional[str]:
+        # 指针未命中时查库并回填（调用方已查过指针缓存）
         with Session(self.engine) as session:
-            stmt = (
-                select(SessionModel)
-                .where(SessionModel.user_id == user_id)
-                .order_by(SessionModel.updated_at.desc())
-                .limit(1)
+            return self._current_session_id(session, user_id)
+
+    def _current_session_id(self, session: Session, user_id: str) -> Optional[str]:
+        stmt = (
+            select(SessionModel.session_id)
+            .where(SessionModel.user_id == user_id)
+            .order_by(SessionModel.updated_at.desc())
+            .limit(1)
+        )
+        session_id = session.exec(stmt).first()
+        if session_id is not None:
+            self._current.set(user_id, session_id)
+        return session_id
+
+    def _forget_current(self, user_id: str, session_id: Optional[str] = None) -> None:
+        # 会话被删除时清除指针（session_id 为空表示无条件清除）
+        if session_id is None or self._current.get(user_id) == session_id:
+            self._current.delete(user_id)
+
+    @traced("history.list_sessions")
+    def list_sessions(
+        self, user_id: str, limit: int = 100, before: Optional[str] = None
+    ) -> ListSessionsResponse:
+        """
+        列出用户的会话（最近更新的在前），含消息数与最后一条消息的预览
+
+        只读 SessionModel：在 (user_id, updated_at, session_id) 索引上倒序取 limit 条，
+        不访问消息表。before：上一页返回的 next_before 游标，按 (updated_at, session_id)
+        组合键翻页，updated_at 相同的会话不会在页边界被跳过。游标格式错误时抛出 ValueError。
+        """
+        self.flush()  # 计数在批量落库时更新
+        stmt = select(SessionModel).where(SessionModel.user_id == user_id)
+        if before is not None:
+            stmt = stmt.where(
+                tuple_(SessionModel.updated_at, SessionModel.session_id) < tuple_(*_parse_session_cursor(before))
             )
-            row = session.exec(stmt).first()
-            return row.session_id if row else None
+        stmt = stmt.order_by(SessionModel.updated_at.desc(), SessionModel.session_id.desc()).limit(limit + 1)
+        with Session(self.engine) as session:
+            rows = session.exec(stmt).all()
+        return ListSessionsResponse(
+            sessions=[
+                SessionListItem(
+                    session_id=r.session_id,
+                    message_count=r.message_count,
+                    last_message_preview=r.last_message_preview,
+                    last_message_at=r.last_message_at,
+                    created_at=r.created_at,
+                    updated_at=r.updated_at,
+                )
+                for r in rows[:limit]
+            ],
+            has_more=len(rows) > limit,
+            next_before=_session_cursor(rows[limit - 1].updated_at, rows[limit - 1].session_id)
+            if len(rows) > limit else None,
+        )
 
-    def add_message(self, user_id: str, session_id: str, message_data: AddMessageRequest) -> bool:
+    def add_message(
+        self, user_id: str, session_id: str, message_data: AddMessageRequest, truncated: bool = False
+    ) -> bool:
         with Session(self.engine) as session:
             sess = session.get(SessionModel, session_id)
             if not sess or sess.user_id != user_id:
                 return False
-            msg = MessageModel(
+            self._persist(session, sess, [PendingMessage(
                 session_id=session_id,
                 user_id=user_id,
                 role=message_data.role,
                 content=message_data.content,
                 timestamp=datetime.utcnow(),
-            )
-            sess.updated_at = msg.timestamp
-            session.add(msg)
-            session.add(sess)
-            session.commit()
+                truncated=truncated,
+            )])
+        return True
+
+    def record_turn(
+        self,
+        user_id: str,
+        session_id: str,
+        question: str,
+        reply: Optional[str],
+        truncated: bool = False,
+        asked_at: Optional[datetime] = None,
+    ) -> bool:
+        """
+        原子地记录一轮对话：用户问题 + AI 回答 + 会话更新时间，在同一个事务中提交
+
+        参数：
+            reply: AI 回答；为空（生成失败且无部分内容）时只记录用户问题
+            truncated: 回答是否不完整（流式中断）
+            asked_at: 提问时间（默认当前时间），使问题的时间戳早于回答
+        """
+        now = datetime.utcnow()
+        messages = [PendingMessage(session_id, user_id, "user", question, asked_at or now, False)]
+        if reply:
+            messages.append(PendingMessage(session_id, user_id, "assistant", reply, now, truncated))
+        with span("history.record_turn", chat_metrics.history_write.observe), Session(self.engine) as session:
+            sess = session.get(SessionModel, session_id)
+            if not sess or sess.user_id != user_id:
+                return False
+            self._persist(session, sess, messages)
         return True
 
-    def get_history(self, user_id: str, session_id: Optional[str] = None) -> Optional[GetHistoryResponse]:
+    def _persist(self, session: Session, sess: SessionModel, messages: List[PendingMessage]) -> None:
+        # 写缓冲模式：交给后台批量写入；否则在当前事务中写入并更新会话时间后提交（一次 fsync）
+        # 有新消息的会话即成为该用户的当前会话
+        self._current.set(sess.user_id, sess.session_id)
+        if self._writer is not None:
+            self._writer.enqueue(*messages)
+            return
+        session.add_all([MessageModel(**m._asdict()) for m in messages])
+        sess.updated_at = messages[-1].timestamp
+        sess.message_count += len(messages)
+        sess.last_message_preview = _preview(messages[-1].content)
+        sess.last_message_at = messages[-1].timestamp
+        session.add(sess)
+        with span("history.commit"):  # 含等待写锁与 fsync
+            session.commit()
+
+    def _backfill_session_counters(self) -> None:
+        # 新增反范式列后一次性回填：集合式 UPDATE（关联子查询走 session_id 索引）
+        live_count = (
+            select(func.count()).select_from(MessageModel)
+            .where(MessageModel.session_id == SessionModel.session_id).scalar_subquery()
+        )
+        archived_count = (
+            select(SessionArchiveModel.message_count)
+            .where(SessionArchiveModel.session_id == SessionModel.session_id).scalar_subquery()
+        )
+        last = (
+            select(MessageModel.content, MessageModel.timestamp)
+            .where(MessageModel.session_id == SessionModel.session_id)
+            .order_by(MessageModel.id.desc()).limit(1)
+        )
+        with Session(self.engine) as session:
+            session.execute(update(SessionModel).values(
+                message_count=live_count + func.coalesce(archived_count, 0),
+                last_message_preview=select(
+                    func.substr(func.replace(last.c.content, "\n", " "), 1, PREVIEW_CHARS)
+                ).scalar_subquery(),
+                last_message_at=select(last.c.timestamp).scalar_subquery(),
+            ))
+            # 只有归档、没有在线消息的会话：最后一条消息在归档里
+            for archive in session.exec(
+                select(SessionArchiveModel).join(SessionModel, SessionModel.session_id == SessionArchiveModel.session_id)
+                .where(SessionModel.last_message_at.is_(None))
+            ).all():
+                latest = decompress_messages(archive.codec, archive.payload)[-1]
+                session.execute(
+                    update(SessionModel).where(SessionModel.session_id == archive.session_id)
+                    .values(last_message_preview=_preview(latest.content), last_message_at=latest.timestamp)
+                )
+            session.commit()
+
+    def load_turn_context(self, user_id: str, session_id: Optional[str] = None, limit: int = 10) -> TurnContext:
+        """
+        一次读取一轮对话所需的全部上下文：会话 id、摘要、摘要之后最近 limit 条消息、孩子年龄
+
+        未指定 session_id 时使用当前会话，没有则新建。所有读取共用同一个连接。
+        三个步骤分别计入 session_resolve / history_load / profile_load 阶段耗时（见 modules/metrics），
+        同时作为 history.load_turn_context 下的追踪 span（见 modules/tracing）。
+        """
+        with span("history.load_turn_context"), Session(self.engine) as session:
+            with span("history.session_resolve", chat_metrics.session_resolve.observe):
+                if session_id is None:
+                    session_id = self._current.get(user_id)
+                    if session_id is not None and session.get(SessionModel, session_id) is None:
+                        # 指针已过时（会话被其他 worker 删除），回退到索引查询
+                        self._forget_current(user_id, session_id)
+                        session_id = None
+                    if session_id is None:
+                        session_id = self._current_session_id(session, user_id)
+                    if session_id is None:
+                        session_id = str(uuid.uuid4())
+                        session.add(SessionModel(session_id=session_id, user_id=user_id))
+                        session.commit()
+                        self._current.set(user_id, session_id)
+            with span("history.history_load", chat_metrics.history_load.observe):
+                summary, history = self._session_context(session, user_id, session_id, limit)
+            with span("history.profile_load", chat_metrics.profile_load.observe):
+                age = profile_service.get_age(user_id, session=session)
+            return TurnContext(session_id, summary, history, age)
+
+    @traced("history.get_history")
+    def get_history(
+        self,
+        user_id: str,
+        session_id: Optional[str] = None,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> Optional[GetHistoryResponse]:
+        """
+        查询会话历史；指定 before/after/limit 时按消息 id 做游标分页（keyset pagination）
+
+        - before=X：id < X 的消息中最新的 limit 条（向前翻页）
+        - after=X：id > X 的消息中最早的 limit 条（增量拉取新消息）
+        - 只给 limit：最新的 limit 条
+        - 均不指定：整个会话（兼容旧客户端）
+        每页内消息始终按从旧到新排列；has_more 表示翻页方向上是否还有更多消息。
+        分页直接在 session_id 索引上按 id 定位，耗时与会话总长度无关（不用 OFFSET）。
+        """
+        paged = before is not None or after is not None or limit is not None
+        if paged:
+            self.flush()  # 游标基于消息 id，写缓冲中的消息先落库以获得 id
         with Session(self.engine) as session:
             if session_id is None:
                 session_id = self.get_current_session(user_id)
@@ -82,70 +492,657 @@ class HistoryService:
             sess = session.get(SessionModel, session_id)
             if not sess or sess.user_id != user_id:
                 return None
-            msgs = (
-                session.exec(
-                    select(MessageModel)
+            columns = (
+                MessageModel.id, MessageModel.role, MessageModel.content,
+                MessageModel.timestamp, MessageModel.truncated,
+            )
+            has_more = False
+            if paged:
+                msgs, pending = self._history_page(session, session_id, columns, before, after, limit), []
+                archive = self._archive_meta(session, session_id)
+                if archive is not None:
+                    msgs = self._with_archived_page(session, session_id, archive, msgs, before, after, limit)
+                has_more = bool(limit) and len(msgs) > limit
+                msgs = msgs[:limit] if limit else msgs
+                if after is None:
+                    msgs.reverse()  # 倒序取出，按从旧到新返回
+                message_count = sess.message_count  # 反范式计数（写缓冲已在上面落库）
+            else:
+                msgs, pending = self._read_with_pending(session_id, lambda: session.exec(
+                    select(*columns)
                     .where(MessageModel.session_id == session_id)
                     .order_by(MessageModel.timestamp)
-                ).all()
-            )
+                ).all())
+                msgs = self._archived_messages(session, session_id) + list(msgs)
+                message_count = len(msgs) + len(pending)
             messages = [
-                Message(role=m.role, content=m.content, timestamp=m.timestamp) for m in msgs
+                Message(id=m.id, role=m.role, content=m.content, timestamp=m.timestamp, truncated=m.truncated)
+                for m in msgs
+            ] + [
+                Message(role=m.role, content=m.content, timestamp=m.timestamp, truncated=m.truncated)
+                for m in pending
             ]
             return GetHistoryResponse(
                 session_id=session_id,
                 messages=messages,
-                message_count=len(messages),
+                message_count=message_count,
                 created_at=sess.created_at,
                 updated_at=sess.updated_at,
+                has_more=has_more,
+            )
+
+    def _history_page(self, session: Session, session_id: str, columns, before, after, limit):
+        # 多取 1 条用于判断 has_more；after 方向升序，其余倒序
+        stmt = select(*columns).where(MessageModel.session_id == session_id)
+        if before is not None:
+            stmt = stmt.where(MessageModel.id < before)
+        if after is not None:
+            stmt = stmt.where(MessageModel.id > after).order_by(MessageModel.id)
+        else:
+            stmt = stmt.order_by(MessageModel.id.desc())
+        if limit:
+            stmt = stmt.limit(limit + 1)
+        return list(session.exec(stmt).all())
+
+    def _with_archived_page(self, session: Session, session_id: str, archive, msgs, before, after, limit):
+        # 归档消息的 id 都小于在线消息：升序（after）时排在前面，倒序时接在后面；
+        # 在线消息已足够一页（含用于判断 has_more 的 1 条）时不解压归档
+        if after is not None:
+            if after >= archive.max_message_id:
+                return msgs
+            older = [m for m in self._archived_messages(session, session_id) if m.id > after]
+            combined = older + msgs
+        else:
+            if limit and len(msgs) > limit:
+                return msgs
+            older = self._archived_messages(session, session_id)
+            if before is not None:
+                older = [m for m in older if m.id < before]
+            combined = msgs + older[::-1]
+        return combined[: limit + 1] if limit else combined
+
+    def _archive_meta(self, session: Session, session_id: str):
+        # 归档的 (message_count, max_message_id)，不读取压缩数据；未归档时返回 None
+        return session.exec(
+            select(SessionArchiveModel.message_count, SessionArchiveModel.max_message_id)
+            .where(SessionArchiveModel.session_id == session_id)
+        ).first()
+
+    def _archived_messages(self, session: Session, session_id: str) -> List[ArchivedMessage]:
+        # 解压该会话的归档消息（按 id 升序）；未归档时返回空列表
+        row = session.exec(
+            select(SessionArchiveModel.codec, SessionArchiveModel.payload)
+            .where(SessionArchiveModel.session_id == session_id)
+        ).first()
+        return decompress_messages(row.codec, row.payload) if row else []
+
+    def get_history_version(self, user_id: str, session_id: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        """
+        返回 (session_id, 版本串)，用于生成 ETag；会话不存在或不属于该用户时返回 None
+
+        版本串由会话更新时间与消息数（SessionModel 上的反范式计数）组成，只读会话表一行：
+        新增消息、清空会话都会改变它。
+        """
+        self.flush()  # 写缓冲中的消息也要体现在版本中
+        with Session(self.engine) as session:
+            if session_id is None:
+                session_id = self.get_current_session(user_id)
+                if session_id is None:
+                    return None
+            sess = session.get(SessionModel, session_id)
+            if not sess or sess.user_id != user_id:
+                return None
+            # 清空会话会更新 updated_at；归档不改变这些字段，归档前后客户端缓存仍然有效
+            return session_id, f"{sess.updated_at.isoformat()}|{sess.message_count}"
+
+    def get_session_context(
+        self, user_id: str, session_id: str, limit: int = 10
+    ) -> Tuple[Optional[str], List[dict]]:
+        """
+        读取构建对话上下文所需的数据：(摘要, 摘要之后最近 limit 条消息)
+
+        已被折叠进摘要的消息不再以原文返回，避免重复占用上下文。
+        """
+        with Session(self.engine) as session:
+            return self._session_context(session, user_id, session_id, limit)
+
+    def _session_context(
+        self, session: Session, user_id: str, session_id: str, limit: int
+    ) -> Tuple[Optional[str], List[dict]]:
+        sess = session.get(SessionModel, session_id)
+        if not sess or sess.user_id != user_id:
+            return None, []
+        summary = session.get(SessionSummaryModel, session_id)
+        covered_until_id = summary.covered_until_id if summary else 0
+        rows, pending = self._read_with_pending(session_id, lambda: session.exec(
+            # "+ 0" 让 SQLite 不把 id 条件用作索引范围（否则会改走单列索引再临时排序）
+            self._tail_query(session_id, limit).where(MessageModel.id + 0 > covered_until_id)
+        ).all())
+        rows = self._with_archived_tail(session, session_id, rows, limit, covered_until_id)
+        return (summary.summary if summary else None), self._merge_tail(rows, pending, limit)
+
+    def get_messages_to_summarize(
+        self, session_id: str, keep_recent: int
+    ) -> Tuple[Optional[str], List[MessageModel]]:
+        """
+        返回 (已有摘要, 待折叠的消息)：摘要之后、且不在最近 keep_recent 条之内的消息
+
+        折叠位置用消息 id 记录，因此先把写缓冲中的消息落库（后台任务中执行，不影响对话延迟）。
+        """
+        self.flush()
+        with Session(self.engine) as session:
+            summary = session.get(SessionSummaryModel, session_id)
+            covered_until_id = summary.covered_until_id if summary else 0
+            rows = session.exec(
+                select(MessageModel)
+                .where(MessageModel.session_id == session_id, MessageModel.id > covered_until_id)
+                .order_by(MessageModel.id)
+            ).all()
+            pending = rows[:-keep_recent] if keep_recent else rows
+            return (summary.summary if summary else None), list(pending)
+
+    def save_summary(self, session_id: str, summary: str, covered_until_id: int) -> None:
+        with Session(self.engine) as session:
+            if not session.get(SessionModel, session_id):
+                return  # 会话已被删除（摘要在后台生成期间）
+            model = session.get(SessionSummaryModel, session_id) or SessionSummaryModel(
+                session_id=session_id, summary=summary
+            )
+            model.summary = summary
+            model.covered_until_id = covered_until_id
+            model.updated_at = datetime.utcnow()
+            session.add(model)
+            session.commit()
+
+    def _tail_query(self, session_id: str, limit: int):
+        # 只取 role/content 两列，倒序取 limit 条（命中 ix_messagemodel_session_ts，无需排序）
+        return (
+            select(MessageModel.role, MessageModel.content)
+            .where(MessageModel.session_id == session_id)
+            .order_by(MessageModel.timestamp.desc(), MessageModel.id.desc())
+            .limit(limit)
+        )
+
+    def _with_archived_tail(
+        self, session: Session, session_id: str, rows, limit: int, covered_until_id: int = 0
+    ) -> list:
+        # rows 为倒序的 (role, content)；在线消息不足 limit 条时（会话刚从归档中恢复对话）用归档补齐
+        if len(rows) >= limit:
+            return rows
+        older = [
+            (m.role, m.content)
+            for m in reversed(self._archived_messages(session, session_id))
+            if m.id > covered_until_id
+        ]
+        return list(rows) + older[: limit - len(rows)]
+
+    def _read_with_pending(self, session_id: str, read):
+        # 返回 (数据库读取结果, 该会话尚未落库的消息)；未开启写缓冲时后者为空
+        if self._writer is None:
+            return read(), []
+        return self._writer.read_consistent(session_id, read)
+
+    def _merge_tail(self, rows, pending: List[PendingMessage], limit: int) -> List[dict]:
+        # rows 为倒序的 (role, content)；未落库的消息一定更新，接在末尾后再截取最近 limit 条
+        messages = [{"role": role, "content": content} for role, content in reversed(rows)]
+        messages += [{"role": m.role, "content": m.content} for m in pending]
+        return messages[-limit:] if limit > 0 else []
+
+    def _write_batch(self, batch: List[PendingMessage]) -> None:
+        # 写缓冲的批量落库：一个事务（一次 fsync）写入整批消息并更新各会话的 updated_at
+        with self.engine.begin() as conn:
+            session_ids = {m.session_id for m in batch}
+            existing = set(conn.execute(
+                select(SessionModel.session_id).where(SessionModel.session_id.in_(session_ids))
+            ).scalars())
+            rows = [m._asdict() for m in batch if m.session_id in existing]  # 跳过期间已删除的会话
+            if not rows:
+                return
+            conn.execute(insert(MessageModel), rows)
+            latest = {}
+            for row in rows:
+                counters = latest.setdefault(row["session_id"], {"sid": row["session_id"], "n": 0})
+                counters.update(n=counters["n"] + 1, ts=row["timestamp"], preview=_preview(row["content"]))
+            conn.execute(
+                update(SessionModel)
+                .where(SessionModel.session_id == bindparam("sid"))
+                .values(
+                    updated_at=bindparam("ts"),
+                    message_count=SessionModel.message_count + bindparam("n"),
+                    last_message_preview=bindparam("preview"),
+                    last_message_at=bindparam("ts"),
+                ),
+                list(latest.values()),
             )
 
+    def flush(self) -> int:
+        """把写缓冲中的消息立即落库（未开启写缓冲时为空操作），返回写入条数"""
+        return self._writer.flush() if self._writer is not None else 0
+
+    def close(self) -> None:
+        """应用关闭时调用：停止后台写入线程并落库剩余消息"""
+        if self._writer is not None:
+            self._writer.close()
+
+    @traced("history.get_messages_for_api")
     def get_messages_for_api(self, user_id: str, session_id: Optional[str] = None, limit: int = 10) -> List[dict]:
-        history = self.get_history(user_id, session_id)
-        if not history:
-            return []
-        messages = history.messages[-limit:]
-        return [{"role": msg.role, "content": msg.content} for msg in messages]
+        # 最近 limit 条消息（从旧到新），直接返回 LLM 所需的 dict，不构造 Pydantic 对象。
+        if session_id is None:
+            session_id = self.get_current_session(user_id)
+            if session_id is None:
+                return []
+        with Session(self.engine) as session:
+            sess = session.get(SessionModel, session_id)
+            if not sess or sess.user_id != user_id:
+                return []
+            rows, pending = self._read_with_pending(
+                session_id, lambda: session.exec(self._tail_query(session_id, limit)).all()
+            )
+            rows = self._with_archived_tail(session, session_id, rows, limit)
+        return self._merge_tail(rows, pending, limit)
 
     def clear_session(self, user_id: str, session_id: str) -> bool:
+        """
+        清空会话的消息（保留会话本身）
+
+        先分批删除截至当前最大 id 的消息，再在一个事务中写墓碑并重置计数：
+        两步之间新写入的消息 id 更大，既不会被删除，也不在墓碑范围内，计数按它们重算。
+        """
+        self.flush()  # 先落库缓冲中的消息，避免清空后又被写回
         with Session(self.engine) as session:
             sess = session.get(SessionModel, session_id)
             if not sess or sess.user_id != user_id:
                 return False
-            # 清空消息表中对应会话的记录。
-            session.exec(select(MessageModel).where(MessageModel.session_id == session_id))
-            session.exec("DELETE FROM messagemodel WHERE session_id = :sid", {"sid": session_id})
+            up_to = self._session_max_message_id(session, session_id)
+        self._delete_messages_in_batches(MessageModel.session_id == session_id, up_to)
+        with Session(self.engine) as session:
+            sess = session.get(SessionModel, session_id)
+            if not sess:  # 期间会话已被删除（删除操作自己写了墓碑）
+                return False
+            session.add(HistoryTombstoneModel(
+                user_id=user_id, session_id=session_id, kind="clear", up_to_message_id=up_to
+            ))
+            # 消息清空后摘要与归档也随之失效。
+            session.execute(delete(SessionSummaryModel).where(SessionSummaryModel.session_id == session_id))
+            session.execute(delete(SessionArchiveModel).where(SessionArchiveModel.session_id == session_id))
+            remaining = session.exec(
+                select(func.count()).select_from(MessageModel).where(MessageModel.session_id == session_id)
+            ).one()
+            latest = session.exec(
+                select(MessageModel.content, MessageModel.timestamp)
+                .where(MessageModel.session_id == session_id)
+                .order_by(MessageModel.id.desc()).limit(1)
+            ).first()
             sess.updated_at = datetime.utcnow()
+            sess.message_count = remaining
+            sess.last_message_preview = _preview(latest.content) if latest else None
+            sess.last_message_at = latest.timestamp if latest else None
             session.add(sess)
             session.commit()
-            return True
+        self._current.set(user_id, session_id)
+        return True
 
     def delete_session(self, user_id: str, session_id: str) -> bool:
+        self.flush()
         with Session(self.engine) as session:
             sess = session.get(SessionModel, session_id)
             if not sess or sess.user_id != user_id:
                 return False
-            # 先删消息，再删会话元数据。
-            session.exec("DELETE FROM messagemodel WHERE session_id = :sid", {"sid": session_id})
-            session.delete(sess)
-            session.commit()
-            return True
+            up_to = self._session_max_message_id(session, session_id)
+        # 先分批删除消息，再在一个事务中写墓碑并删除会话元数据
+        # （摘要及期间新写入的消息由外键级联删除，墓碑在同一事务中计入它们）。
+        self._delete_messages_in_batches(MessageModel.session_id == session_id, up_to)
+        self._delete_sessions_in_batches(SessionModel.session_id == session_id)
+        self._forget_current(user_id, session_id)
+        return True
 
     def delete_all_sessions(self, user_id: str) -> bool:
+        """
+        删除用户的所有会话（集合式 SQL，按 user_id 分批删除）
+
+        每批最多 DB_DELETE_BATCH_SIZE 行、单独提交，大批量清理时不会长时间占用写锁；
+        中途失败时重新调用即可继续完成。
+        """
+        self.flush()
+        self._forget_current(user_id)
         with Session(self.engine) as session:
-            sessions = session.exec(select(SessionModel).where(SessionModel.user_id == user_id)).all()
-            if not sessions:
+            up_to = session.exec(
+                select(func.coalesce(func.max(MessageModel.id), 0)).where(MessageModel.user_id == user_id)
+            ).one()
+        self._delete_messages_in_batches(MessageModel.user_id == user_id, up_to)
+        return self._delete_sessions_in_batches(SessionModel.user_id == user_id) > 0
+
+    def _delete_messages_in_batches(self, condition, up_to: int) -> int:
+        # 只删 id ≤ up_to 的消息：删除期间新写入的消息留给后续步骤（墓碑 / 级联删除）处理
+        return self._delete_in_batches(MessageModel, and_(condition, MessageModel.id <= up_to))
+
+    def _delete_sessions_in_batches(self, condition) -> int:
+        # 每批一个事务：先用 INSERT ... SELECT 写墓碑（记录此刻各会话的最大消息 id），
+        # 再删除会话行，级联删除的消息都在墓碑范围内
+        batch_size = settings.DB_DELETE_BATCH_SIZE
+        total = 0
+        while True:
+            with Session(self.engine) as session:
+                session_ids = session.exec(
+                    select(SessionModel.session_id).where(condition).limit(batch_size)
+                ).all()
+                if session_ids:
+                    session.execute(
+                        insert(HistoryTombstoneModel).from_select(
+                            ["user_id", "session_id", "kind", "up_to_message_id", "deleted_at"],
+                            select(
+                                SessionModel.user_id, SessionModel.session_id, literal("delete"),
+                                self._max_message_id(), literal(datetime.utcnow()),
+                            ).where(SessionModel.session_id.in_(session_ids)),
+                        )
+                    )
+                    session.execute(delete(SessionModel).where(SessionModel.session_id.in_(session_ids)))
+                    session.commit()
+            total += len(session_ids)
+            if len(session_ids) < batch_size:
+                return total
+
+    def _delete_in_batches(self, model, condition) -> int:
+        # DELETE ... WHERE rowid IN (SELECT rowid ... LIMIT n)：每批一个短事务，直到删完
+        batch_size = settings.DB_DELETE_BATCH_SIZE
+        rowid = literal_column("rowid")
+        total = 0
+        while True:
+            with Session(self.engine) as session:
+                batch = select(rowid).select_from(model).where(condition).limit(batch_size)
+                deleted = session.execute(
+                    delete(model).where(rowid.in_(batch.scalar_subquery()))
+                ).rowcount
+                session.commit()
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+    def _max_message_id(self):
+        # 关联子查询：外层 SessionModel 行对应会话的最大消息 id（在线消息或归档，取较大者）
+        live = (
+            select(func.max(MessageModel.id))
+            .where(MessageModel.session_id == SessionModel.session_id)
+            .scalar_subquery()
+        )
+        archived = (
+            select(SessionArchiveModel.max_message_id)
+            .where(SessionArchiveModel.session_id == SessionModel.session_id)
+            .scalar_subquery()
+        )
+        return func.max(func.coalesce(live, 0), func.coalesce(archived, 0))
+
+    def _session_max_message_id(self, session: Session, session_id: str) -> int:
+        return session.exec(
+            select(self._max_message_id()).where(SessionModel.session_id == session_id)
+        ).one()
+
+    def archive_idle_sessions(self, idle_days: float, limit: int) -> Tuple[int, int]:
+        """
+        归档最多 limit 个超过 idle_days 天无活动、且仍有在线消息的会话，返回 (挑选数, 实际归档数)
+
+        由维护命令分批调用（见 maintenance.py）；每个会话单独一个事务。
+        挑选后又有了新消息、或已被删除的会话会被跳过，因此实际归档数可能小于挑选数。
+        """
+        self.flush()
+        cutoff = datetime.utcnow() - timedelta(days=idle_days)
+        with Session(self.engine) as session:
+            has_messages = select(MessageModel.id).where(MessageModel.session_id == SessionModel.session_id).exists()
+            session_ids = session.exec(
+                select(SessionModel.session_id)
+                .where(SessionModel.updated_at < cutoff, has_messages)
+                .order_by(SessionModel.updated_at)
+                .limit(limit)
+            ).all()
+        return len(session_ids), sum(self.archive_session(sid, cutoff) for sid in session_ids)
+
+    def archive_session(self, session_id: str, idle_before: Optional[datetime] = None) -> bool:
+        """
+        把会话的在线消息并入压缩归档（与已有归档合并），并删除这些消息行
+
+        idle_before：会话在此时间之后有过活动则跳过（挑选与归档之间又有了新消息）。
+        归档期间新写入的消息 id 更大，不会被删除，读取时与归档拼接。
+        """
+        with Session(self.engine) as session:
+            sess = session.get(SessionModel, session_id)
+            if not sess or (idle_before is not None and sess.updated_at >= idle_before):
+                return False
+            live = [
+                ArchivedMessage(*row) for row in session.exec(
+                    select(
+                        MessageModel.id, MessageModel.role, MessageModel.content,
+                        MessageModel.timestamp, MessageModel.truncated,
+                    )
+                    .where(MessageModel.session_id == session_id)
+                    .order_by(MessageModel.id)
+                ).all()
+            ]
+            if not live:
                 return False
-            session_ids = [s.session_id for s in sessions]
-            # 批量删除该用户下所有消息与会话。
-            session.exec(
-                "DELETE FROM messagemodel WHERE session_id IN (:ids)",
-                {"ids": tuple(session_ids)},
+            messages = self._archived_messages(session, session_id) + live
+            codec, payload, raw_bytes = compress_messages(messages)
+            archive = session.get(SessionArchiveModel, session_id) or SessionArchiveModel(
+                session_id=session_id, codec=codec, message_count=0, max_message_id=0, raw_bytes=0, payload=b""
+            )
+            archive.codec = codec
+            archive.payload = payload
+            archive.raw_bytes = raw_bytes
+            archive.message_count = len(messages)
+            archive.max_message_id = live[-1].id
+            archive.archived_at = datetime.utcnow()
+            session.add(archive)
+            session.execute(
+                delete(MessageModel).where(MessageModel.session_id == session_id, MessageModel.id <= live[-1].id)
             )
-            for s in sessions:
-                session.delete(s)
             session.commit()
-            return True
+        return True
+
+    @traced("history.search_messages")
+    def search_messages(self, user_id: str, query: str, limit: int = 20, offset: int = 0) -> HistorySearchResponse:
+        """
+        在用户的全部会话中搜索消息，按相关度（bm25）返回命中片段
+
+        多个词（空格分隔）需全部命中。三个字及以上的词走 FTS5 trigram 索引，
+        耗时取决于命中数而不是消息总量；更短的词在索引结果上（或该用户的全部消息中）用 LIKE 过滤。
+        """
+        terms = query.split()
+        if not terms:
+            return HistorySearchResponse(query=query)
+        indexed = [t for t in terms if len(t) >= 3]
+        short = [t for t in terms if len(t) < 3]
+        self.flush()  # 写缓冲中的消息落库后才进入索引
+        with Session(self.engine) as session:
+            if self._fts and indexed:
+                # 索引不区分用户：命中行按 rowid 回表后再按 user_id 过滤
+                match = " AND ".join(_fts_phrase(t) for t in indexed)
+                params = {"match": match, "user_id": user_id, "limit": limit + 1, "offset": offset}
+                like = ""
+                for i, term in enumerate(short):
+                    like += f" AND m.content LIKE :like{i} ESCAPE '\\'"
+                    params[f"like{i}"] = _like_pattern(term)
+                rows = session.execute(text(
+                    "SELECT m.id, m.session_id, m.role, m.timestamp, "
+                    f"snippet(messagefts, 0, '{SNIPPET_OPEN}', '{SNIPPET_CLOSE}', '…', {SNIPPET_CHARS}) AS snippet "
+                    "FROM messagefts JOIN messagemodel m ON m.id = messagefts.rowid "
+                    f"WHERE messagefts MATCH :match AND m.user_id = :user_id{like} "
+                    "ORDER BY rank LIMIT :limit OFFSET :offset"
+                ).columns(timestamp=DateTime), params).all()
+                hits = [
+                    HistorySearchHit(
+                        message_id=r.id, session_id=r.session_id, role=r.role, timestamp=r.timestamp,
+                        snippet=r.snippet,
+                    )
+                    for r in rows
+                ]
+            else:
+                # 只有短词（或 FTS5 不可用）：在该用户的消息中 LIKE 过滤，最新的在前
+                stmt = select(
+                    MessageModel.id, MessageModel.session_id, MessageModel.role,
+                    MessageModel.timestamp, MessageModel.content,
+                ).where(MessageModel.user_id == user_id)
+                for term in terms:
+                    stmt = stmt.where(MessageModel.content.like(_like_pattern(term), escape="\\"))
+                rows = session.exec(stmt.order_by(MessageModel.id.desc()).offset(offset).limit(limit + 1)).all()
+                hits = [
+                    HistorySearchHit(
+                        message_id=r.id, session_id=r.session_id, role=r.role, timestamp=r.timestamp,
+                        snippet=_like_snippet(r.content, terms[0]),
+                    )
+                    for r in rows
+                ]
+        return HistorySearchResponse(query=query, hits=hits[:limit], has_more=len(hits) > limit)
+
+    @traced("history.get_changes")
+    def get_changes(
+        self, user_id: str, since: Optional[str] = None, session_id: Optional[str] = None, limit: int = 100
+    ) -> HistoryChangesResponse:
+        """
+        增量同步：返回游标 since 之后的新消息与删除记录，以及新的游标
+
+        - since 为空：首次同步，返回全部消息（不返回历史墓碑）
+        - session_id：只同步该会话（默认同步该用户的所有会话）
+        - 消息每次最多 limit 条（按 id 升序），has_more=True 时客户端应带新游标继续拉取
+        - 已归档的消息不在此返回：归档只针对长期无活动的会话，其消息通常早已同步过；
+          首次同步的新设备可用 get_history 分页读取
+        游标格式错误时抛出 ValueError。
+        """
+        message_cursor, tombstone_cursor = _parse_cursor(since) if since else (0, 0)
+        self.flush()  # 游标基于消息 id，写缓冲中的消息先落库
+        # 两次读取在同一个读事务中完成（WAL 快照），消息与墓碑互相一致
+        with Session(self.engine) as session:
+            stmt = (
+                select(
+                    MessageModel.id, MessageModel.session_id, MessageModel.role, MessageModel.content,
+                    MessageModel.timestamp, MessageModel.truncated,
+                )
+                .where(MessageModel.user_id == user_id, MessageModel.id > message_cursor)
+                .order_by(MessageModel.id)
+                .limit(limit + 1)
+            )
+            if session_id is not None:
+                stmt = stmt.where(MessageModel.session_id == session_id)
+            rows = session.exec(stmt).all()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+
+            tombstones = []
+            if since:
+                tomb_stmt = (
+                    select(HistoryTombstoneModel)
+                    .where(HistoryTombstoneModel.user_id == user_id, HistoryTombstoneModel.id > tombstone_cursor)
+                    .order_by(HistoryTombstoneModel.id)
+                )
+                if session_id is not None:
+                    tomb_stmt = tomb_stmt.where(HistoryTombstoneModel.session_id == session_id)
+                tombstones = session.exec(tomb_stmt).all()
+                if tombstones:
+                    tombstone_cursor = tombstones[-1].id
+            else:
+                tombstone_cursor = session.exec(
+                    select(func.coalesce(func.max(HistoryTombstoneModel.id), 0))
+                    .where(HistoryTombstoneModel.user_id == user_id)
+                ).one()
+
+        if rows:
+            message_cursor = rows[-1].id
+        return HistoryChangesResponse(
+            cursor=f"{message_cursor}.{tombstone_cursor}",
+            messages=[
+                SyncedMessage(
+                    id=r.id, session_id=r.session_id, role=r.role, content=r.content,
+                    timestamp=r.timestamp, truncated=r.truncated,
+                )
+                for r in rows
+            ],
+            deletions=[
+                HistoryDeletion(
+                    session_id=t.session_id, kind=t.kind,
+                    up_to_message_id=t.up_to_message_id, deleted_at=t.deleted_at,
+                )
+                for t in tombstones
+            ],
+            has_more=has_more,
+        )
+
+    # ========== 异步接口（数据库线程池中执行，不阻塞事件循环） ==========
+
+    async def create_session_async(self, user_id: str) -> str:
+        return await run_in_db(self.create_session, user_id)
+
+    async def list_sessions_async(
+        self, user_id: str, limit: int = 100, before: Optional[str] = None
+    ) -> ListSessionsResponse:
+        return await run_in_db(self.list_sessions, user_id, limit, before)
+
+    async def get_current_session_async(self, user_id: str) -> Optional[str]:
+        # 指针命中时直接返回，不必切换到数据库线程
+        session_id = self._current.get(user_id)
+        if session_id is not None:
+            return session_id
+        return await run_in_db(self._load_current_session, user_id)
+
+    async def add_message_async(
+        self, user_id: str, session_id: str, message_data: AddMessageRequest, truncated: bool = False
+    ) -> bool:
+        return await run_in_db(self.add_message, user_id, session_id, message_data, truncated)
+
+    async def record_turn_async(
+        self,
+        user_id: str,
+        session_id: str,
+        question: str,
+        reply: Optional[str],
+        truncated: bool = False,
+        asked_at: Optional[datetime] = None,
+    ) -> bool:
+        return await run_in_db(self.record_turn, user_id, session_id, question, reply, truncated, asked_at)
+
+    async def load_turn_context_async(
+        self, user_id: str, session_id: Optional[str] = None, limit: int = 10
+    ) -> TurnContext:
+        return await run_in_db(self.load_turn_context, user_id, session_id, limit)
+
+    async def get_history_async(
+        self,
+        user_id: str,
+        session_id: Optional[str] = None,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> Optional[GetHistoryResponse]:
+        return await run_in_db(self.get_history, user_id, session_id, before, after, limit)
+
+    async def get_history_version_async(
+        self, user_id: str, session_id: Optional[str] = None
+    ) -> Optional[Tuple[str, str]]:
+        return await run_in_db(self.get_history_version, user_id, session_id)
+
+    async def search_messages_async(
+        self, user_id: str, query: str, limit: int = 20, offset: int = 0
+    ) -> HistorySearchResponse:
+        return await run_in_db(self.search_messages, user_id, query, limit, offset)
+
+    async def get_changes_async(
+        self, user_id: str, since: Optional[str] = None, session_id: Optional[str] = None, limit: int = 100
+    ) -> HistoryChangesResponse:
+        return await run_in_db(self.get_changes, user_id, since, session_id, limit)
+
+    async def get_messages_to_summarize_async(
+        self, session_id: str, keep_recent: int
+    ) -> Tuple[Optional[str], List[MessageModel]]:
+        return await run_in_db(self.get_messages_to_summarize, session_id, keep_recent)
+
+    async def save_summary_async(self, session_id: str, summary: str, covered_until_id: int) -> None:
+        return await run_in_db(self.save_summary, session_id, summary, covered_until_id)
+
+    async def clear_session_async(self, user_id: str, session_id: str) -> bool:
+        return await run_in_db(self.clear_session, user_id, session_id)
+
+    async def delete_session_async(self, user_id: str, session_id: str) -> bool:
+        return await run_in_db(self.delete_session, user_id, session_id)
+
+    async def delete_all_sessions_async(self, user_id: str) -> bool:
+        return await run_in_db(self.delete_all_sessions, user_id)
 
 
 history_service = HistoryService()
@@ -0,0 +1,89 @@
+"""
+对话历史管理模块 - 滚动摘要（后台任务）
+
+C++ 视角速览：
+- 长对话中，较早的消息超出上下文后会被丢弃；全部发送又慢又贵。
+- ConversationSummarizer 在每轮对话结束后由适配器调度（schedule），在后台把
+  “最近 N 条之前”的旧消息连同已有摘要一起交给 LLM，折叠成新的摘要存入 SessionSummaryModel。
+- 构建上下文时发送：System Prompt + 摘要 + 摘要之后的最近消息，提示词长度不再随对话增长。
+- 同一会话同时只运行一个摘要任务；失败仅放弃本次摘要，不影响对话本身。
+"""
+from typing import Dict, List, Optional
+import asyncio
+import logging
+
+from config import settings
+from modules.chat.llm import llm_client_manager
+from .service import MessageModel, history_service
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = (
+    "你是对话记录整理助手。请把家长与育儿顾问之间的对话压缩成一段摘要，供顾问后续继续咨询时参考。\n"
+    "需要保留：孩子的年龄、性格等背景；事件经过与关键细节；家长的主要困惑和情绪；顾问已经给出的核心建议。\n"
+    "使用第三人称陈述，不要编造对话中没有的信息，不超过 300 字。"
+)
+
+_ROLE_LABELS = {"user": "家长", "assistant": "顾问"}
+
+
+def build_summary_prompt(previous_summary: Optional[str], messages: List[MessageModel]) -> str:
+    lines = [f"{_ROLE_LABELS.get(m.role, m.role)}：{m.content}" for m in messages]
+    parts = []
+    if previous_summary:
+        parts.append(f"已有摘要：\n{previous_summary}")
+    parts.append("新增对话：\n" + "\n".join(lines))
+    return "\n\n".join(parts)
+
+
+class ConversationSummarizer:
+    def __init__(self, keep_recent: int, trigger_messages: int, enabled: bool = True):
+        self.enabled = enabled
+        self.keep_recent = keep_recent  # 始终以原文保留的最近消息条数
+        self.trigger_messages = trigger_messages  # 待折叠消息达到该数量才触发摘要
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def schedule(self, session_id: str) -> None:
+        """在后台为会话安排一次摘要（已有任务在运行时跳过）"""
+        if not self.enabled or session_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(session_id))
+        self._tasks[session_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(session_id, None))
+
+    async def _run(self, session_id: str) -> None:
+        try:
+            previous, pending = await history_service.get_messages_to_summarize_async(session_id, self.keep_recent)
+            if len(pending) < self.trigger_messages:
+                return
+            client = llm_client_manager.client
+            response = await client.chat.completions.create(
+                model=settings.MODEL_NAME,
+                messages=[
+                    {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                    {"role": "user", "content": build_summary_prompt(previous, pending)},
+                ],
+                temperature=0.3,  # 摘要以忠实为主，降低随机性
+                max_tokens=settings.SUMMARY_MAX_TOKENS,
+                timeout=settings.LLM_TIMEOUT,
+            )
+            summary = (response.choices[0].message.content or "").strip()
+            if summary:
+                await history_service.save_summary_async(session_id, summary, covered_until_id=pending[-1].id)
+        except Exception:
+            # 后台任务的异常没有调用方接收：读库、调用模型或保存失败都在此记录
+            logger.exception("会话摘要生成失败：session_id=%s", session_id)
+
+    async def shutdown(self) -> None:
+        # 关闭时取消未完成的摘要任务（下一轮对话会重新触发）
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+summarizer = ConversationSummarizer(
+    keep_recent=settings.SUMMARY_KEEP_RECENT,
+    trigger_messages=settings.SUMMARY_TRIGGER_MESSAGES,
+    enabled=settings.SUMMARY_ENABLED,
+)
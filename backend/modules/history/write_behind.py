@@ -0,0 +1,140 @@
+"""
+对话历史管理模块 - 消息写缓冲（write-behind）
+
+C++ 视角速览：
+- 默认每条消息单独开事务提交，一轮对话（用户消息 + AI 回复）就要两次 fsync。
+- 开启 HISTORY_WRITE_BEHIND 后，add_message 只把消息放入内存队列（类似生产者-消费者的
+  std::deque + std::condition_variable），后台线程在首条消息入队后等待几毫秒或攒满 N 条时
+  在一个事务里批量写入；队列为空时线程阻塞在条件变量上，不做周期性唤醒。
+- 顺序保证：单一 FIFO 队列 + 单一写入线程，同一会话的消息按入队顺序落库（自增 id 同序）。
+- 读己之写：读取最近消息时把队列中尚未落库的消息合并进结果。为避免批次提交前后
+  “两边都读到 / 两边都没读到”，用版本号做乐观校验（类似 seqlock）：读期间发生过提交则重读。
+- 关闭时（应用 lifespan 结束或进程退出）把剩余消息全部写入。
+"""
+from typing import Callable, List, NamedTuple, Optional, Tuple, TypeVar
+from datetime import datetime
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MAX_RETRY_BACKOFF = 5.0  # 写入失败后重试间隔的上限（秒）
+
+
+class PendingMessage(NamedTuple):
+    session_id: str
+    user_id: str
+    role: str
+    content: str
+    timestamp: datetime
+    truncated: bool
+
+
+class MessageWriteBehind:
+    def __init__(
+        self,
+        write_batch: Callable[[List[PendingMessage]], None],
+        flush_interval: float,
+        max_batch: int,
+    ):
+        self._write_batch = write_batch  # 在一个事务中写入一批消息（由 HistoryService 提供）
+        self.flush_interval = flush_interval  # 秒
+        self.max_batch = max_batch
+        self._pending: List[PendingMessage] = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # 后台线程与手动 flush 互斥
+        # 版本号：批次开始写入时 +1（奇数），提交并移出队列后再 +1（偶数）
+        self._generation = 0
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def enqueue(self, *messages: PendingMessage) -> None:
+        # 同一次调用的多条消息（如一轮对话的问与答）一起入队，总在同一批次中落库
+        with self._cond:
+            was_empty = not self._pending
+            self._pending.extend(messages)
+            if self._thread is None:
+                self._start()
+            # 队列由空变为非空（唤醒空闲的写入线程开始计时）或攒满一批时通知
+            if was_empty or len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+
+    def read_consistent(self, session_id: str, read: Callable[[], T]) -> Tuple[T, List[PendingMessage]]:
+        """
+        执行一次数据库读取，并返回 (读取结果, 该会话尚未落库的消息)
+
+        两者保证互不重叠且无遗漏：读取期间若有批次提交，则整体重试。
+        """
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._generation % 2 == 0)
+                generation = self._generation
+                pending = [m for m in self._pending if m.session_id == session_id]
+            result = read()
+            with self._cond:
+                if self._generation == generation:
+                    return result, pending
+
+    def flush(self) -> int:
+        """立即把队列中的消息写入数据库，返回写入条数（失败时保留在队列中并抛出异常）"""
+        with self._flush_lock:
+            with self._cond:
+                batch = list(self._pending)
+                if not batch:
+                    return 0
+                self._generation += 1
+            committed = False
+            try:
+                self._write_batch(batch)
+                committed = True
+            finally:
+                with self._cond:
+                    if committed:
+                        # 写入期间新入队的消息都在 batch 之后
+                        del self._pending[: len(batch)]
+                    self._generation += 1
+                    self._cond.notify_all()
+            return len(batch)
+
+    def close(self) -> None:
+        # 停止后台线程并写入剩余消息；可重复调用
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def _start(self) -> None:
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="history-write-behind", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        backoff = 0.0  # 连续写入失败时的重试间隔（秒），成功后归零
+        while True:
+            with self._cond:
+                # 空闲时一直阻塞，直到有消息入队或关闭（不做周期性唤醒）
+                self._cond.wait_for(lambda: self._closed or self._pending)
+                # 有消息后最多再等一个周期，攒满一批则提前写入
+                self._cond.wait_for(
+                    lambda: self._closed or len(self._pending) >= self.max_batch,
+                    timeout=self.flush_interval,
+                )
+                if self._closed:
+                    self._thread = None
+                    return
+            try:
+                self.flush()
+                backoff = 0.0
+            except Exception:
+                # 数据库被锁、磁盘满等：指数退避后重试（队列已满时不会空转刷日志），关闭时立即结束等待
+                backoff = min(max(backoff * 2, self.flush_interval, 0.05), MAX_RETRY_BACKOFF)
+                logger.exception("历史消息批量写入失败，%.2f 秒后重试", backoff)
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed, timeout=backoff)
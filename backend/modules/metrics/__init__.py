@@ -0,0 +1,8 @@
+"""
+运行指标模块
+
+功能：GET /metrics 以 Prometheus 文本格式输出对话各阶段耗时、token 数、缓存命中、上游错误与在途请求数
+"""
+from .routes import register_routes
+
+__all__ = ["register_routes"]
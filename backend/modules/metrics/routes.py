@@ -0,0 +1,63 @@
+"""
+运行指标模块 - API 路由
+
+C++ 程序员理解：
+- GET /metrics 供 Prometheus 定期抓取（文本格式 0.0.4），不做业务处理
+- 接口本身不鉴权，默认不注册（METRICS_ENABLED=false）；开启后应只对内网/抓取端开放
+- 缓存命中等已有统计在抓取时才读取（采集函数），不给热路径增加任何开销
+"""
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from config import settings
+from modules.chat.cache import response_cache
+from modules.chat.singleflight import singleflight
+from modules.profile.service import profile_service
+from .service import family, registry
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _cache_samples():
+    caches = {"response": response_cache.stats(), "profile": profile_service.cache_stats()}
+    for kind in ("hits", "misses"):
+        yield from family(
+            f"cache_{kind}_total", "counter", f"Cache {kind} by cache",
+            [([("cache", name)], stats.get(kind, 0)) for name, stats in caches.items()],
+        )
+    flights = singleflight.stats()
+    yield from family(
+        "chat_coalesced_requests_total", "counter", "Requests served by joining an identical in-flight upstream call",
+        [((), flights["coalesced"])],
+    )
+
+
+registry.register_collector(_cache_samples)
+
+
+def register_routes(app):
+    """
+    注册指标路由到主应用（METRICS_ENABLED=false 时不注册）
+
+    参数：
+        app: FastAPI 应用实例
+    """
+    if not settings.METRICS_ENABLED:
+        return
+    router = APIRouter(tags=["运行指标"])
+
+    @router.get("/metrics", response_class=PlainTextResponse)
+    async def metrics():
+        """
+        Prometheus 抓取接口
+
+        返回（节选）：
+            # TYPE chat_stage_duration_seconds histogram
+            chat_stage_duration_seconds_bucket{stage="history_load",le="0.005"} 118
+            ...
+            chat_tokens_total{kind="prompt"} 52310
+            cache_hits_total{cache="profile"} 950
+        """
+        return PlainTextResponse(registry.expose(), media_type=CONTENT_TYPE)
+
+    app.include_router(router)
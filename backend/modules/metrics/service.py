@@ -0,0 +1,287 @@
+"""
+运行指标模块 - 指标类型与对话各阶段指标（Prometheus 文本格式）
+
+C++ 视角速览：
+- Counter / Gauge / Histogram 相当于带锁的计数器、当前值与直方图（分桶计数 + 总和），
+  不依赖 prometheus_client；expose() 按 Prometheus 文本格式（0.0.4）输出，供 GET /metrics 抓取。
+- 热路径开销：带标签的子指标在模块加载时就绑定好（如 chat_metrics.history_load），
+  记录一次只是 perf_counter + 二分查找桶 + 加锁自增，约 1 微秒；字符串拼接只在抓取时发生。
+- 内部加锁，可同时在事件循环与数据库线程池中记录。
+- 仅统计本进程；多 worker 部署时由 Prometheus 分别抓取各进程再聚合。
+"""
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# 延迟分桶（秒）：覆盖内存/SQLite 级别的毫秒以下操作到数十秒的模型生成
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value: str) -> str:
+    # 标签值中的反斜杠、双引号与换行需要转义
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels) + "}"
+
+
+def sample_line(name: str, value: float, labels: Sequence[Tuple[str, str]] = ()) -> str:
+    return f"{name}{_format_labels(labels)} {_format_value(value)}"
+
+
+class _Timer:
+    # with metric.time(): ... —— 退出时记录耗时（秒）
+    __slots__ = ("_observe", "_start")
+
+    def __init__(self, observe: Callable[[float], None]):
+        self._observe = observe
+
+    def __enter__(self) -> "_Timer":
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._observe(perf_counter() - self._start)
+
+
+class _CounterChild:
+    __slots__ = ("_value", "_lock")
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def track(self) -> "_InFlight":
+        # with gauge.track(): ... —— 进入时 +1，退出时 -1（在途请求数）
+        return _InFlight(self)
+
+
+class _InFlight:
+    __slots__ = ("_gauge",)
+
+    def __init__(self, gauge: _GaugeChild):
+        self._gauge = gauge
+
+    def __enter__(self) -> None:
+        self._gauge.inc()
+
+    def __exit__(self, *exc) -> None:
+        self._gauge.dec()
+
+
+class _HistogramChild:
+    __slots__ = ("_upper", "_counts", "_sum", "_lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self._upper = tuple(buckets)
+        self._counts = [0] * (len(self._upper) + 1)  # 末位为 +Inf 桶；各桶不累计，输出时再累加
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self._upper, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self) -> _Timer:
+        return _Timer(self.observe)
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = Lock()
+
+    @abstractmethod
+    def _new_child(self):
+        """创建一组标签值对应的子指标（实际计数的对象）"""
+
+    def labels(self, *values: str):
+        """取（或创建）某组标签值对应的子指标（无标签指标用 labels()）；热路径上应在模块加载时取好并复用"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _label_pairs(self, key: Tuple[str, ...]) -> List[Tuple[str, str]]:
+        return list(zip(self.labelnames, key))
+
+    @abstractmethod
+    def samples(self) -> Iterable[str]:
+        """逐行输出样本（不含 HELP/TYPE 行）"""
+
+    def expose(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def samples(self) -> Iterable[str]:
+        for key, child in list(self._children.items()):
+            yield sample_line(self.name, child.value, self._label_pairs(key))
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def samples(self) -> Iterable[str]:
+        for key, child in list(self._children.items()):
+            labels = self._label_pairs(key)
+            counts, total = child.snapshot()
+            cumulative = 0
+            for upper, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                yield sample_line(f"{self.name}_bucket", cumulative, [*labels, ("le", _format_value(upper))])
+            yield sample_line(f"{self.name}_sum", total, labels)
+            yield sample_line(f"{self.name}_count", cumulative, labels)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        # 抓取时调用的采集函数：把其他模块已有的统计（如缓存命中数）转换为样本行
+        self._collectors: List[Callable[[], Iterable[str]]] = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector: Callable[[], Iterable[str]]) -> None:
+        self._collectors.append(collector)
+
+    def expose(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+def family(name: str, kind: str, documentation: str, samples: Iterable[Tuple[Sequence[Tuple[str, str]], float]]):
+    """采集函数的辅助：输出一个指标族（HELP/TYPE + 样本行）"""
+    yield f"# HELP {name} {documentation}"
+    yield f"# TYPE {name} {kind}"
+    for labels, value in samples:
+        yield sample_line(name, value, labels)
+
+
+class ChatMetrics:
+    """
+    /chat_with_context 各阶段的耗时与计数（子指标预先绑定，热路径上直接调用）
+
+    阶段：
+        session_resolve   确定会话（指针缓存 / 索引查询 / 新建）
+        history_load      读取摘要与最近消息
+        profile_load      读取孩子年龄（档案缓存命中时接近 0）
+        prompt_build      构建 System Prompt 并按 token 预算裁剪历史
+        upstream_ttft     请求上游到收到首个增量（仅流式）
+        generation        上游生成总耗时（流式为首包前 + 逐段接收）
+        safety_filter     安全过滤（流式为各增量扫描耗时之和）
+        history_write     回写本轮问答
+    """
+
+    STAGES = (
+        "session_resolve", "history_load", "profile_load", "prompt_build",
+        "upstream_ttft", "generation", "safety_filter", "history_write",
+    )
+
+    def __init__(self, registry: MetricsRegistry):
+        stage = registry.histogram(
+            "chat_stage_duration_seconds", "Time spent in each stage of a chat turn", ("stage",)
+        )
+        for name in self.STAGES:
+            setattr(self, name, stage.labels(name))
+        request = registry.histogram(
+            "chat_request_duration_seconds", "End-to-end chat request latency", ("endpoint",)
+        )
+        self.request = request.labels("chat_with_context")
+        self.request_stream = request.labels("chat_with_context_stream")
+        self.in_flight = registry.gauge(
+            "chat_in_flight_requests", "Chat requests currently being processed"
+        ).labels()
+        tokens = registry.counter("chat_tokens_total", "Estimated tokens exchanged with the upstream model", ("kind",))
+        self.prompt_tokens = tokens.labels("prompt")
+        self.completion_tokens = tokens.labels("completion")
+        self.upstream_errors = registry.counter("chat_upstream_errors_total", "Failed upstream model calls").labels()
+
+
+registry = MetricsRegistry()
+chat_metrics = ChatMetrics(registry)
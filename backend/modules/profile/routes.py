@@ -48,7 +48,7 @@ def register_routes(app):
             类似 HTTP GET /profile 的处理函数
             参数从 HTTP Header 中读取
         """
-        profile = profile_service.get_profile(user_id)
+        profile = await profile_service.get_profile_async(user_id)
         if not profile:
             raise HTTPException(status_code=404, detail="档案不存在")
         return profile
@@ -76,12 +76,12 @@ def register_routes(app):
             创建的档案信息（包含计算的年龄）
         """
         # 检查是否已存在
-        existing = profile_service.get_profile(user_id)
+        existing = await profile_service.get_profile_async(user_id)
         if existing:
             raise HTTPException(status_code=400, detail="档案已存在，请使用 PUT 更新")
         
         # 创建档案
-        return profile_service.create_profile(user_id, profile_data)
+        return await profile_service.create_profile_async(user_id, profile_data)
     
     @router.put("", response_model=ChildProfileResponse)
     async def update_profile(
@@ -99,7 +99,7 @@ def register_routes(app):
         返回：
             更新后的完整档案
         """
-        profile = profile_service.update_profile(user_id, update_data)
+        profile = await profile_service.update_profile_async(user_id, update_data)
         if not profile:
             raise HTTPException(status_code=404, detail="档案不存在")
         return profile
@@ -112,7 +112,7 @@ def register_routes(app):
         返回：
             204 No Content（成功删除，无返回内容）
         """
-        success = profile_service.delete_profile(user_id)
+        success = await profile_service.delete_profile_async(user_id)
         if not success:
             raise HTTPException(status_code=404, detail="档案不存在")
     
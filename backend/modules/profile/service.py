@@ -5,10 +5,21 @@ C++ 视角速览：
 - ProfileModel 相当于 struct+ORM 映射，存到 SQLite。
 - ProfileService 提供 CRUD，内部用 SQLModel+Session（类似 RAII 持有连接）。
 - _age 是纯函数，用于计算年龄（避免在 DB 中存重复字段）。
+- *_async 方法在数据库线程池中执行对应的同步方法（见 modules/database.py），供 async 路由 await。
+- 读穿透缓存（read-through）：get_profile / get_age 先查进程内 TTLCache，未命中才读库并回填；
+  “无档案”也会缓存，避免没有档案的用户每轮对话都查库。
+  年龄按当天日期计算，因此缓存条目最晚在本地时间次日零点过期（生日当天零点后年龄随之更新）。
+  update_profile / delete_profile / create_profile 会使对应条目失效。多 worker 部署时其他进程最多滞后一个 TTL。
+- 读库与写库记为追踪 span（profile.db_read 等，见 modules/tracing）；命中缓存时不产生 span。
 """
-from typing import Optional
-from datetime import datetime, date
-from sqlmodel import SQLModel, Field, Session, create_engine, select
+from typing import Any, Dict, Optional
+from datetime import datetime, date, time, timedelta
+from threading import Lock
+from sqlmodel import SQLModel, Field, Session, select
+from config import settings
+from modules.cache import TTLCache
+from modules.database import get_engine, run_in_db
+from modules.tracing.service import span, traced
 from .schemas import ChildProfileCreate, ChildProfileUpdate, ChildProfileResponse
 
 
@@ -22,11 +33,52 @@ class ProfileModel(SQLModel, table=True):
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 
+_MISS = object()  # 缓存未命中标记（与“已缓存的无档案 None”区分）
+
+
+def _seconds_until_midnight() -> float:
+    # 距本地时间次日零点的秒数（date.today() 在零点后改变，年龄可能随之改变）
+    now = datetime.now()
+    return (datetime.combine(now.date() + timedelta(days=1), time.min) - now).total_seconds()
+
+
 class ProfileService:
-    def __init__(self, db_url: str = "sqlite:///./data.db"):
-        # SQLite 轻量持久化；check_same_thread=False 允许多线程访问（uvicorn worker 内的协程共享）。
-        self.engine = create_engine(db_url, connect_args={"check_same_thread": False})
-        SQLModel.metadata.create_all(self.engine)
+    def __init__(self, db_url: Optional[str] = None):
+        # 与历史服务共用同一个 Engine（连接池与 SQLite 调优见 modules/database.py）
+        self.engine = get_engine(db_url)
+        self._cache = TTLCache(max_entries=settings.PROFILE_CACHE_MAX_ENTRIES, ttl=settings.PROFILE_CACHE_TTL)
+        # 失效计数：读库期间若发生过失效，则不回填（避免把旧值写回缓存）
+        self._invalidations = 0
+        self._invalidation_lock = Lock()
+
+    def init_db(self) -> None:
+        # 建表（幂等）；由应用启动时显式调用，导入模块不访问数据库
+        SQLModel.metadata.create_all(self.engine, tables=[ProfileModel.__table__])
+
+    # ========== 档案缓存 ==========
+
+    def _cached(self, user_id: str) -> Any:
+        # 返回 ChildProfileResponse / None（无档案）/ _MISS（未缓存）
+        return self._cache.get(user_id, _MISS)
+
+    def _fill(self, user_id: str, profile: Optional[ChildProfileResponse], seen_invalidations: int) -> None:
+        with self._invalidation_lock:
+            if self._invalidations != seen_invalidations:
+                return
+            self._cache.set(user_id, profile, ttl=min(self._cache.ttl, _seconds_until_midnight()))
+
+    def _invalidate(self, user_id: str) -> None:
+        with self._invalidation_lock:
+            self._invalidations += 1
+            self._cache.delete(user_id)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+    def clear_cache(self) -> int:
+        with self._invalidation_lock:
+            self._invalidations += 1
+            return self._cache.clear()
 
     def _age(self, birth_date: date) -> int:
         # 纯计算，不依赖数据库；保持单一真值来源（生日）。
@@ -36,6 +88,7 @@ class ProfileService:
             age -= 1
         return age
 
+    @traced("profile.create_profile")
     def create_profile(self, user_id: str, profile_data: ChildProfileCreate) -> ChildProfileResponse:
         now = datetime.utcnow()
         model = ProfileModel(
@@ -54,15 +107,44 @@ class ProfileService:
             session.add(model)
             session.commit()
             session.refresh(model)
+        self._invalidate(user_id)  # 可能缓存了“无档案”
         return self._to_response(model)
 
-    def get_profile(self, user_id: str) -> Optional[ChildProfileResponse]:
-        with Session(self.engine) as session:
-            model = session.get(ProfileModel, user_id)
-            if not model:
-                return None
-            return self._to_response(model)
+    def get_profile(self, user_id: str, session: Optional[Session] = None) -> Optional[ChildProfileResponse]:
+        """
+        查询档案（读穿透缓存）；无档案时返回 None
+
+        session：可传入调用方已打开的 Session，未命中缓存时与其他读取共用同一连接。
+        """
+        profile = self._cached(user_id)
+        if profile is not _MISS:
+            return profile
+        return self._load_profile(user_id, session)
+
+    def _load_profile(self, user_id: str, session: Optional[Session] = None) -> Optional[ChildProfileResponse]:
+        # 未命中缓存时读库并回填（调用方已查过缓存，这里不再重复查找）
+        seen = self._invalidations
+        with span("profile.db_read"):
+            if session is None:
+                with Session(self.engine) as own_session:
+                    model = own_session.get(ProfileModel, user_id)
+            else:
+                model = session.get(ProfileModel, user_id)
+        profile = self._to_response(model) if model else None
+        self._fill(user_id, profile, seen)
+        return profile
+
+    def get_age(self, user_id: str, session: Optional[Session] = None) -> Optional[int]:
+        """
+        只取孩子年龄（对话上下文只需要这一个整数）；无档案时返回 None
+
+        session：可传入调用方已打开的 Session，与其他读取共用同一连接/事务。
+        年龄随档案一起缓存到本地时间次日零点，命中时不访问数据库。
+        """
+        profile = self.get_profile(user_id, session)
+        return profile.age if profile else None
 
+    @traced("profile.update_profile")
     def update_profile(self, user_id: str, update_data: ChildProfileUpdate) -> Optional[ChildProfileResponse]:
         with Session(self.engine) as session:
             model = session.get(ProfileModel, user_id)
@@ -75,8 +157,10 @@ class ProfileService:
             session.add(model)
             session.commit()
             session.refresh(model)
-            return self._to_response(model)
+        self._invalidate(user_id)
+        return self._to_response(model)
 
+    @traced("profile.delete_profile")
     def delete_profile(self, user_id: str) -> bool:
         with Session(self.engine) as session:
             model = session.get(ProfileModel, user_id)
@@ -84,7 +168,28 @@ class ProfileService:
                 return False
             session.delete(model)
             session.commit()
-            return True
+        self._invalidate(user_id)
+        return True
+
+    # ========== 异步接口（数据库线程池中执行，不阻塞事件循环） ==========
+
+    async def create_profile_async(self, user_id: str, profile_data: ChildProfileCreate) -> ChildProfileResponse:
+        return await run_in_db(self.create_profile, user_id, profile_data)
+
+    async def get_profile_async(self, user_id: str) -> Optional[ChildProfileResponse]:
+        # 命中缓存时直接返回，不必切换到数据库线程
+        profile = self._cached(user_id)
+        if profile is not _MISS:
+            return profile
+        return await run_in_db(self._load_profile, user_id)
+
+    async def update_profile_async(
+        self, user_id: str, update_data: ChildProfileUpdate
+    ) -> Optional[ChildProfileResponse]:
+        return await run_in_db(self.update_profile, user_id, update_data)
+
+    async def delete_profile_async(self, user_id: str) -> bool:
+        return await run_in_db(self.delete_profile, user_id)
 
     def _to_response(self, model: ProfileModel) -> ChildProfileResponse:
         age = self._age(model.birth_date)
@@ -0,0 +1,9 @@
+"""
+请求追踪模块
+
+功能：为每个请求附加请求 id 与嵌套计时片段（慢请求的 JSON 结构化日志，可选 Server-Timing 响应头），
+以及按比例对请求开启的采样分析器（火焰图 folded 格式导出，见管理接口 /admin/profiler）
+"""
+from .middleware import register_middleware
+
+__all__ = ["register_middleware"]
@@ -0,0 +1,112 @@
+"""
+请求追踪模块 - ASGI 中间件
+
+C++ 程序员理解：
+- 包在整个应用外层的“装饰器”：请求进入时建立 Trace（见 service.py），响应头发出时追加
+  X-Request-ID，响应体发送完毕后把完整的 span 列表写一行 JSON 日志（只记录慢请求）。
+- Server-Timing 响应头会向客户端暴露内部阶段名称与耗时，只在 TRACE_SERVER_TIMING=true 时追加
+  （本地调试或内网部署用）。
+- 请求 id：沿用客户端/网关传入的 X-Request-ID（仅接受安全字符），否则生成一个新的。
+- 流式响应（SSE）的响应头在生成开始前就已发出，Server-Timing 只包含此前的阶段
+  （会话、历史、档案读取与 Prompt 构建）；上游首包与生成耗时只出现在日志中。
+- 采用纯 ASGI 实现（而非 BaseHTTPMiddleware），不缓冲流式响应，也不另起任务。
+- 按 sample_rate 抽中的请求在处理期间开启采样分析器（见 profiler.py）。
+"""
+from uuid import uuid4
+import json
+import logging
+import re
+
+from config import settings
+from .profiler import profiler
+from .service import server_timing, start_trace
+
+logger = logging.getLogger(__name__)
+
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+
+
+def _configure_logger() -> None:
+    # 未另行配置日志时，追踪日志以 JSON Lines 输出到 stderr（与 uvicorn 的访问日志分开）
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class TracingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                candidate = value.decode("latin-1")
+                if _REQUEST_ID.match(candidate):
+                    request_id = candidate
+                break
+        trace = start_trace(request_id or uuid4().hex)
+        status = 500  # 应用未发出响应头就抛出异常时记为 500
+        sampled = profiler.should_sample()
+        if sampled:
+            profiler.begin()
+
+        async def send_with_headers(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", trace.request_id.encode("latin-1")))
+                if settings.TRACE_SERVER_TIMING:
+                    headers.append((b"server-timing", server_timing(trace).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            if sampled:
+                profiler.end()
+            trace.closed = True
+            duration = trace.elapsed()
+            if duration * 1000 >= settings.TRACE_LOG_MIN_MS and logger.isEnabledFor(logging.INFO):
+                logger.info(json.dumps({
+                    "event": "request_trace",
+                    "request_id": trace.request_id,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_ms": round(duration * 1000, 2),
+                    "sampled": sampled,
+                    "spans": [
+                        {
+                            "name": s.name,
+                            "start_ms": None if s.start is None else round(s.start * 1000, 2),
+                            "duration_ms": round(s.duration * 1000, 2),
+                            "depth": s.depth,
+                        }
+                        for s in trace.ordered_spans()
+                    ],
+                    "dropped_spans": trace.dropped,
+                }, ensure_ascii=False, separators=(",", ":")))
+
+
+def register_middleware(app):
+    """
+    注册追踪中间件到主应用（TRACING_ENABLED=false 时不注册）
+
+    参数：
+        app: FastAPI 应用实例（应在其他中间件之后注册，使其位于最外层、计入全部耗时）
+    """
+    if not settings.TRACING_ENABLED:
+        return
+    _configure_logger()
+    app.add_middleware(TracingMiddleware)
@@ -0,0 +1,131 @@
+"""
+请求追踪模块 - 按需采样分析器（输出火焰图可用的 folded stacks）
+
+C++ 视角速览：
+- 类似 perf record -F：后台线程每隔 interval 读取一次所有线程的调用栈（sys._current_frames），
+  按 “线程名;外层函数;...;内层函数 次数” 的格式累加（Brendan Gregg 的 folded 格式），
+  可直接交给 flamegraph.pl、speedscope 或 inferno 生成火焰图。
+- 按比例采样请求：sample_rate=0.05 表示约 5% 的请求开启采样；有被采样的请求在处理时
+  采样线程才工作，其余时间阻塞等待，不占 CPU。默认 sample_rate=0，即完全关闭。
+- 采样的是整个进程（事件循环线程 + 数据库线程池）在这些请求处理期间的调用栈，
+  并发的其他请求也会出现在样本中；空闲等待（selectors.select、threading.wait）的样本被丢弃。
+- 通过管理接口（/admin/profiler，需 X-Admin-Token）开启、查看与导出，见 modules/admin/routes.py。
+"""
+from collections import Counter
+from os import path
+from threading import Condition, Thread, enumerate as enumerate_threads, get_ident
+from typing import Dict, Optional
+import random
+import sys
+
+from config import settings
+
+MAX_STACKS = 20000  # 不同调用栈的数量上限，超出后新栈计入 [truncated]
+MAX_DEPTH = 128
+# 空闲等待的栈顶（文件名, 函数名）：事件循环等待 I/O、线程池等待任务
+_IDLE_LEAVES = {("selectors.py", "select"), ("threading.py", "wait")}
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.sample_rate = 0.0
+        self.sampled_requests = 0
+        self.samples = 0
+        self._active = 0  # 正在处理的被采样请求数
+        self._stacks: Counter = Counter()
+        self._labels: Dict[object, str] = {}  # code 对象 -> 帧标签
+        self._cond = Condition()
+        self._thread: Optional[Thread] = None
+
+    def configure(self, sample_rate: float, interval: Optional[float] = None) -> None:
+        with self._cond:
+            self.sample_rate = sample_rate
+            if interval is not None:
+                self.interval = interval
+
+    def should_sample(self) -> bool:
+        # 热路径：未开启时只做一次比较
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def begin(self) -> None:
+        with self._cond:
+            self.sampled_requests += 1
+            self._active += 1
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def end(self) -> None:
+        with self._cond:
+            self._active -= 1
+
+    def reset(self) -> None:
+        with self._cond:
+            self._stacks.clear()
+            self.samples = 0
+            self.sampled_requests = 0
+
+    def folded(self) -> str:
+        """导出 folded stacks（每行 “栈 次数”），按次数从多到少排列"""
+        with self._cond:
+            stacks = self._stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def stats(self) -> dict:
+        return {
+            "sample_rate": self.sample_rate,
+            "interval_ms": self.interval * 1000,
+            "sampled_requests": self.sampled_requests,
+            "active_requests": self._active,
+            "samples": self.samples,
+            "distinct_stacks": len(self._stacks),
+        }
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._active <= 0:
+                    self._cond.wait()
+                interval = self.interval
+            self._sample()
+            with self._cond:
+                # 等待下一次采样；期间 end/reset 不受影响
+                self._cond.wait(interval)
+
+    def _sample(self) -> None:
+        me = get_ident()
+        names = {t.ident: t.name for t in enumerate_threads()}
+        collected = []
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            code = frame.f_code
+            if (path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES:
+                continue
+            labels = []
+            while frame is not None and len(labels) < MAX_DEPTH:
+                labels.append(self._label(frame.f_code))
+                frame = frame.f_back
+            labels.append(names.get(ident, str(ident)))
+            collected.append(";".join(reversed(labels)))
+        with self._cond:
+            for stack in collected:
+                if stack not in self._stacks and len(self._stacks) >= MAX_STACKS:
+                    stack = "[truncated]"
+                self._stacks[stack] += 1
+            self.samples += 1
+
+    def _label(self, code) -> str:
+        # “函数名 (上级目录/文件名:起始行)”：区分各模块同名的 service.py；按函数（而非当前行）聚合
+        label = self._labels.get(code)
+        if label is None:
+            directory, filename = path.split(code.co_filename)
+            label = f"{code.co_name} ({path.basename(directory)}/{filename}:{code.co_firstlineno})"
+            # folded 格式以 ';' 分隔帧、以最后一个空格分隔次数
+            label = self._labels[code] = label.replace(";", ",")
+        return label
+
+
+profiler: SamplingProfiler = SamplingProfiler(interval=settings.PROFILER_INTERVAL_MS / 1000)
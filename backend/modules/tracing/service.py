@@ -0,0 +1,142 @@
+"""
+请求追踪模块 - 请求级计时片段（span）
+
+C++ 视角速览：
+- Trace 相当于每个请求一份的“计时记录表”：请求 id + 一组 Span（名称、相对请求开始的偏移、耗时、嵌套深度）。
+- 当前请求的 Trace 存在 contextvars 中（类似 thread_local，但按 asyncio 任务隔离）；
+  run_in_db 与 asyncio.create_task 都会复制上下文，因此数据库线程池、
+  singleflight 的上游调用中记录的 span 仍归属发起请求的 Trace。
+- span(name) 是 RAII 风格的计时器：with 块退出时记录一条 Span；嵌套的 with 自动加深一层。
+  不在请求中（如维护命令、后台任务）时只计时不记录。
+  可同时传入 observe（如 chat_metrics.history_load.observe），一次计时同时用于追踪与指标。
+- traced(name) 是整个方法作为一个 span 时的装饰器写法。
+- 跨越 yield 的计时（流式生成）不能用 with（生成器可能在别的上下文中被关闭），改用 record_span(name, start)。
+- 分散在多处、只有累计时长的耗时（如各增量的安全扫描之和）用 record_duration(name, seconds)：
+  没有单一的开始时刻，Span.start 为 None，输出时排在有开始时刻的 span 之后。
+"""
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+from typing import Callable, List, NamedTuple, Optional
+
+MAX_SPANS = 64  # 单个请求最多记录的 span 数，防止循环中的 span 撑大日志与响应头
+
+
+class Span(NamedTuple):
+    name: str
+    start: Optional[float]  # 相对请求开始（秒）；None 表示只有累计时长
+    duration: float  # 秒
+    depth: int  # 嵌套深度（1 为顶层）
+
+
+class Trace:
+    __slots__ = ("request_id", "started", "spans", "dropped", "closed")
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started = perf_counter()
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self.closed = False  # 请求结束后（如后台摘要任务中）记录的 span 丢弃
+
+    def add(self, name: str, start: float, end: float, depth: int) -> None:
+        self._append(Span(name, start - self.started, end - start, depth))
+
+    def add_duration(self, name: str, duration: float, depth: int) -> None:
+        self._append(Span(name, None, duration, depth))
+
+    def _append(self, item: Span) -> None:
+        if self.closed:
+            return
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        # list.append 在 CPython 中是原子的，数据库线程与事件循环可同时记录
+        self.spans.append(item)
+
+    def ordered_spans(self) -> List[Span]:
+        # 按开始时刻排序；只有累计时长的 span 按记录顺序排在最后
+        return sorted(self.spans, key=lambda s: (s.start is None, s.start or 0.0))
+
+    def elapsed(self) -> float:
+        return perf_counter() - self.started
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_depth: ContextVar[int] = ContextVar("trace_depth", default=0)
+
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+
+def current_request_id() -> Optional[str]:
+    trace = _trace.get()
+    return trace.request_id if trace else None
+
+
+def start_trace(request_id: str) -> Trace:
+    # 由中间件在请求开始时调用；当前上下文中后续的 span 都记入该 Trace
+    trace = Trace(request_id)
+    _trace.set(trace)
+    return trace
+
+
+class span:
+    """with span("history.load_turn_context"): ... —— 记录一段耗时（可选同时记入指标）"""
+
+    __slots__ = ("name", "_observe", "_trace", "_start", "_token")
+
+    def __init__(self, name: str, observe: Optional[Callable[[float], None]] = None):
+        self.name = name
+        self._observe = observe
+
+    def __enter__(self) -> "span":
+        self._trace = _trace.get()
+        if self._trace is not None:
+            self._token = _depth.set(_depth.get() + 1)
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        end = perf_counter()
+        if self._observe is not None:
+            self._observe(end - self._start)
+        if self._trace is not None:
+            self._trace.add(self.name, self._start, end, _depth.get())
+            _depth.reset(self._token)
+
+
+def traced(name: str):
+    """@traced("history.get_history") —— 把整个（同步）方法记为一个 span"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_span(name: str, start: float, end: Optional[float] = None) -> None:
+    """记录一段已结束的耗时（start/end 为 perf_counter 读数），深度为当前层级之下一层"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(name, start, perf_counter() if end is None else end, _depth.get() + 1)
+
+
+def record_duration(name: str, seconds: float) -> None:
+    """记录一段只有累计时长、没有单一开始时刻的耗时（秒），深度为当前层级之下一层"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.add_duration(name, seconds, _depth.get() + 1)
+
+
+def server_timing(trace: Trace) -> str:
+    """
+    按 Server-Timing 响应头格式输出（浏览器开发者工具的 Timing 面板可直接显示）：
+        total;dur=812.4, adapter.load_context;dur=3.1, history.load_turn_context;dur=2.2, ...
+    """
+    entries = [f"total;dur={trace.elapsed() * 1000:.1f}"]
+    entries.extend(f"{s.name};dur={s.duration * 1000:.1f}" for s in trace.ordered_spans())
+    return ", ".join(entries)
@@ -1,4 +1,5 @@
 import { apiRequest } from '../../utils/request.js'
+import { applyChanges, getCursor, getMessages } from '../../utils/messageStore.js'
 
 /**
  * 单页聊天与档案管理逻辑
@@ -9,7 +10,8 @@ import { apiRequest } from '../../utils/request.js'
  * - 输入与发送：调用后端聚合接口 `/chat_with_context`，自动带档案年龄与历史。
  * - 会话管理：复用后端返回的 `session_id`，保存在本地并继续透传于请求头。
  * - 档案表单：GET/POST/PUT `/profile`，支持轻量弹窗编辑与保存。
- * - 历史加载：GET `/history`，合并并缓存。
+ * - 历史同步：GET `/history/changes?since=<cursor>` 只拉取新消息与删除记录，
+ *   本地按页缓存（utils/messageStore.js），每次只写入新增部分。
  * - 语音按钮：保留占位，后续可接入同声传译或云函数。
  */
 Page({
@@ -47,7 +49,7 @@ Page({
     if (sid) {
       this.setData({ sessionId: sid })
     }
-    const cachedMsgs = wx.getStorageSync('LOCAL_MESSAGES') || []
+    const cachedMsgs = getMessages()
     if (cachedMsgs.length) {
       this.setData({ messages: cachedMsgs })
     }
@@ -98,10 +100,10 @@ Page({
         wx.setStorageSync('X_SESSION_ID', resp.session_id)
       }
 
-      // 写入AI回复并持久化本地消息
+      // 先展示AI回复，再增量同步（本轮问答以服务端记录为准写入本地缓存）
       const msgs2 = this.data.messages.concat([{ role: 'assistant', content: resp.reply || '' }])
       this.setData({ messages: msgs2 })
-      wx.setStorageSync('LOCAL_MESSAGES', msgs2)
+      this.loadHistory()
 
       // 简易“安全提示”示例（服务端若返回特定标记可增强）
       if ((resp.reply || '').includes('不当建议')) {
@@ -117,25 +119,35 @@ Page({
   },
 
   /**
-   * 加载历史（云端）：
-   * - 若本地已有会话ID则透传到请求头，后端返回该会话的完整历史。
-   * - 返回后只保留 role+content 并覆盖本地缓存。
+   * 同步历史（云端 → 本地缓存）：
+   * - 带上次的同步游标请求 `/history/changes`，只返回之后的新消息与删除记录。
+   * - 无会话ID时先查询当前会话；切换会话时游标为空，自动全量同步一次。
+   * - has_more 为 true 时继续拉取，直到追上服务端。
    */
   async loadHistory() {
     try {
-      const headers = {}
-      if (this.data.sessionId) headers['X-Session-ID'] = this.data.sessionId
-
-      const data = await apiRequest({ path: '/history', method: 'GET', headers })
-      if (data && data.messages) {
-        const msgs = data.messages.map(m => ({ role: m.role, content: m.content }))
-        this.setData({ messages: msgs })
-        wx.setStorageSync('LOCAL_MESSAGES', msgs)
-        if (data.session_id && !this.data.sessionId) {
-          this.setData({ sessionId: data.session_id })
-          wx.setStorageSync('X_SESSION_ID', data.session_id)
-        }
+      let sessionId = this.data.sessionId
+      if (!sessionId) {
+        const cur = await apiRequest({ path: '/history/session', method: 'GET' })
+        if (!cur || !cur.session_id) return
+        sessionId = cur.session_id
+        this.setData({ sessionId })
+        wx.setStorageSync('X_SESSION_ID', sessionId)
       }
+      const headers = { 'X-Session-ID': sessionId }
+
+      let data
+      do {
+        const since = getCursor(sessionId)
+        data = await apiRequest({
+          path: '/history/changes',
+          method: 'GET',
+          headers,
+          data: since ? { since } : {}
+        })
+        const msgs = applyChanges(sessionId, data)
+        this.setData({ messages: msgs })
+      } while (data.has_more)
     } catch (err) {
       wx.showToast({ title: '历史加载失败', icon: 'none' })
       console.error('history error', err)
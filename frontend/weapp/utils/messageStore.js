@@ -0,0 +1,82 @@
+/**
+ * 本地消息缓存（分页存储 + 增量同步）
+ *
+ * 存储布局：
+ * - `LOCAL_MSG_INDEX`：{ sessionId, pages, cursor }，cursor 为后端 `/history/changes` 返回的同步游标。
+ * - `LOCAL_MSG_PAGE_<n>`：第 n 页消息，每页最多 PAGE_SIZE 条 { id, role, content, truncated }。
+ *
+ * 追加新消息时只重写最后一页与索引，不再每收到一条消息就序列化整个对话；
+ * 删除记录（清空会话）很少发生，处理时才整体重写。
+ */
+const INDEX_KEY = 'LOCAL_MSG_INDEX'
+const PAGE_PREFIX = 'LOCAL_MSG_PAGE_'
+const LEGACY_KEY = 'LOCAL_MESSAGES'
+const PAGE_SIZE = 50
+
+// 内存副本：首次读取后常驻，避免每次渲染都读全部分页
+let index = null
+let messages = null
+
+function ensureLoaded() {
+  if (index) return
+  // 旧版本整体存储的消息没有 id，无法参与增量同步：丢弃后由首次同步重新拉取
+  wx.removeStorageSync(LEGACY_KEY)
+  index = wx.getStorageSync(INDEX_KEY) || { sessionId: '', pages: 0, cursor: '' }
+  messages = []
+  for (let i = 0; i < index.pages; i++) {
+    messages = messages.concat(wx.getStorageSync(PAGE_PREFIX + i) || [])
+  }
+}
+
+function writePages(fromPage) {
+  // 重写 fromPage 及之后的分页，并删除多余的旧分页
+  const pages = Math.ceil(messages.length / PAGE_SIZE)
+  for (let i = fromPage; i < pages; i++) {
+    wx.setStorageSync(PAGE_PREFIX + i, messages.slice(i * PAGE_SIZE, (i + 1) * PAGE_SIZE))
+  }
+  for (let i = pages; i < index.pages; i++) {
+    wx.removeStorageSync(PAGE_PREFIX + i)
+  }
+  index.pages = pages
+}
+
+/** 当前缓存的消息（从旧到新） */
+export function getMessages() {
+  ensureLoaded()
+  return messages
+}
+
+/** 下次同步使用的游标；缓存属于其他会话时返回空串（需要全量同步） */
+export function getCursor(sessionId) {
+  ensureLoaded()
+  return index.sessionId === sessionId ? index.cursor : ''
+}
+
+/**
+ * 应用一次 `/history/changes` 的结果
+ * - 先按删除记录移除 id ≤ up_to_message_id 的消息，再追加新消息
+ * - 切换到其他会话（或首次同步）时清空旧缓存
+ */
+export function applyChanges(sessionId, { cursor, messages: added = [], deletions = [] }) {
+  ensureLoaded()
+  let firstDirtyPage = index.pages ? index.pages - 1 : 0
+  if (index.sessionId !== sessionId) {
+    messages = []
+    firstDirtyPage = 0
+    index.sessionId = sessionId
+  }
+  if (deletions.length) {
+    const upTo = Math.max(...deletions.map(d => d.up_to_message_id))
+    messages = messages.filter(m => m.id > upTo)
+    firstDirtyPage = 0
+  }
+  messages = messages.concat(added.map(m => ({
+    id: m.id, role: m.role, content: m.content, truncated: !!m.truncated
+  })))
+  if (added.length || deletions.length || firstDirtyPage === 0) {
+    writePages(firstDirtyPage)
+  }
+  index.cursor = cursor
+  wx.setStorageSync(INDEX_KEY, index)
+  return messages
+}
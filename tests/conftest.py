@@ -0,0 +1,72 @@
+"""
+pytest 公共设置
+
+- 在导入应用之前把 DATABASE_URL 指向本次运行独有的临时目录：测试不会读写工作目录下的 ./data.db，
+  每次运行都从空库开始，运行结束后删除；同时开启默认关闭的 /metrics。
+- 调整 PythonPath，使得 backend 中的 `from config import settings` 能解析到 backend/config.py。
+- TestClient 不经过 lifespan，因此在会话开始时显式执行一次 init_db（建表与迁移）。
+- 公共夹具：client / user_id（每个用例一个新用户）/ seed_history（建会话并写入消息）。
+"""
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+_BACKEND_PATH = os.path.join(os.path.dirname(__file__), "..", "backend")
+sys.path.insert(0, os.path.abspath(_BACKEND_PATH))
+
+_DB_DIR = tempfile.TemporaryDirectory(prefix="edu_expert_tests_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR.name, 'test.db')}"
+# /metrics 默认关闭（路由在导入应用时注册），测试中开启以覆盖指标输出
+os.environ["METRICS_ENABLED"] = "true"
+
+
+@pytest.fixture(scope="session", autouse=True)
+def init_test_db():
+    from modules.history.service import history_service
+    from modules.profile.service import profile_service
+
+    profile_service.init_db()
+    history_service.init_db()
+    yield
+    history_service.close()
+    history_service.engine.dispose()
+    _DB_DIR.cleanup()
+
+
+@pytest.fixture
+def client():
+    import backend.main as main
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def user_id():
+    """每个用例使用新的用户 id，数据互不干扰"""
+    return f"test_{uuid.uuid4().hex[:8]}"
+
+
+@pytest.fixture
+def seed_history():
+    """
+    建会话并按顺序写入消息，返回 session_id：
+        seed_history(user_id, ["第0条", "第1条"])                    # 新会话，均为 user 消息
+        seed_history(user_id, texts, roles=("user", "assistant"))    # 角色轮流
+        seed_history(user_id, ["回来了"], session_id=session_id)     # 追加到已有会话
+    """
+    from modules.history.schemas import AddMessageRequest
+    from modules.history.service import history_service
+
+    def seed(user_id, contents=(), session_id=None, roles=("user",), service=None):
+        service = service or history_service
+        if session_id is None:
+            session_id = service.create_session(user_id)
+        for i, content in enumerate(contents):
+            message = AddMessageRequest(role=roles[i % len(roles)], content=content)
+            assert service.add_message(user_id, session_id, message)
+        return session_id
+
+    return seed
@@ -3,28 +3,23 @@ FastAPI TestClient / pytest 端到端测试
 
 目标：
 - 避免真实网络端口与进程抢占，提升 CI 可用性
-- 使用 TestClient 与 httpx.ASGITransport，将适配器内对 /chat 的调用在内存中路由到同一 app
+- 使用 TestClient 在内存中调用 app（适配器直接在进程内调用对话流水线，无需 HTTP 回环）
 - Mock OpenAI 客户端，避免外部依赖
 
 注意：
-- 测试默认会在当前工作目录创建/使用 `./data.db`（SQLite）。如需隔离，可在服务层支持自定义 DB URL。
+- 测试使用 conftest.py 创建的临时数据库（DATABASE_URL 指向临时目录），不读写 `./data.db`。
 - 不修改业务逻辑，只在测试中进行 monkeypatch。
 """
 
 import json
 import uuid
-import httpx
 import pytest
 from fastapi.testclient import TestClient
-import os
-import sys
-
-# 调整 PythonPath，使得 backend/main.py 中的 `from config import settings` 能解析到 backend/config.py
-_BACKEND_PATH = os.path.join(os.path.dirname(__file__), "..", "backend")
-sys.path.insert(0, os.path.abspath(_BACKEND_PATH))
 
 # 导入应用（不启动 uvicorn）
 import backend.main as main
+from config import settings
+from modules.chat.cache import response_cache
 
 
 @pytest.fixture(scope="session")
@@ -33,26 +28,10 @@ def app():
     return main.app
 
 
-@pytest.fixture(autouse=True)
-def patch_httpx_asyncclient(monkeypatch, app):
-    """
-    将适配器中的 httpx.AsyncClient 改为 ASGITransport 直连应用。
-    - 保持接口一致（支持 async with），避免真实 HTTP 网络调用。
-    """
-
-    class AsyncClientPatched(httpx.AsyncClient):
-        def __init__(self, *args, **kwargs):
-            transport = httpx.ASGITransport(app=app)
-            # 使用统一的 base_url，适配绝对/相对路径
-            super().__init__(transport=transport, base_url="http://testserver")
-
-    monkeypatch.setattr("httpx.AsyncClient", AsyncClientPatched)
-
-
 @pytest.fixture(autouse=True)
 def patch_openai(monkeypatch):
     """
-    Mock OpenAI 客户端的 chat.completions.create，返回可控的回复文本，
+    Mock 异步 OpenAI 客户端的 chat.completions.create，返回可控的回复文本，
     以避免外部 API 依赖与费用。
     """
 
@@ -68,11 +47,53 @@ def patch_openai(monkeypatch):
         def __init__(self, content: str):
             self.choices = [_Choice(content)]
 
-    def _fake_create(**kwargs):
+    class _Delta:
+        def __init__(self, content: str):
+            self.content = content
+
+    class _StreamChoice:
+        def __init__(self, content: str):
+            self.delta = _Delta(content)
+
+    class _Chunk:
+        def __init__(self, content: str):
+            self.choices = [_StreamChoice(content)]
+
+    class _FakeStream:
+        # 模拟 openai.AsyncStream：每两个字符一个增量，逐段输出；记录是否被关闭
+        instances = []
+
+        def __init__(self, text: str):
+            self.text = text
+            self.closed = False
+            _FakeStream.instances.append(self)
+
+        async def __aiter__(self):
+            for i in range(0, len(self.text), 2):
+                yield _Chunk(self.text[i:i + 2])
+
+        async def close(self):
+            self.closed = True
+
+    async def _fake_create(**kwargs):
         # 返回包含敏感词的示例文本，以测试后端安全提醒追加逻辑
-        return _Response("建议不要打孩子，先共情再设边界。")
+        text = "建议不要打孩子，先共情再设边界。"
+        if kwargs.get("stream"):
+            return _FakeStream(text)
+        return _Response(text)
 
-    monkeypatch.setattr(main.client.chat.completions, "create", _fake_create)
+    monkeypatch.setattr(
+        main.llm_client_manager.client.chat.completions, "create", _fake_create
+    )
+    return _FakeStream
+
+
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    """每个用例使用空的回答缓存，避免用例之间相互影响。"""
+    response_cache.clear()
+    yield
+    response_cache.clear()
 
 
 def _headers_for_user(user_id: str, session_id: str | None = None):
@@ -166,6 +187,7 @@ def test_chat_with_context_flow_and_safety(app):
     # 因为我们 mock 的回复包含“打”字，
     # 后端安全过滤应追加“安全提醒”内容
     assert "安全提醒" in data["reply"]
+    assert data["context_tokens"] > 0
 
     # 历史应包含双方消息各一条
     resp_hist = client.get(
@@ -174,3 +196,855 @@ def test_chat_with_context_flow_and_safety(app):
     assert resp_hist.status_code == 200
     hist = resp_hist.json()
     assert hist["message_count"] >= 2
+
+
+def _parse_sse(body: str):
+    """将 SSE 响应体解析为 [(event, data_dict), ...]。"""
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_chat_stream_sse(client):
+    resp = client.post(
+        "/chat/stream",
+        json={"message": "孩子不听话怎么办？", "response_mode": "concise"},
+    )
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+
+    events = _parse_sse(resp.text)
+    deltas = [data["content"] for event, data in events if event == "delta"]
+    assert "".join(deltas) == "建议不要打孩子，先共情再设边界。"
+
+    # 最后一个事件携带完整回答与安全提醒
+    event, data = events[-1]
+    assert event == "done"
+    assert data["safety_reminder"]
+    assert data["reply"].startswith("".join(deltas))
+    assert "安全提醒" in data["reply"]
+
+
+def test_upstream_stream_closed_when_consumer_stops_early(patch_openai):
+    import asyncio
+
+    async def _read_first_delta():
+        deltas = main.chat_service._iter_deltas([{"role": "user", "content": "孩子不听话怎么办？"}])
+        first = await deltas.__anext__()
+        await deltas.aclose()  # 模拟客户端断开
+        return first
+
+    assert asyncio.run(_read_first_delta())
+    # 上游响应被显式关闭，连接归还连接池
+    assert patch_openai.instances[-1].closed is True
+
+
+def test_chat_with_context_stream_persists_reply(client, user_id):
+    resp = client.post(
+        "/chat_with_context/stream",
+        headers=_headers_for_user(user_id),
+        json={"message": "孩子不肯睡觉怎么办？", "response_mode": "concise"},
+    )
+    assert resp.status_code == 200
+    events = _parse_sse(resp.text)
+
+    # 首个事件即下发 session_id
+    assert events[0][0] == "session"
+    session_id = events[0][1]["session_id"]
+    assert events[-1][0] == "done"
+    assert events[-1][1]["session_id"] == session_id
+
+    hist = client.get("/history", headers=_headers_for_user(user_id, session_id)).json()
+    assert [m["role"] for m in hist["messages"]] == ["user", "assistant"]
+    assert hist["messages"][1]["content"] == events[-1][1]["reply"]
+    assert hist["messages"][1]["truncated"] is False
+
+
+def test_chat_with_context_stream_marks_truncated(client, user_id, monkeypatch):
+    async def _broken_deltas(messages):
+        yield "先共情，"
+        raise RuntimeError("upstream reset")
+
+    monkeypatch.setattr(main.chat_service, "_iter_deltas", _broken_deltas)
+
+    resp = client.post(
+        "/chat_with_context/stream",
+        headers=_headers_for_user(user_id),
+        json={"message": "孩子撒谎怎么办？"},
+    )
+    events = _parse_sse(resp.text)
+    assert events[-1][0] == "error"
+
+    session_id = events[0][1]["session_id"]
+    hist = client.get("/history", headers=_headers_for_user(user_id, session_id)).json()
+    assistant = hist["messages"][-1]
+    assert assistant["role"] == "assistant"
+    assert assistant["content"] == "先共情，"
+    assert assistant["truncated"] is True
+
+
+def test_chat_response_cache_and_admin_flush(client, monkeypatch):
+    calls = []
+    fake_create = main.llm_client_manager.client.chat.completions.create
+
+    async def _counting_create(**kwargs):
+        calls.append(kwargs)
+        return await fake_create(**kwargs)
+
+    monkeypatch.setattr(main.llm_client_manager.client.chat.completions, "create", _counting_create)
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "secret")
+
+    body = {"message": "孩子不肯写作业怎么办？", "response_mode": "concise", "child_age": 7}
+    first = client.post("/chat", json=body).json()
+    # 规范化后相同（去掉标点）、同一年龄段 → 命中缓存
+    second = client.post("/chat", json={**body, "message": "孩子不肯写作业怎么办", "child_age": 8}).json()
+    assert first["reply"] == second["reply"]
+    assert len(calls) == 1
+
+    # 有历史时不使用缓存
+    client.post("/chat", json={**body, "history": [{"role": "user", "content": "你好"}]})
+    assert len(calls) == 2
+
+    assert client.get("/admin/cache").status_code == 403
+    # 含非 ASCII 字符的口令同样是 403，而不是 500
+    assert client.get("/admin/cache", headers={"X-Admin-Token": "口令".encode("utf-8")}).status_code == 403
+    stats = client.get("/admin/cache", headers={"X-Admin-Token": "secret"}).json()
+    assert stats["response_cache"]["hits"] >= 1
+
+    resp = client.delete("/admin/cache", headers={"X-Admin-Token": "secret"})
+    assert resp.json()["flushed"] == 1
+    client.post("/chat", json=body)
+    assert len(calls) == 3
+
+
+def test_concurrent_identical_requests_share_one_upstream_call(monkeypatch):
+    import asyncio
+
+    calls = []
+    fake_create = main.llm_client_manager.client.chat.completions.create
+
+    async def _slow_create(**kwargs):
+        calls.append(kwargs)
+        await asyncio.sleep(0.05)
+        return await fake_create(**kwargs)
+
+    monkeypatch.setattr(main.llm_client_manager.client.chat.completions, "create", _slow_create)
+    history = [{"role": "user", "content": "孩子上学总迟到"}]
+
+    async def _run():
+        results = await asyncio.gather(
+            *[main.chat_service.complete("学校的事怎么沟通？", history, "concise", 9) for _ in range(5)]
+        )
+        replies = [r.reply for r in results]
+        streams = [main.chat_service.stream("学校的事怎么沟通？", history, "detailed", 9) for _ in range(3)]
+
+        async def _drain(stream):
+            return "".join([content async for content in stream])
+
+        streamed = await asyncio.gather(*[_drain(s) for s in streams])
+        return replies, streamed
+
+    replies, streamed = asyncio.run(_run())
+    assert len(set(replies)) == 1
+    assert len(set(streamed)) == 1
+    # 5 个非流式请求 + 3 个流式请求 → 各只调用一次上游
+    assert len(calls) == 2
+
+
+def test_rolling_summary_folds_older_messages(user_id, seed_history):
+    import asyncio
+    from modules.history.service import history_service
+    from modules.history.summarizer import summarizer
+
+    session_id = seed_history(user_id, [f"第{i}条" for i in range(16)], roles=("user", "assistant"))
+
+    asyncio.run(summarizer._run(session_id))
+
+    summary, recent = history_service.get_session_context(user_id, session_id, limit=20)
+    # 较早的消息折叠为摘要，只保留最近 keep_recent 条原文
+    assert summary
+    assert [m["content"] for m in recent] == [f"第{i}条" for i in range(16 - summarizer.keep_recent, 16)]
+
+    context = main.chat_service.build_context("新问题", recent, "concise", None, summary)
+    assert context.messages[1]["role"] == "system"
+    assert summary in context.messages[1]["content"]
+
+
+def test_recent_messages_tail_query(user_id, seed_history):
+    from modules.history.service import history_service
+
+    session_id = seed_history(user_id, [f"第{i}条" for i in range(12)], roles=("user", "assistant"))
+
+    recent = history_service.get_messages_for_api(user_id, session_id, limit=5)
+    # 只取最近 5 条，按时间从旧到新
+    assert recent == [
+        {"role": "assistant" if i % 2 else "user", "content": f"第{i}条"} for i in range(7, 12)
+    ]
+    # 当前会话可省略 session_id；他人会话不可读
+    assert history_service.get_messages_for_api(user_id, limit=5) == recent
+    assert history_service.get_messages_for_api("someone_else", session_id) == []
+
+
+def test_db_work_runs_off_the_event_loop():
+    import asyncio
+    import threading
+    import time
+    from modules.database import run_in_db
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        # 模拟一次慢的同步数据库调用（如 fsync）：期间事件循环仍在调度其他协程
+        thread_name = await run_in_db(lambda: (time.sleep(0.2), threading.current_thread().name)[1])
+        task.cancel()
+        return ticks, thread_name
+
+    ticks, thread_name = asyncio.run(scenario())
+    assert ticks >= 5
+    assert thread_name.startswith("db")
+
+
+def test_services_share_tuned_sqlite_engine():
+    from modules.history.service import history_service
+    from modules.profile.service import profile_service
+
+    assert history_service.engine is profile_service.engine
+    with history_service.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() > 0
+        assert conn.exec_driver_sql("PRAGMA foreign_keys").scalar() == 1
+
+
+def test_write_behind_batches_and_reads_own_writes(user_id, seed_history, monkeypatch):
+    from sqlmodel import Session, select
+    from config import settings
+    from modules.history.schemas import AddMessageRequest
+    from modules.history.service import HistoryService, MessageModel
+
+    # 间隔足够长，确保断言期间后台线程不会自动落库
+    monkeypatch.setattr(settings, "HISTORY_FLUSH_INTERVAL_MS", 60_000)
+    service = HistoryService(write_behind=True)
+    try:
+        session_id = seed_history(user_id, [f"第{i}条" for i in range(4)], roles=("user", "assistant"), service=service)
+        assert not service.add_message("someone_else", session_id, AddMessageRequest(role="user", content="x"))
+
+        def stored():
+            with Session(service.engine) as session:
+                return session.exec(
+                    select(MessageModel.content).where(MessageModel.session_id == session_id).order_by(MessageModel.id)
+                ).all()
+
+        # 尚未落库，但读取时已能看到（读己之写）
+        assert stored() == []
+        assert [m["content"] for m in service.get_messages_for_api(user_id, session_id, limit=3)] == ["第1条", "第2条", "第3条"]
+        assert service.get_history(user_id, session_id).message_count == 4
+
+        # 一次批量落库，顺序与入队顺序一致，且不会与缓冲重复
+        assert service.flush() == 4
+        assert stored() == [f"第{i}条" for i in range(4)]
+        assert len(service.get_messages_for_api(user_id, session_id, limit=10)) == 4
+    finally:
+        service.close()
+
+
+def test_write_behind_thread_sleeps_while_idle():
+    import time
+    from datetime import datetime
+    from modules.history.write_behind import MessageWriteBehind, PendingMessage
+
+    written = []
+    writer = MessageWriteBehind(written.extend, flush_interval=0.01, max_batch=100)
+    flushes = []
+    flush = writer.flush
+    writer.flush = lambda: flushes.append(1) or flush()
+    try:
+        writer.enqueue(PendingMessage("s", "u", "user", "hi", datetime.utcnow(), False))
+        deadline = time.monotonic() + 2
+        while not written and time.monotonic() < deadline:
+            time.sleep(0.005)
+        assert len(written) == 1
+        # 队列清空后线程阻塞等待，不再每个周期醒来空跑 flush
+        time.sleep(0.1)
+        assert len(flushes) == 1
+    finally:
+        writer.close()
+
+
+def test_write_behind_backs_off_after_failed_flush(caplog):
+    import logging
+    import time
+    from datetime import datetime
+    from modules.history.write_behind import MessageWriteBehind, PendingMessage
+
+    attempts, healthy = [], []
+
+    def _write(batch):
+        attempts.append(len(batch))
+        if not healthy:
+            raise RuntimeError("database is locked")
+
+    writer = MessageWriteBehind(_write, flush_interval=0.001, max_batch=1)
+    try:
+        with caplog.at_level(logging.CRITICAL, logger="modules.history.write_behind"):
+            writer.enqueue(PendingMessage("s", "u", "user", "hi", datetime.utcnow(), False))
+            time.sleep(0.3)
+        # 队列已满且持续失败：按退避间隔重试，而不是空转
+        assert 1 <= len(attempts) <= 10
+    finally:
+        healthy.append(True)
+        writer.close()
+    assert attempts[-1] == 1  # 关闭时落库剩余消息
+
+
+def test_turn_context_and_atomic_turn_recording(client, user_id):
+    from modules.history.service import history_service
+
+    client.post(
+        "/profile",
+        headers=_headers_for_user(user_id),
+        json={"nickname": "小明", "birth_date": "2017-05-20"},
+    )
+
+    # 无会话时新建；年龄与历史一次取回
+    turn = history_service.load_turn_context(user_id, limit=10)
+    assert turn.history == [] and turn.summary is None
+    assert turn.age == client.get("/profile", headers=_headers_for_user(user_id)).json()["age"]
+
+    assert history_service.record_turn(user_id, turn.session_id, "孩子撒谎怎么办？", "先共情。")
+    assert history_service.record_turn(user_id, turn.session_id, "那打他呢？", None)  # 生成失败：只记录问题
+    assert not history_service.record_turn("someone_else", turn.session_id, "x", "y")
+
+    again = history_service.load_turn_context(user_id, limit=10)
+    assert again.session_id == turn.session_id
+    assert again.history == [
+        {"role": "user", "content": "孩子撒谎怎么办？"},
+        {"role": "assistant", "content": "先共情。"},
+        {"role": "user", "content": "那打他呢？"},
+    ]
+
+
+def test_profile_read_through_cache_and_invalidation(client, user_id, monkeypatch):
+    from config import settings
+    from modules.profile.service import profile_service
+
+    headers = _headers_for_user(user_id)
+
+    assert profile_service.get_age(user_id) is None  # “无档案”也会被缓存
+    client.post("/profile", headers=headers, json={"nickname": "小明", "birth_date": "2017-05-20"})
+    age = profile_service.get_age(user_id)
+    assert age is not None
+
+    hits = profile_service.cache_stats()["hits"]
+    assert profile_service.get_age(user_id) == age
+    assert profile_service.cache_stats()["hits"] == hits + 1
+
+    # 更新后缓存失效，立即读到新值
+    client.put("/profile", headers=headers, json={"birth_date": "2020-05-20"})
+    assert profile_service.get_age(user_id) == age - 3
+    client.delete("/profile", headers=headers)
+    assert profile_service.get_age(user_id) is None
+
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "secret")
+    stats = client.get("/admin/cache", headers={"X-Admin-Token": "secret"}).json()
+    assert stats["profile_cache"]["hits"] >= 1
+
+    # 异步读取未命中时只查一次缓存（只记一次 miss），管理接口可清空档案缓存
+    import asyncio
+    misses = profile_service.cache_stats()["misses"]
+    profile_service._invalidate(user_id)
+    assert asyncio.run(profile_service.get_profile_async(user_id)) is None
+    assert profile_service.cache_stats()["misses"] == misses + 1
+    resp = client.delete("/admin/cache", headers={"X-Admin-Token": "secret"})
+    assert resp.json()["profile_flushed"] >= 1
+    assert profile_service.cache_stats()["size"] == 0
+
+
+def test_current_session_pointer_follows_activity(user_id, seed_history):
+    from modules.history.service import SessionModel, history_service
+    from sqlmodel import Session
+
+    first = seed_history(user_id)
+    second = seed_history(user_id)
+    assert history_service.get_current_session(user_id) == second
+
+    seed_history(user_id, ["hi"], session_id=first)
+    assert history_service.get_current_session(user_id) == first
+
+    history_service.delete_session(user_id, first)
+    assert history_service.get_current_session(user_id) == second
+
+    # 指针过时（会话在别处被删除）时回退到索引查询
+    with Session(history_service.engine) as session:
+        session.delete(session.get(SessionModel, second))
+        session.commit()
+    turn = history_service.load_turn_context(user_id)
+    assert turn.session_id not in (first, second)
+
+    # 异步读取未命中时只查一次指针缓存
+    import asyncio
+    history_service._forget_current(user_id)
+    misses = history_service._current.misses
+    assert asyncio.run(history_service.get_current_session_async(user_id)) == turn.session_id
+    assert history_service._current.misses == misses + 1
+
+
+def test_history_keyset_pagination_and_etag(client, user_id, seed_history):
+    session_id = seed_history(user_id, [f"第{i}条" for i in range(7)])
+    headers = _headers_for_user(user_id, session_id)
+
+    # 首屏：最新 3 条
+    page = client.get("/history", headers=headers, params={"limit": 3}).json()
+    assert [m["content"] for m in page["messages"]] == ["第4条", "第5条", "第6条"]
+    assert page["has_more"] is True and page["message_count"] == 7
+
+    # 向前翻页直到没有更多
+    page2 = client.get("/history", headers=headers, params={"before": page["messages"][0]["id"], "limit": 3}).json()
+    assert [m["content"] for m in page2["messages"]] == ["第1条", "第2条", "第3条"]
+    page3 = client.get("/history", headers=headers, params={"before": page2["messages"][0]["id"], "limit": 3}).json()
+    assert [m["content"] for m in page3["messages"]] == ["第0条"]
+    assert page3["has_more"] is False
+
+    # 增量拉取
+    newer = client.get("/history", headers=headers, params={"after": page2["messages"][-1]["id"]}).json()
+    assert [m["content"] for m in newer["messages"]] == ["第4条", "第5条", "第6条"]
+
+    # 条件请求：未变化 → 304；新增消息后 ETag 变化
+    resp = client.get("/history", headers=headers)
+    etag = resp.headers["ETag"]
+    assert client.get("/history", headers={**headers, "If-None-Match": etag}).status_code == 304
+    seed_history(user_id, ["新消息"], session_id=session_id)
+    resp2 = client.get("/history", headers={**headers, "If-None-Match": etag})
+    assert resp2.status_code == 200 and resp2.headers["ETag"] != etag
+
+
+def test_history_etag_differs_when_current_session_switches(client, user_id, seed_history):
+    from datetime import datetime
+    from modules.history.service import SessionModel, history_service
+    from sqlmodel import Session, update
+
+    # 两个会话的版本串相同（更新时间与消息数一致）
+    first = seed_history(user_id, ["同一句"])
+    second = seed_history(user_id, ["同一句"])
+    with Session(history_service.engine) as session:
+        session.execute(
+            update(SessionModel).where(SessionModel.user_id == user_id).values(updated_at=datetime(2026, 1, 1))
+        )
+        session.commit()
+    headers = _headers_for_user(user_id)  # 不传 X-Session-ID，读取“当前会话”
+
+    history_service._current.set(user_id, first)
+    etag = client.get("/history", headers=headers).headers["ETag"]
+    history_service._current.set(user_id, second)
+    resp = client.get("/history", headers={**headers, "If-None-Match": etag})
+    assert resp.status_code == 200 and resp.json()["session_id"] == second
+    assert resp.headers["ETag"] != etag
+
+
+def test_history_changes_delta_sync(client, user_id, seed_history):
+    session_id = seed_history(user_id, [f"第{i}条" for i in range(3)])
+    headers = _headers_for_user(user_id, session_id)
+
+    # 首次同步：全部消息 + 游标
+    first = client.get("/history/changes", headers=headers).json()
+    assert [m["content"] for m in first["messages"]] == ["第0条", "第1条", "第2条"]
+    assert first["deletions"] == [] and first["has_more"] is False
+
+    # 无变化：空增量
+    idle = client.get("/history/changes", headers=headers, params={"since": first["cursor"]}).json()
+    assert idle["messages"] == [] and idle["cursor"] == first["cursor"]
+
+    # 清空后再写入：删除记录覆盖旧消息，新消息 id 更大，不受影响
+    client.delete("/history/session", headers=headers)
+    seed_history(user_id, ["新的开始"], session_id=session_id)
+    delta = client.get("/history/changes", headers=headers, params={"since": first["cursor"], "limit": 1}).json()
+    assert [m["content"] for m in delta["messages"]] == ["新的开始"]
+    assert delta["deletions"][0]["kind"] == "clear"
+    assert delta["deletions"][0]["up_to_message_id"] == first["messages"][-1]["id"]
+    assert delta["messages"][0]["id"] > delta["deletions"][0]["up_to_message_id"]
+
+    assert client.get("/history/changes", headers=headers, params={"since": "bogus"}).status_code == 400
+
+
+def test_clear_and_delete_cover_messages_written_in_between(user_id, seed_history, monkeypatch):
+    from modules.history.service import history_service
+
+    # 在“分批删除消息”与“写墓碑”两步之间插入一条新消息
+    delete_messages = history_service._delete_messages_in_batches
+    interleaved = []
+
+    def _delete_then_write(condition, up_to):
+        deleted = delete_messages(condition, up_to)
+        seed_history(user_id, ["期间写入"], session_id=session_id)
+        interleaved.append(history_service.get_changes(user_id, since=f"{up_to}.0").messages[0].id)
+        return deleted
+
+    monkeypatch.setattr(history_service, "_delete_messages_in_batches", _delete_then_write)
+
+    # 清空：新消息保留且计入计数，墓碑只覆盖实际删除的消息
+    session_id = seed_history(user_id, ["第0条", "第1条"])
+    assert history_service.clear_session(user_id, session_id)
+    assert [m["content"] for m in history_service.get_messages_for_api(user_id, session_id)] == ["期间写入"]
+    item = history_service.list_sessions(user_id).sessions[0]
+    assert item.message_count == 1 and item.last_message_preview == "期间写入"
+    clear = history_service.get_changes(user_id, since="0.0", session_id=session_id).deletions[-1]
+    assert clear.kind == "clear" and clear.up_to_message_id < interleaved[-1]
+
+    # 删除：新消息随会话级联删除，墓碑覆盖到它
+    assert history_service.delete_session(user_id, session_id)
+    delete = history_service.get_changes(user_id, since="0.0", session_id=session_id).deletions[-1]
+    assert delete.kind == "delete" and delete.up_to_message_id == interleaved[-1]
+
+
+def test_delete_all_sessions_in_batches_with_cascade(client, user_id, seed_history, monkeypatch):
+    from config import settings
+    from modules.history.service import MessageModel, SessionModel, SessionSummaryModel, history_service
+    from sqlmodel import Session, func, select
+
+    monkeypatch.setattr(settings, "DB_DELETE_BATCH_SIZE", 2)  # 强制多批
+    sessions = [seed_history(user_id, [f"第{i}条" for i in range(3)]) for _ in range(3)]
+    for sid in sessions:
+        history_service.save_summary(sid, "摘要", 0)
+
+    assert client.delete("/history/session/all", headers=_headers_for_user(user_id)).status_code == 200
+    with Session(history_service.engine) as session:
+        assert session.exec(select(func.count()).select_from(SessionModel).where(SessionModel.user_id == user_id)).one() == 0
+        assert session.exec(select(func.count()).select_from(MessageModel).where(MessageModel.user_id == user_id)).one() == 0
+        assert session.exec(
+            select(func.count()).select_from(SessionSummaryModel).where(SessionSummaryModel.session_id.in_(sessions))
+        ).one() == 0
+    changes = history_service.get_changes(user_id, since="0.0", session_id=sessions[0])
+    assert [d.kind for d in changes.deletions] == ["delete"]
+    assert history_service.delete_all_sessions(user_id) is False
+
+
+def test_idle_session_archival_is_transparent(client, user_id, seed_history):
+    from datetime import datetime, timedelta
+    from modules.history.service import MessageModel, SessionArchiveModel, SessionModel, history_service
+    from sqlmodel import Session, select
+
+    session_id = seed_history(user_id, [f"第{i}条" * 50 for i in range(5)])
+    headers = _headers_for_user(user_id, session_id)
+    history_service.flush()
+    with Session(history_service.engine) as session:
+        sess = session.get(SessionModel, session_id)
+        sess.updated_at = datetime.utcnow() - timedelta(days=60)
+        session.add(sess)
+        session.commit()
+    before = client.get("/history", headers=headers)
+
+    selected, archived = history_service.archive_idle_sessions(idle_days=30, limit=1000)
+    assert archived >= 1 and selected >= archived
+    with Session(history_service.engine) as session:
+        assert session.exec(select(MessageModel).where(MessageModel.session_id == session_id)).all() == []
+        archive = session.get(SessionArchiveModel, session_id)
+        assert archive.message_count == 5 and len(archive.payload) < archive.raw_bytes
+
+    # 归档后读取结果与 ETag 不变
+    after = client.get("/history", headers=headers)
+    assert after.json()["messages"] == before.json()["messages"]
+    assert after.headers["ETag"] == before.headers["ETag"]
+
+    # 继续对话：新消息在线存储，与归档拼接；分页跨越归档边界
+    seed_history(user_id, ["回来了"], session_id=session_id)
+    page = client.get("/history", headers=headers, params={"limit": 3}).json()
+    assert [m["content"] for m in page["messages"]] == ["第3条" * 50, "第4条" * 50, "回来了"]
+    assert page["message_count"] == 6 and page["has_more"] is True
+    older = client.get("/history", headers=headers, params={"before": page["messages"][0]["id"]}).json()
+    assert len(older["messages"]) == 3 and older["has_more"] is False
+    assert history_service.get_messages_for_api(user_id, session_id, limit=2)[0]["content"] == "第4条" * 50
+
+    # 再次归档时与已有归档合并；清空后墓碑覆盖归档中的消息
+    assert history_service.archive_session(session_id)
+    assert len(client.get("/history", headers=headers).json()["messages"]) == 6
+    history_service.clear_session(user_id, session_id)
+    deletion = history_service.get_changes(user_id, since="0.0", session_id=session_id).deletions[0]
+    assert deletion.up_to_message_id == page["messages"][-1]["id"]
+    assert client.get("/history", headers=headers).json()["messages"] == []
+
+
+def test_maintenance_keeps_archiving_after_skipped_sessions(user_id, seed_history, monkeypatch):
+    from datetime import datetime, timedelta
+    from modules.history import maintenance
+    from modules.history.service import SessionArchiveModel, SessionModel, history_service
+    from sqlmodel import Session, select, update
+
+    sessions = [seed_history(user_id, [f"第{i}条"]) for i in range(3)]
+    history_service.flush()
+    with Session(history_service.engine) as session:
+        session.execute(
+            update(SessionModel).where(SessionModel.user_id == user_id)
+            .values(updated_at=datetime.utcnow() - timedelta(days=60))
+        )
+        session.commit()
+
+    # 第一个挑中的会话跳过一次（如挑选后又有了新消息）：本批归档数小于批大小，但仍有空闲会话
+    archive_session = history_service.archive_session
+    skipped = []
+
+    def _skip_once(session_id, idle_before=None):
+        if not skipped:
+            skipped.append(session_id)
+            return False
+        return archive_session(session_id, idle_before)
+
+    monkeypatch.setattr(history_service, "archive_session", _skip_once)
+    maintenance.main(["--idle-days", "30", "--batch-size", "2"])
+    with Session(history_service.engine) as session:
+        archived = session.exec(
+            select(SessionArchiveModel.session_id).where(SessionArchiveModel.session_id.in_(sessions))
+        ).all()
+    assert sorted(archived) == sorted(sessions)
+
+
+def test_history_search_fts_and_short_terms(client, user_id, seed_history):
+    from modules.history.service import history_service
+
+    first = seed_history(
+        user_id, ["孩子最近总是撒谎怎么办？", "孩子撒谎时先别急着批评，了解撒谎背后的原因。"], roles=("user", "assistant")
+    )
+    seed_history(user_id, ["孩子不爱吃蔬菜"])
+    seed_history("someone_else", ["孩子撒谎怎么办"])
+    headers = _headers_for_user(user_id)
+
+    # 三字及以上：FTS5 索引，按相关度排序，只返回本用户的消息
+    result = client.get("/history/search", headers=headers, params={"q": "别急着"}).json()
+    assert [h["session_id"] for h in result["hits"]] == [first]
+    assert "<em>别急着</em>" in result["hits"][0]["snippet"]
+
+    # 两字短词：LIKE 回退
+    short = client.get("/history/search", headers=headers, params={"q": "撒谎"}).json()
+    assert len(short["hits"]) == 2 and all("<em>撒谎</em>" in h["snippet"] for h in short["hits"])
+
+    # 多个词需全部命中；分页
+    both = client.get("/history/search", headers=headers, params={"q": "孩子 撒谎 背后的原因"}).json()
+    assert [h["role"] for h in both["hits"]] == ["assistant"]
+    page = client.get("/history/search", headers=headers, params={"q": "孩子", "limit": 2}).json()
+    assert len(page["hits"]) == 2 and page["has_more"] is True
+
+    # 删除会话后索引同步更新
+    history_service.delete_session(user_id, first)
+    assert client.get("/history/search", headers=headers, params={"q": "别急着"}).json()["hits"] == []
+
+
+def test_list_sessions_from_denormalized_counters(client, user_id, seed_history):
+    from modules.history.service import history_service
+
+    first = seed_history(user_id)
+    second = seed_history(user_id, ["第一句"])
+    history_service.record_turn(user_id, first, "孩子撒谎怎么办？", "先别急着批评。\n了解原因。")
+    headers = _headers_for_user(user_id)
+
+    sessions = client.get("/history/sessions", headers=headers).json()["sessions"]
+    assert [s["session_id"] for s in sessions] == [first, second]
+    assert sessions[0]["message_count"] == 2
+    assert sessions[0]["last_message_preview"] == "先别急着批评。 了解原因。"
+    assert sessions[1]["message_count"] == 1
+
+    page = client.get("/history/sessions", headers=headers, params={"limit": 1}).json()
+    assert page["has_more"] is True
+    rest = client.get("/history/sessions", headers=headers, params={"before": page["next_before"]}).json()
+    assert [s["session_id"] for s in rest["sessions"]] == [second]
+    assert rest["has_more"] is False and rest["next_before"] is None
+    assert client.get("/history/sessions", headers=headers, params={"before": "bogus"}).status_code == 400
+
+    history_service.clear_session(user_id, first)
+    cleared = client.get("/history/sessions", headers=headers).json()["sessions"][0]
+    assert cleared["message_count"] == 0 and cleared["last_message_preview"] is None
+
+
+def test_list_sessions_pages_through_identical_timestamps(client, user_id, seed_history):
+    from datetime import datetime
+    from modules.history.service import SessionModel, history_service
+    from sqlmodel import Session, update
+
+    sessions = [seed_history(user_id) for _ in range(3)]
+    with Session(history_service.engine) as session:
+        session.execute(
+            update(SessionModel).where(SessionModel.user_id == user_id).values(updated_at=datetime(2026, 1, 1))
+        )
+        session.commit()
+
+    # 每页一条：updated_at 全部相同，按 session_id 倒序逐页取完，不跳过也不重复
+    headers, seen, before = _headers_for_user(user_id), [], None
+    while True:
+        params = {"limit": 1} if before is None else {"limit": 1, "before": before}
+        page = client.get("/history/sessions", headers=headers, params=params).json()
+        seen += [s["session_id"] for s in page["sessions"]]
+        if not page["has_more"]:
+            break
+        before = page["next_before"]
+    assert seen == sorted(sessions, reverse=True)
+
+
+def _metric_value(body: str, sample: str) -> float:
+    for line in body.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"{sample} 不在 /metrics 输出中")
+
+
+def test_metrics_expose_chat_stage_latencies(client, user_id):
+    before = client.get("/metrics")
+    assert before.status_code == 200
+    assert before.headers["content-type"].startswith("text/plain; version=0.0.4")
+    history_loads = _metric_value(before.text, 'chat_stage_duration_seconds_count{stage="history_load"}')
+
+    resp = client.post(
+        "/chat_with_context",
+        headers=_headers_for_user(user_id),
+        json={"message": "孩子总是拖拉怎么办？", "response_mode": "concise"},
+    )
+    assert resp.status_code == 200
+    body = client.get("/metrics").text
+
+    assert _metric_value(body, 'chat_stage_duration_seconds_count{stage="history_load"}') == history_loads + 1
+    for stage in ("session_resolve", "profile_load", "prompt_build", "generation", "safety_filter", "history_write"):
+        assert _metric_value(body, f'chat_stage_duration_seconds_count{{stage="{stage}"}}') >= 1
+    assert _metric_value(body, 'chat_request_duration_seconds_bucket{endpoint="chat_with_context",le="+Inf"}') >= 1
+    assert _metric_value(body, 'chat_tokens_total{kind="prompt"}') > 0
+    assert _metric_value(body, 'chat_in_flight_requests') == 0
+    assert 'cache_hits_total{cache="response"}' in body
+
+
+def test_request_tracing_server_timing_and_log(client, user_id, caplog, monkeypatch):
+    import logging
+    from modules.tracing.middleware import logger as trace_logger
+
+    # 默认不向客户端暴露 Server-Timing
+    resp = client.get("/history/sessions", headers=_headers_for_user(user_id))
+    assert "x-request-id" in resp.headers and "server-timing" not in resp.headers
+
+    monkeypatch.setattr(settings, "TRACE_SERVER_TIMING", True)
+    monkeypatch.setattr(settings, "TRACE_LOG_MIN_MS", 0)
+    trace_logger.addHandler(caplog.handler)
+    try:
+        with caplog.at_level(logging.INFO, logger=trace_logger.name):
+            resp = client.post(
+                "/chat_with_context",
+                headers={**_headers_for_user(user_id), "X-Request-ID": "req-trace-1"},
+                json={"message": "孩子不爱吃蔬菜怎么办？", "response_mode": "concise"},
+            )
+    finally:
+        trace_logger.removeHandler(caplog.handler)
+    assert resp.status_code == 200
+    assert resp.headers["x-request-id"] == "req-trace-1"
+    timing = resp.headers["server-timing"]
+    for name in ("total", "adapter.load_context", "history.load_turn_context", "chat.upstream", "history.record_turn"):
+        assert f"{name};dur=" in timing
+
+    record = next(
+        json.loads(r.getMessage()) for r in caplog.records
+        if r.name == trace_logger.name and '"req-trace-1"' in r.getMessage()
+    )
+    assert record["path"] == "/chat_with_context" and record["status"] == 200
+    depth = {s["name"]: s["depth"] for s in record["spans"]}
+    # 数据库线程中的 span 嵌套在适配层 span 之下
+    assert depth["history.load_turn_context"] == depth["adapter.load_context"] + 1
+    assert depth["history.session_resolve"] == depth["history.load_turn_context"] + 1
+
+    # 不合法的请求 id 被替换为新生成的 id
+    resp = client.get("/history/sessions", headers={**_headers_for_user(user_id), "X-Request-ID": "bad id\t"})
+    assert len(resp.headers["x-request-id"]) == 32
+
+    # 流式生成中的安全扫描穿插在各增量之间：只记累计时长，没有开始时刻
+    trace_logger.addHandler(caplog.handler)
+    try:
+        with caplog.at_level(logging.INFO, logger=trace_logger.name):
+            client.post(
+                "/chat_with_context/stream",
+                headers={**_headers_for_user(user_id), "X-Request-ID": "req-trace-2"},
+                json={"message": "孩子不肯睡觉怎么办？"},
+            )
+    finally:
+        trace_logger.removeHandler(caplog.handler)
+    record = next(
+        json.loads(r.getMessage()) for r in caplog.records
+        if r.name == trace_logger.name and '"req-trace-2"' in r.getMessage()
+    )
+    assert record["spans"][-1]["name"] == "chat.safety_filter"
+    assert record["spans"][-1]["start_ms"] is None
+
+
+def test_sampling_profiler_admin_and_folded_output(client, user_id, monkeypatch):
+    import re
+    import threading
+    from modules.tracing.profiler import profiler
+
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "secret")
+    admin = {"X-Admin-Token": "secret"}
+    assert client.put("/admin/profiler", json={"sample_rate": 1}).status_code == 403
+
+    try:
+        stats = client.put("/admin/profiler", headers=admin, json={"sample_rate": 1, "interval_ms": 1}).json()
+        assert stats["sample_rate"] == 1
+        client.post(
+            "/chat_with_context",
+            headers=_headers_for_user(user_id),
+            json={"message": "孩子沉迷动画片怎么办？", "response_mode": "concise"},
+        )
+        stats = client.get("/admin/profiler", headers=admin).json()
+        # 对话请求与本次查询都被采样（查询本身仍在处理中）
+        assert stats["sampled_requests"] >= 2 and stats["active_requests"] == 1
+        assert client.put("/admin/profiler", headers=admin, json={"sample_rate": 0}).json()["sample_rate"] == 0
+
+        # 直接采一次样：忙碌线程的调用栈以 folded 格式出现
+        stop = threading.Event()
+
+        def _spin():
+            while not stop.is_set():
+                pass
+
+        worker = threading.Thread(target=_spin, name="spinner")
+        worker.start()
+        try:
+            profiler._sample()
+        finally:
+            stop.set()
+            worker.join()
+        resp = client.get("/admin/profiler/folded", headers=admin, params={"reset": True})
+        assert resp.headers["content-type"].startswith("text/plain")
+        lines = resp.text.splitlines()
+        assert all(re.fullmatch(r".+ \d+", line) for line in lines)
+        assert any(line.startswith("spinner;") and "_spin (tests/test_api.py:" in line for line in lines)
+        assert client.get("/admin/profiler", headers=admin).json()["distinct_stacks"] == 0
+    finally:
+        client.delete("/admin/profiler", headers=admin)
+    assert profiler.sample_rate == 0
+
+
+def test_schema_migrations_run_only_in_init_db(tmp_path):
+    from sqlalchemy import inspect
+    from modules.history.service import HistoryService
+
+    db_path = tmp_path / "fresh.db"
+    service = HistoryService(db_url=f"sqlite:///{db_path}", write_behind=False)
+    # 构造服务（即导入模块）不访问数据库
+    assert not db_path.exists()
+    service.init_db()
+    service.init_db()  # 幂等
+    tables = set(inspect(service.engine).get_table_names())
+    assert {"sessionmodel", "messagemodel", "sessionarchivemodel", "messagefts"} <= tables
+    service.engine.dispose()
+
+
+def test_reclaim_space_reports_noop_without_incremental_vacuum(tmp_path):
+    from modules.database import reclaim_space
+    from modules.history.service import HistoryService
+
+    service = HistoryService(db_url=f"sqlite:///{tmp_path / 'reclaim.db'}", write_behind=False)
+    service.init_db()
+    # 默认 auto_vacuum=NONE：不带 full 时无法回收，返回 None 而不是“回收了 0 字节”
+    assert reclaim_space(service.engine) is None
+    assert reclaim_space(service.engine, full=True) >= 0
+    assert reclaim_space(service.engine) is not None  # 已切换为增量回收
+    service.engine.dispose()
@@ -0,0 +1,30 @@
+"""
+上下文构建单元测试：按 token 预算从新到旧选取历史
+"""
+import os
+import sys
+
+_BACKEND_PATH = os.path.join(os.path.dirname(__file__), "..", "backend")
+sys.path.insert(0, os.path.abspath(_BACKEND_PATH))
+
+from modules.chat.context import ContextBuilder, estimate_tokens  # noqa: E402
+
+
+def test_estimate_tokens_counts_cjk_per_char():
+    assert estimate_tokens("孩子不肯写作业") == 7
+    assert estimate_tokens("abcdefgh") == 2
+
+
+def test_build_keeps_newest_history_within_budget():
+    history = [
+        {"role": "user", "content": "旧" * 500},
+        {"role": "assistant", "content": "中" * 50},
+        {"role": "user", "content": "新" * 50},
+    ]
+    builder = ContextBuilder(token_budget=400, reserved_output_tokens=200)
+    context = builder.build("系统", history, "问题")
+
+    # 最旧的长消息放不下，被丢弃；其余按原顺序保留
+    assert [m["content"][0] for m in context.messages] == ["系", "中", "新", "问"]
+    assert context.history_used == 2
+    assert context.prompt_tokens <= 400 - 200
@@ -0,0 +1,45 @@
+"""
+安全过滤自动机单元测试
+
+覆盖：
+- 多关键词一次扫描、重叠关键词（“殴打”与“打”）
+- 流式场景下关键词被拆在两个 chunk 之间
+- filter_unsafe_content 行为保持不变
+"""
+import os
+import sys
+
+_BACKEND_PATH = os.path.join(os.path.dirname(__file__), "..", "backend")
+sys.path.insert(0, os.path.abspath(_BACKEND_PATH))
+
+from modules.chat.safety import (  # noqa: E402
+    SAFETY_REMINDER,
+    SafetyMatch,
+    SafetyMatcher,
+    filter_unsafe_content,
+)
+
+
+def test_find_all_reports_terms_and_positions():
+    matcher = SafetyMatcher(["打", "殴打", "罚站"])
+    matches = matcher.find_all("不要殴打或罚站")
+    assert matches == [
+        SafetyMatch("殴打", 2, 4),
+        SafetyMatch("打", 3, 4),
+        SafetyMatch("罚站", 5, 7),
+    ]
+
+
+def test_scanner_matches_across_chunk_boundaries():
+    matcher = SafetyMatcher(["关禁闭", "体罚"])
+    scanner = matcher.scanner()
+    assert scanner.feed("不要关") == []
+    assert scanner.feed("禁") == []
+    assert scanner.feed("闭，也不要体") == [SafetyMatch("关禁闭", 2, 5)]
+    assert scanner.feed("罚") == [SafetyMatch("体罚", 9, 11)]
+    assert scanner.terms == ["关禁闭", "体罚"]
+
+
+def test_filter_unsafe_content_appends_reminder():
+    assert filter_unsafe_content("先共情再设边界") == "先共情再设边界"
+    assert filter_unsafe_content("不要打孩子") == "不要打孩子" + SAFETY_REMINDER